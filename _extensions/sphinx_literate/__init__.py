@@ -68,6 +68,8 @@ def setup(app: Sphinx):
 
     return {
         'version': '0.2',
+        # Bump this whenever the data stored in the environment changes
+        'env_version': 7,
         'parallel_read_safe': True,
         'parallel_write_safe': True,
     }
@@ -3,17 +3,25 @@ from docutils.nodes import Node
 import sphinx
 from sphinx.builders import Builder
 from sphinx.locale import __
+from sphinx.util import logging
 from sphinx.util.osutil import ensuredir
+from sphinx.util.parallel import ParallelTasks, make_chunks, parallel_available
 from sphinx.errors import ExtensionError
 
-from os.path import join, dirname, getmtime
-from typing import Any, Iterator, Set, Optional
+from os.path import join, dirname, exists, getmtime, relpath
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Set, Tuple, Optional
 from zipfile import ZipFile
+import hashlib
+import io
+import os
 import shutil
 import json
 
 from .registry import CodeBlock, CodeBlockRegistry
-from .tangle import tangle
+from .tangle import tangle_iter, tangle_closure, BlockDependency
+from .cache import TangleCache
+
+logger = logging.getLogger(__name__)
 
 #############################################################
 # Builder
@@ -25,31 +33,63 @@ class TangleBuilder(Builder):
 
     # Inherited methods
 
+    # Name of the file, in the output directory, that records how each output
+    # file was tangled, for incremental builds.
+    manifest_filename = ".tangle-manifest.json"
+    manifest_version = 1
+
     def init(self) -> None:
-        pass
+        # Documents that changed since the last time the manifest was written
+        self.changed_docnames: Set[str] = set()
 
-    def get_outdated_docs(self) -> Iterator[str]:
+        # Set when the build runs although no document is out of date
+        self.only_check_outputs = False
+
+        # On-disk cache of tangled files, open while tangling in finish()
+        self.tangle_cache: TangleCache | None = None
+
+    def get_outdated_docs(self) -> List[str] | str:
+        # NB: Documents may also have been re-read by another builder sharing
+        # the same environment, so we compare with the last tangle time.
+        try:
+            targetmtime = getmtime(join(self.outdir, self.manifest_filename))
+        except Exception:
+            targetmtime = 0
+        outdated_docs = []
         for docname in self.env.found_docs:
             if docname not in self.env.all_docs:
-                yield docname
+                outdated_docs.append(docname)
                 continue
-            targetname = join(self.outdir, docname + ".meta.txt")
-            try:
-                targetmtime = getmtime(targetname)
-            except Exception:
-                targetmtime = 0
             try:
                 srcmtime = getmtime(self.env.doc2path(docname))
                 if srcmtime > targetmtime:
-                    yield docname
+                    outdated_docs.append(docname)
             except OSError:
                 # source doesn't exist anymore
                 pass
 
+        if not outdated_docs:
+            # Sphinx stops before finish() when no target is out of date, but
+            # tangled or fetched files may have been removed from the output
+            # directory, or the manifest may be missing or incomplete. A
+            # string makes it run anyway, and finish() only writes the files
+            # that the manifest does not describe or that do not exist.
+            self.only_check_outputs = True
+            return str(__('no outdated document, checking tangled files'))
+        return outdated_docs
+
     def get_target_uri(self, docname: str, typ: Optional[str] = None) -> str:
         #print(f"get_target_uri(docname={docname}, typ={typ})")
         return ""
 
+    def write(self, build_docnames: Iterable[str], updated_docnames: Sequence[str], method: str = 'update') -> None:
+        if self.only_check_outputs and build_docnames == ['__all__']:
+            build_docnames = []
+        elif build_docnames is None or build_docnames == ['__all__']:
+            build_docnames = self.env.found_docs
+        self.changed_docnames = set(build_docnames) | set(updated_docnames)
+        super().write(build_docnames, updated_docnames, method)
+
     def prepare_writing(self, docnames: Set[str]) -> None:
         #print(f"prepare_writing(docnames={docnames})")
         pass
@@ -61,16 +101,45 @@ class TangleBuilder(Builder):
     def finish(self) -> None:
         # Tangle only at the end to account for unordered definitions and inheritance
         registry = CodeBlockRegistry.from_env(self.env)
-        registry.try_fixing_all_missing()
+        registry.finalize()
 
-        for tangle_root in registry.all_tangle_roots():
-            self.processed_files = set()
+        files_to_tangle = self.list_files_to_tangle(registry)
 
-            # Tangle blocks
-            for lit in registry.blocks_by_root(tangle_root):
-                if lit.name.startswith("file:"):
-                    self.tangle_and_write(lit, tangle_root)
+        # Skip files that do not depend on any changed document
+        manifest = self.load_manifest()
+        new_manifest = {}
+        outdated_files = []
+        is_outdated = self.build_outdated_file_checker(registry)
+        for lit, tangle_root in files_to_tangle:
+            entry = manifest.get(self.get_manifest_key(lit, tangle_root))
+            if is_outdated(lit, tangle_root, entry):
+                outdated_files.append((lit, tangle_root))
+            else:
+                new_manifest[self.get_manifest_key(lit, tangle_root)] = entry
+        logger.info(
+            __('%d tangled files out of date (out of %d)'),
+            len(outdated_files), len(files_to_tangle)
+        )
 
+        # Tangle blocks
+        self.tangle_cache = self.open_tangle_cache()
+        try:
+            if self.tangle_parallel_ok():
+                entries = self.tangle_parallel(outdated_files, nproc=self.app.parallel)
+            else:
+                entries = self.tangle_serial(outdated_files)
+            if self.tangle_cache is not None:
+                self.tangle_cache.evict()
+        finally:
+            if self.tangle_cache is not None:
+                self.tangle_cache.close()
+            self.tangle_cache = None
+
+        for (lit, tangle_root), entry in zip(outdated_files, entries):
+            if entry is not None:
+                new_manifest[self.get_manifest_key(lit, tangle_root)] = entry
+
+        for tangle_root in registry.all_tangle_roots():
             # Fetch extra code
             fetch_files = registry.all_tangle_fetch_files(tangle_root)
             for path, source_location in fetch_files:
@@ -87,49 +156,376 @@ class TangleBuilder(Builder):
             "roots": registry.all_tangle_roots(),
         }
         metadata_filename = join(self.outdir, "metadata.json")
-        with open(metadata_filename, "w", encoding="utf-8") as f:
-            json.dump(metadata, f, indent=2)
+        self.write_file_if_changed(metadata_filename, json.dumps(metadata, indent=2))
+
+        # Written last, so that an interrupted build does not mark files as up
+        # to date (documents remain newer than the previous manifest).
+        self.save_manifest(new_manifest)
 
     # Internal methods
 
-    def tangle_and_write(self, lit: CodeBlock, tangle_root: str | None):
+    def list_files_to_tangle(self, registry: CodeBlockRegistry) -> List[Tuple[CodeBlock, str | None]]:
         """
+        List all the 'file:' blocks of all tangle roots, in a deterministic
+        order, and check that no two of them would write to the same file.
+        @return a list of (lit, tangle_root) pairs
         NB: tangle_root is different from lit.tangle_root in case of inheritance
         """
-        registry = CodeBlockRegistry.from_env(self.env)
+        files_to_tangle = []
+        outfiles = {}
+        for tangle_root in registry.all_tangle_roots():
+            file_blocks = sorted(
+                registry.file_blocks_by_root(tangle_root),
+                key=lambda lit: lit.name,
+            )
+            processed_files = set()
+            for lit in file_blocks:
+                filename = lit.name[len("file:"):].strip()
+
+                # Easy mistake guard
+                if filename in processed_files:
+                    message = (
+                        f"There are two different blocks with a name 'file: {filename}' that " +
+                        "only differ from spaces after 'file:', this is likely a mistake."
+                    )
+                    raise ExtensionError(message, modname="sphinx_literate")
+                processed_files.add(filename)
+
+                outfilename = self.get_outfilename(lit, tangle_root)
+                other = outfiles.get(outfilename)
+                if other is not None:
+                    message = (
+                        f"Blocks {other.format()} (from {other.source_location.format()}) " +
+                        f"and {lit.format()} (from {lit.source_location.format()}) " +
+                        f"are both tangled into the same file '{outfilename}'."
+                    )
+                    raise ExtensionError(message, modname="sphinx_literate")
+                outfiles[outfilename] = lit
+
+                files_to_tangle.append((lit, tangle_root))
+        return files_to_tangle
+
+    def get_outfilename(self, lit: CodeBlock, tangle_root: str | None) -> str:
         assert(lit.name.startswith("file:"))
         filename = lit.name[len("file:"):].strip()
-        
-        # Easy mistake guard
-        if filename in self.processed_files:
-            message = (
-                f"There are two different blocks with a name 'file: {filename}' that " +
-                f"only differ from spaces after 'file:', this is likely a mistake."
+        if tangle_root is not None:
+            filename = join(tangle_root, filename)
+        return join(self.outdir, filename)
+
+    def open_tangle_cache(self) -> TangleCache | None:
+        """
+        Open the on-disk cache of tangled files, if enabled by the config
+        value lit_tangle_cache.
+        """
+        setting = self.app.config.lit_tangle_cache
+        if setting is False or setting is None:
+            return None
+        if setting is True:
+            filename = join(self.doctreedir, "tangle-cache.sqlite")
+        else:
+            filename = join(self.confdir, setting)
+        return TangleCache(filename, self.app.config.lit_tangle_cache_size)
+
+    def tangle_parallel_ok(self) -> bool:
+        """
+        Tangling runs in parallel when sphinx-build is called with -j N
+        """
+        return (
+            parallel_available and
+            self.app.parallel > 1 and
+            self.app.is_parallel_allowed('write')
+        )
+
+    def get_manifest_key(self, lit: CodeBlock, tangle_root: str | None) -> str:
+        return relpath(self.get_outfilename(lit, tangle_root), self.outdir).replace('\\', '/')
+
+    def load_manifest(self) -> Dict[str,Dict]:
+        """
+        Load the manifest written by the previous tangle build, if any.
+        Each entry describes an output file:
+         - 'root': tangle root, 'block': name of the file: block
+         - 'uids', 'docnames', 'names': blocks the file was tangled from
+         - 'hash': hash of the written content
+        """
+        try:
+            with open(join(self.outdir, self.manifest_filename), encoding="utf-8") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return {}
+        if manifest.get("version") != self.manifest_version:
+            return {}
+        # Config values that change tangled files without changing documents
+        if manifest.get("config") != self.get_manifest_config():
+            return {}
+        return manifest.get("files", {})
+
+    def get_manifest_config(self) -> Dict:
+        """
+        Config values that affect tangled files but do not require to read
+        documents again (so they are not noticed by the environment).
+        """
+        return {
+            "lit_comment_prefixes": self.app.config.lit_comment_prefixes,
+        }
+
+    def save_manifest(self, files: Dict[str,Dict]) -> None:
+        manifest = {
+            "version": self.manifest_version,
+            "config": self.get_manifest_config(),
+            "files": dict(sorted(files.items())),
+        }
+        try:
+            with open(join(self.outdir, self.manifest_filename), "w", encoding="utf-8") as f:
+                json.dump(manifest, f, indent=1)
+        except OSError as err:
+            logger.warning(__("error writing file %s: %s"), self.manifest_filename, err)
+
+    def build_outdated_file_checker(self, registry: CodeBlockRegistry):
+        """
+        Return a function that tells whether a file must be tangled again,
+        given its entry in the previous manifest.
+        A file is outdated when one of the documents it was tangled from
+        changed or disappeared, when a block it was tangled from disappeared,
+        when a changed document defines a block with the same name as one of
+        its blocks (it may now be appended, replaced, inherited, etc.) or when
+        a changed document defines its tangle root hierarchy.
+        """
+        changed_docnames = self.changed_docnames
+        all_docnames = self.env.all_docs
+
+        # Names of the blocks defined (or modified) in changed documents
+        changed_names = set()
+        for head in registry.blocks():
+            lit = head
+            while lit is not None:
+                if lit.source_location.docname in changed_docnames:
+                    changed_names.add(lit.name)
+                lit = lit.next
+
+        def hierarchy_changed(tangle_root: str | None) -> bool:
+            info = registry.get_tangle_info(tangle_root)
+            while info is not None:
+                if info.source_location.docname in changed_docnames:
+                    return True
+                info = registry.get_tangle_info(info.parent)
+            return False
+
+        def is_outdated(lit: CodeBlock, tangle_root: str | None, entry: Dict | None) -> bool:
+            return (
+                entry is None or
+                entry["root"] != tangle_root or
+                entry["block"] != lit.name or
+                not exists(self.get_outfilename(lit, tangle_root)) or
+                any(d in changed_docnames or d not in all_docnames for d in entry["docnames"]) or
+                any(registry.get_by_uid(uid) is None for uid in entry["uids"]) or
+                any(name in changed_names for name in entry["names"]) or
+                hierarchy_changed(tangle_root)
             )
+
+        return is_outdated
+
+    def tangle_serial(self, files_to_tangle: List[Tuple[CodeBlock, str | None]]) -> List[Dict | None]:
+        return [
+            self.tangle_and_write(lit, tangle_root)
+            for lit, tangle_root in files_to_tangle
+        ]
+
+    def tangle_parallel(self, files_to_tangle: List[Tuple[CodeBlock, str | None]], nproc: int) -> List[Dict | None]:
+        """
+        Split files in chunks that are tangled and written by forked processes.
+        Chunks follow the order of files_to_tangle, so they tend to group files
+        of the same tangle root, which share the same tangle cache.
+        @return the manifest entry of each file
+        """
+        chunks = make_chunks(list(range(len(files_to_tangle))), nproc)
+        entries = [None] * len(files_to_tangle)
+        errors = []
+
+        def tangle_process(indices: List[int]) -> Tuple[List[Dict | None], Tuple[int, str] | None]:
+            # Errors are sent back as plain data so that the main process
+            # reports them in a deterministic order, with their original message
+            chunk_entries = []
+            for i in indices:
+                lit, tangle_root = files_to_tangle[i]
+                try:
+                    chunk_entries.append(self.tangle_and_write(lit, tangle_root))
+                except ExtensionError as err:
+                    return chunk_entries, (i, err.message)
+            return chunk_entries, None
+
+        def on_chunk_finished(indices: List[int], result) -> None:
+            chunk_entries, error = result
+            for i, entry in zip(indices, chunk_entries):
+                entries[i] = entry
+            if error is not None:
+                errors.append(error)
+
+        tasks = ParallelTasks(nproc)
+        for chunk in chunks:
+            tasks.add_task(tangle_process, chunk, on_chunk_finished)
+        tasks.join()
+
+        if errors:
+            # Report the error that a serial tangle would have raised first
+            _, message = min(errors)
             raise ExtensionError(message, modname="sphinx_literate")
-        self.processed_files.add(filename)
 
-        if tangle_root is not None:
-            filename = join(tangle_root, filename)
+        return entries
 
-        tangled_content, root_lit = tangle(
+    def tangle_and_write(self, lit: CodeBlock, tangle_root: str | None) -> Dict | None:
+        """
+        NB: tangle_root is different from lit.tangle_root in case of inheritance
+        The file is not written if its content did not change since the last
+        build, so that its modification time remains untouched.
+        @return the manifest entry describing the tangled file
+        """
+        registry = CodeBlockRegistry.from_env(self.env)
+        outfilename = self.get_outfilename(lit, tangle_root)
+
+        # Files whose dependency closure did not change are read from the
+        # on-disk cache rather than tangled again.
+        cache = self.tangle_cache
+        if cache is not None:
+            cache_key, closure = tangle_closure(lit.name, tangle_root, registry, self.app.config)
+            content = cache.get(cache_key)
+            if content is not None:
+                if not self.write_file_if_changed(outfilename, content):
+                    return None
+                return self.build_manifest_entry(
+                    lit,
+                    tangle_root,
+                    closure,
+                    hashlib.sha256(content.encode('utf-8')).hexdigest(),
+                )
+
+        dependencies: Set[BlockDependency] = set()
+        tangled_lines, root_lit = tangle_iter(
             lit.name,
             tangle_root,
             registry,
             self.app.config,
-            lit.source_location.format() + ", "
+            lit.source_location.format() + ", ",
+            dependencies,
         )
 
-        if not tangled_content:
-            return
+        first_line = next(tangled_lines, None)
+        if first_line is None:
+            return None
+
+        content_hash = hashlib.sha256()
+        # Chunks kept for the cache, unless the file is too large for it
+        cached_chunks = [] if cache is not None else None
+        def hashed_chunks():
+            nonlocal cached_chunks
+            size = 0
+            for chunk in self.join_lines(first_line, tangled_lines):
+                content_hash.update(chunk.encode('utf-8'))
+                if cached_chunks is not None:
+                    size += len(chunk)
+                    if size > cache.max_entry_size:
+                        cached_chunks = None
+                    else:
+                        cached_chunks.append(chunk)
+                yield chunk
+
+        if not self.write_file_if_changed(outfilename, hashed_chunks()):
+            return None
+
+        if cached_chunks is not None:
+            cache.put(cache_key, "".join(cached_chunks))
+
+        # Dependencies are known once all lines have been generated
+        return self.build_manifest_entry(lit, tangle_root, dependencies, content_hash.hexdigest())
+
+    @staticmethod
+    def build_manifest_entry(lit: CodeBlock, tangle_root: str | None, dependencies: Set[BlockDependency], content_hash: str) -> Dict:
+        return {
+            "root": tangle_root,
+            "block": lit.name,
+            "uids": sorted({ uid for uid, _, _ in dependencies if uid is not None }),
+            "docnames": sorted({ docname for _, docname, _ in dependencies }),
+            "names": sorted({ name for _, _, name in dependencies }),
+            "hash": content_hash,
+        }
 
-        outfilename = join(self.outdir, filename)
-        ensuredir(dirname(outfilename))
+    @staticmethod
+    def join_lines(first_line: str, lines: Iterator[str], chunk_size: int = 1 << 16) -> Iterator[str]:
+        """
+        Same as '\\n'.join([first_line, *lines]), but generated as chunks of
+        roughly chunk_size characters.
+        """
+        buffer = [first_line]
+        size = len(first_line)
+        for line in lines:
+            buffer.append(line)
+            size += len(line) + 1
+            if size >= chunk_size:
+                yield '\n'.join(buffer)
+                # The next chunk starts with the line break
+                buffer = [""]
+                size = 0
+        if buffer != [""]:
+            yield '\n'.join(buffer)
+
+    def write_file_if_changed(self, filename: str, data: str | Iterable[str]) -> bool:
+        """
+        Write data to a file, unless it already contains the very same data,
+        so that its modification time remains untouched (this prevents
+        downstream build systems from rebuilding unchanged files).
+        The data may be given as an iterable of chunks. It is then consumed
+        while being compared with the existing file, and written from the
+        first chunk that differs, so it never needs to be all in memory.
+        New content is written to a temporary file that replaces the existing
+        one only once all chunks were generated, so that an error raised by
+        the iterable leaves the existing file as it was.
+        @return False if an error occurred
+        """
+        if isinstance(data, str):
+            data = [data]
+
+        ensuredir(dirname(filename))
+        tmpfilename = f"{filename}.{os.getpid()}.tmp"
+        tmp = None
         try:
-            with open(outfilename, 'w', encoding='utf-8') as f:
-                f.write('\n'.join(tangled_content))
+            try:
+                existing = open(filename, 'rb')
+            except FileNotFoundError:
+                existing = None
+            try:
+                # Number of leading bytes that are the same as in the existing file
+                matched = 0
+                for chunk in data:
+                    # Same newlines as a file opened in text mode
+                    if os.linesep != '\n':
+                        chunk = chunk.replace('\n', os.linesep)
+                    raw = chunk.encode('utf-8')
+                    if tmp is None:
+                        if existing is not None and existing.read(len(raw)) == raw:
+                            matched += len(raw)
+                            continue
+                        tmp = open_replacement_file(tmpfilename, existing, matched)
+                    tmp.write(raw)
+                if tmp is None:
+                    if existing is not None and not existing.read(1):
+                        return True
+                    # The new content is a prefix of the existing one
+                    tmp = open_replacement_file(tmpfilename, existing, matched)
+            finally:
+                if existing is not None:
+                    existing.close()
+            tmp.close()
+            if existing is not None:
+                shutil.copymode(filename, tmpfilename)
+            os.replace(tmpfilename, filename)
         except OSError as err:
-            logger.warning(__("error writing file %s: %s"), outfilename, err)
+            logger.warning(__("error writing file %s: %s"), filename, err)
+            return False
+        finally:
+            if tmp is not None and not tmp.closed:
+                tmp.close()
+            if tmp is not None and exists(tmpfilename):
+                os.remove(tmpfilename)
+        return True
 
     def fetch_file(self, path, tangle_root):
         if path.name.endswith(".zip"):
@@ -137,3 +533,22 @@ class TangleBuilder(Builder):
                 zf.extractall(join(self.outdir, tangle_root))
         else:
             shutil.copy(path, join(self.outdir, tangle_root))
+
+#############################################################
+# Utils
+
+def open_replacement_file(tmpfilename: str, existing: io.BufferedReader | None, size: int) -> io.BufferedWriter:
+    """
+    Create the temporary file that replaces an existing file, starting
+    with the first size bytes of the existing file.
+    """
+    tmp = open(tmpfilename, 'wb')
+    if existing is not None and size > 0:
+        existing.seek(0)
+        while size > 0:
+            buffer = existing.read(min(size, 1 << 16))
+            if not buffer:
+                break
+            tmp.write(buffer)
+            size -= len(buffer)
+    return tmp
@@ -0,0 +1,138 @@
+from __future__ import annotations
+from typing import Optional
+import os
+import sqlite3
+import time
+
+from sphinx.locale import __
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+#############################################################
+
+class TangleCache:
+    """
+    On-disk cache of tangled files, shared by successive builds (and by
+    builds of different source trees that point to the same file). Entries
+    map the hash of the dependency closure of a file, as returned by
+    tangle.tangle_closure(), to its tangled content.
+
+    The cache is a sqlite database, so that processes forked by parallel
+    builds can read and write it concurrently. Least recently used entries
+    are evicted by evict() when its total size exceeds max_size bytes.
+
+    Errors never fail the build: they are reported as a warning and the
+    cache is then disabled for the rest of the build.
+    """
+
+    # Content larger than this is not cached, so that tangling it keeps
+    # streaming lines rather than holding the whole file in memory.
+    max_entry_size = 16 << 20
+
+    def __init__(self, filename: str, max_size: int) -> None:
+        self.filename = filename
+        self.max_size = max_size
+        self.enabled = True
+
+        # The connection is created on demand by each process, as sqlite
+        # connections must not be used across a fork.
+        self._connection: sqlite3.Connection | None = None
+        self._pid: int | None = None
+
+    def get(self, key: str) -> Optional[str]:
+        """
+        @return the content cached for a given key, or None
+        """
+        connection = self._connect()
+        if connection is None:
+            return None
+        try:
+            with connection:
+                row = connection.execute(
+                    "SELECT content FROM tangled WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    return None
+                connection.execute(
+                    "UPDATE tangled SET last_used = ? WHERE key = ?", (time.time(), key)
+                )
+            return row[0].decode('utf-8')
+        except (sqlite3.Error, UnicodeDecodeError) as err:
+            self._disable(err)
+            return None
+
+    def put(self, key: str, content: str) -> None:
+        connection = self._connect()
+        if connection is None:
+            return
+        data = content.encode('utf-8')
+        if len(data) > self.max_entry_size:
+            return
+        try:
+            with connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO tangled (key, content, size, last_used) VALUES (?, ?, ?, ?)",
+                    (key, data, len(data), time.time()),
+                )
+        except sqlite3.Error as err:
+            self._disable(err)
+
+    def evict(self) -> None:
+        """
+        Remove least recently used entries until the total size of the cache
+        is at most max_size.
+        """
+        connection = self._connect()
+        if connection is None:
+            return
+        try:
+            with connection:
+                total = connection.execute("SELECT COALESCE(SUM(size), 0) FROM tangled").fetchone()[0]
+                if total <= self.max_size:
+                    return
+                rows = connection.execute(
+                    "SELECT key, size FROM tangled ORDER BY last_used"
+                ).fetchall()
+                evicted = []
+                for key, size in rows:
+                    if total <= self.max_size:
+                        break
+                    evicted.append((key,))
+                    total -= size
+                connection.executemany("DELETE FROM tangled WHERE key = ?", evicted)
+            connection.execute("VACUUM")
+        except sqlite3.Error as err:
+            self._disable(err)
+
+    def close(self) -> None:
+        if self._connection is not None and self._pid == os.getpid():
+            self._connection.close()
+        self._connection = None
+        self._pid = None
+
+    def _connect(self) -> sqlite3.Connection | None:
+        if not self.enabled:
+            return None
+        if self._connection is not None and self._pid == os.getpid():
+            return self._connection
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.filename)), exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=30)
+            with connection:
+                connection.execute(
+                    "CREATE TABLE IF NOT EXISTS tangled ("
+                    "key TEXT PRIMARY KEY, content BLOB NOT NULL, "
+                    "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+                )
+        except (OSError, sqlite3.Error) as err:
+            self._disable(err)
+            return None
+        self._connection = connection
+        self._pid = os.getpid()
+        return connection
+
+    def _disable(self, err: Exception) -> None:
+        logger.warning(__("tangle cache %s disabled: %s"), self.filename, err)
+        self.enabled = False
+        self.close()
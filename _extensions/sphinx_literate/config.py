@@ -1,8 +1,33 @@
 
 def setup(app):
-    # Begin and end a reference to another code block
-    app.add_config_value("lit_begin_ref", "{{", 'html', [str])
-    app.add_config_value("lit_end_ref", "}}", 'html', [str])
+    # Begin and end a reference to another code block (references are parsed
+    # when reading documents, so changing these requires to read them again)
+    app.add_config_value("lit_begin_ref", "{{", 'env', [str])
+    app.add_config_value("lit_end_ref", "}}", 'env', [str])
+
+    # Prefix of the comments that tangle roots in debug mode add around each
+    # block, indexed by lexer name (case insensitive). Lexers that are not
+    # listed use '//'. This only affects tangled output (files written by the
+    # tangle builder, which tracks it in its manifest, and lit-tangle
+    # directives rendered in HTML pages), not the reading of documents.
+    app.add_config_value("lit_comment_prefixes", {
+        "c++": "//",
+        "javascript": "//",
+        "rust": "//",
+        "python": "#",
+        "cmake": "#",
+        "bash": "#",
+    }, 'html', [dict])
+
+    # On-disk cache of tangled files, reused across builds: True stores it in
+    # the doctree directory, a string gives the path of the cache file
+    # (relative to the configuration directory, so that several build
+    # directories can share it) and False disables it.
+    app.add_config_value("lit_tangle_cache", True, '', [bool, str])
+
+    # Maximum size of the tangle cache, in bytes. Least recently used files
+    # are evicted beyond this.
+    app.add_config_value("lit_tangle_cache_size", 256 << 20, '', [int])
 
     # Turn this to False if you want to define your own style (js and css files)
     app.add_config_value("lit_use_default_style", True, 'html', [bool])
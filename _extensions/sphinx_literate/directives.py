@@ -159,7 +159,11 @@ class LiterateDirective(SphinxCodeBlock):
 
         all_targetnodes = []
         for tangle_root in all_tangle_roots:
-            parsed_content = parse_block_content(self.content, tangle_root, self.config)
+            source_location = SourceLocation(
+                docname = self.env.docname,
+                lineno = self.lineno,
+            )
+            parsed_content = parse_block_content(self.content, tangle_root, self.config, source_location)
 
             targetid = 'lit-%d' % self.env.new_serialno('lit')
             targetnode = nodes.target('', '', ids=[targetid])
@@ -167,19 +171,17 @@ class LiterateDirective(SphinxCodeBlock):
             lit = CodeBlock(
                 name = parsed_title.name,
                 tangle_root = tangle_root,
-                source_location = SourceLocation(
-                    docname = self.env.docname,
-                    lineno = self.lineno,
-                ),
+                source_location = source_location,
                 content = self.content,
-                target = targetnode,
+                reference_slots = parsed_content.reference_slots,
+                refid = targetid,
                 lexer = parsed_title.lexer,
             )
 
             # Register
             lit_codeblocks.register_codeblock(lit, parsed_title.options)
             for ref in parsed_content.uid_to_block_link.values():
-                lit_codeblocks.add_reference(lit.key, ref.key)
+                lit_codeblocks.add_reference(lit.key, ref.key, source_location.docname)
 
             all_targetnodes.append(targetnode)
             if tangle_root == primary_tangle_root:
@@ -7,7 +7,7 @@ from sphinx.util.fileutil import copy_asset_file
 from sphinx.environment.adapters.toctree import TocTree
 
 from .registry import CodeBlock, CodeBlockRegistry
-from .nodes import LiterateNode, TangleNode, RegistryNode
+from .nodes import LiterateNode, TangleNode, RegistryNode, BlockInfoTable
 from .tangle import tangle
 from .utils import print_traceback
 
@@ -25,16 +25,42 @@ def purge_registry(app: Sphinx, env, docname: str):
 
 @print_traceback
 def merge_registry(app, env, docnames, other):
+    """
+    Called once per chunk of documents read by a parallel worker. Merging
+    is deferred to finalize_registry() so that it happens in a single batch.
+    """
     registry = CodeBlockRegistry.from_env(env)
-    registry.merge(CodeBlockRegistry.from_env(other))
+    registry.schedule_merge(CodeBlockRegistry.from_env(other), docnames)
+
+####################################################
+
+@print_traceback
+def thaw_registry(app: Sphinx, env, added, changed, removed):
+    """
+    The registry was frozen at the end of the previous build, allow the
+    documents that are about to be purged and re-read to modify it.
+    """
+    CodeBlockRegistry.from_env(env).thaw()
+    return []
+
+####################################################
+
+@print_traceback
+def finalize_registry(app: Sphinx, env):
+    """
+    Once all documents have been read, resolve missing blocks and check the
+    registry once for all rather than for each resolved document.
+    """
+    CodeBlockRegistry.from_env(env).finalize()
+    return []
 
 ####################################################
 
 @print_traceback
 def process_literate_nodes(app: Sphinx, doctree, fromdocname: str):
     registry = CodeBlockRegistry.from_env(app.builder.env)
-    registry.try_fixing_all_missing()
-    registry.check_integrity()
+    # No-op unless env-updated was not emitted for some reason
+    registry.finalize()
 
     has_literate_node = False
     for literate_node in doctree.findall(LiterateNode):
@@ -43,7 +69,7 @@ def process_literate_nodes(app: Sphinx, doctree, fromdocname: str):
         # This check should not be needed if the registry was doing its job...
         for uid, link in literate_node.uid_to_block_link.items():
             if registry.get_rec_by_key(link.key) is None:
-                missing_tangle_root, missing_name = link.key.split("##")
+                missing_tangle_root, missing_name = link.key
                 raise ExtensionError(f"Reference to an invalid block: '{missing_name}' (in tangle root '{missing_tangle_root}')")
 
         literate_node.uid_to_lit = {
@@ -99,8 +125,10 @@ def process_literate_nodes(app: Sphinx, doctree, fromdocname: str):
         app.builder.env.lit_doc_contains_block = {}
     app.builder.env.lit_doc_contains_block[fromdocname] = has_literate_node
 
-    registry_dump = registry.pretty_dump()
+    registry_dump = None
     for registry_node in doctree.findall(RegistryNode):
+        if registry_dump is None:
+            registry_dump = registry.pretty_dump()
         block_node = registry_node.raw_block_node
         block_node.rawsource = '\n'.join(registry_dump)
         block_node.children.clear()
@@ -139,10 +167,18 @@ def html_page_context(
     found_lit_block = builder.env.lit_doc_contains_block.get(docname, False)
     context["lit_show_options"] = found_lit_block
 
+    # Metadata of the blocks of the page, looked up by lit-block-info
+    # elements. It comes first so that it is parsed before them.
+    table = BlockInfoTable.pop_page(builder, docname)
+    if table is not None and "body" in context:
+        context["body"] = table.to_html() + context["body"]
+
 #############################################################
 # Setup
 
 def setup(app):
+    app.connect('env-get-outdated', thaw_registry)
+    app.connect('env-updated', finalize_registry)
     app.connect('doctree-resolved', process_literate_nodes)
     app.connect('env-purge-doc', purge_registry)
     app.connect('env-merge-info', merge_registry)
@@ -11,7 +11,9 @@ const config = {
 // Options tunable by the user
 class Options {
 	constructor() {
-		this.changedEvent = new Event("litOptionsChanged");
+		// Dispatched on document when an option changes, with the name of the
+		// option as event.detail.key
+		this.changedEventType = "litOptionsChanged";
 
 		this.defaultOptions = {
 			showBlockName: true,
@@ -21,23 +23,30 @@ class Options {
 			showHiddenBlocks: false,
 		}
 
+		// In-memory copy of the options, so that reading them does not parse
+		// the local storage again
+		this.values = {};
 		for (const [key, value] of Object.entries(this.defaultOptions)) {
-			if (localStorage.getItem(key) === null) {
+			const stored = localStorage.getItem(key);
+			if (stored === null) {
 				console.log("Initializing option " + key);
 				localStorage.setItem(key, JSON.stringify(value));
+				this.values[key] = value;
 			} else {
-				console.log("Loaded option " + key + ": " + JSON.parse(localStorage.getItem(key)));
+				this.values[key] = JSON.parse(stored);
+				console.log("Loaded option " + key + ": " + this.values[key]);
 			}
 		}
 	}
 
 	get(key) {
-		return JSON.parse(localStorage.getItem(key));
+		return this.values[key];
 	}
 
 	set(key, value) {
+		this.values[key] = value;
 		localStorage.setItem(key, JSON.stringify(value));
-		document.dispatchEvent(this.changedEvent);
+		document.dispatchEvent(new CustomEvent(this.changedEventType, { detail: { key: key } }));
 	}
 }
 const options = new Options();
@@ -150,6 +159,221 @@ const litBlockInfoStyle = `
 }
 `;
 
+// Stylesheets shared by all the shadow roots of a given element type. Where
+// constructable stylesheets are not supported, each shadow root gets its own
+// <style> element instead.
+const supportsAdoptedStyleSheets = (
+	typeof CSSStyleSheet !== "undefined" &&
+	"replaceSync" in CSSStyleSheet.prototype &&
+	typeof ShadowRoot !== "undefined" &&
+	"adoptedStyleSheets" in ShadowRoot.prototype
+);
+
+function createSharedStyle(css) {
+	if (supportsAdoptedStyleSheets) {
+		const sheet = new CSSStyleSheet();
+		sheet.replaceSync(css);
+		return sheet;
+	}
+	return css;
+}
+
+/**
+ * Apply a style returned by createSharedStyle() to a shadow root.
+ * @return the nodes that must remain in the shadow root when replacing its
+ *         content
+ */
+function adoptSharedStyle(shadowRoot, style) {
+	if (supportsAdoptedStyleSheets) {
+		shadowRoot.adoptedStyleSheets = [style];
+		return [];
+	}
+	const styleElement = document.createElement("style");
+	styleElement.textContent = style;
+	return [styleElement];
+}
+
+const litRefSharedStyle = createSharedStyle(commonStyle + litRefStyle);
+const litBlockInfoSharedStyle = createSharedStyle(commonStyle + litBlockInfoStyle);
+
+// Elements currently in the document, updated by a single listener when the
+// options they depend on change
+const connectedLitRefs = new Set();
+const connectedHiddenLitRefs = new Set();
+const connectedLitBlockInfos = new Set();
+
+function elementsDependingOn(key) {
+	switch (key) {
+	case 'showReferenceLinks':
+		return connectedLitRefs;
+	case 'showHiddenLinks':
+		return connectedHiddenLitRefs;
+	case 'showBlockName':
+	case 'showReferenceDetails':
+		return connectedLitBlockInfos;
+	case 'showHiddenBlocks':
+		return [];
+	default:
+		// Unknown option: update everything
+		return [...connectedLitRefs, ...connectedLitBlockInfos];
+	}
+}
+
+document.addEventListener(options.changedEventType, function(event) {
+	const key = event.detail ? event.detail.key : undefined;
+	for (const element of elementsDependingOn(key)) {
+		element.optionChanged(key);
+	}
+	if (document.body !== null) {
+		document.body.setAttribute("data-lit-block-show-hidden", options.get("showHiddenBlocks"));
+	}
+});
+
+/**
+ * Defer the rendering of the shadow DOM of lit elements, so that pages with
+ * thousands of references do not block their first paint. Elements are
+ * rendered as soon as they get near the viewport (where IntersectionObserver
+ * is supported), and the other ones are rendered in batches when the browser
+ * is idle, so that they are ready by the time the reader scrolls to them.
+ *
+ * Elements must implement render(), which builds their content for the
+ * current options, and have boolean attributes rendered, stale (an option
+ * changed since the last render) and nearViewport.
+ */
+class RenderScheduler {
+	constructor() {
+		// Connected elements that were never rendered or are stale
+		this.pending = new Set();
+
+		// Render elements up to one screen above and below the viewport
+		this.observer = null;
+		if (typeof IntersectionObserver !== "undefined") {
+			this.observer = new IntersectionObserver(
+				entries => this.onIntersection(entries),
+				{ rootMargin: "100% 0px" }
+			);
+		}
+
+		this.idleCallbackScheduled = false;
+		// Number of elements rendered per batch when requestIdleCallback is
+		// not supported
+		this.batchSize = 100;
+	}
+
+	observe(element) {
+		if (this.observer !== null) {
+			this.observer.observe(element);
+		}
+		if (!element.rendered || element.stale) {
+			this.pending.add(element);
+			this.scheduleIdleRendering();
+		}
+	}
+
+	unobserve(element) {
+		if (this.observer !== null) {
+			this.observer.unobserve(element);
+		}
+		this.pending.delete(element);
+	}
+
+	/**
+	 * Called when an option the element depends on changed: render it now if
+	 * it is near the viewport, or later otherwise.
+	 */
+	invalidate(element) {
+		if (!element.rendered) {
+			// Not rendered yet, it will use the current options
+			return;
+		}
+		if (this.observer === null || element.nearViewport) {
+			element.render();
+		} else {
+			element.stale = true;
+			this.pending.add(element);
+			this.scheduleIdleRendering();
+		}
+	}
+
+	/**
+	 * Render all pending elements right away (e.g., before printing).
+	 */
+	flush() {
+		for (const element of this.pending) {
+			element.render();
+		}
+		this.pending.clear();
+	}
+
+	onIntersection(entries) {
+		for (const entry of entries) {
+			const element = entry.target;
+			element.nearViewport = entry.isIntersecting;
+			if (entry.isIntersecting && this.pending.delete(element)) {
+				element.render();
+			}
+		}
+	}
+
+	scheduleIdleRendering() {
+		if (this.idleCallbackScheduled) {
+			return;
+		}
+		this.idleCallbackScheduled = true;
+		if (typeof requestIdleCallback !== "undefined") {
+			requestIdleCallback(deadline => this.renderIdleBatch(deadline));
+		} else {
+			setTimeout(() => this.renderIdleBatch(null), 0);
+		}
+	}
+
+	renderIdleBatch(deadline) {
+		this.idleCallbackScheduled = false;
+		let count = 0;
+		for (const element of this.pending) {
+			if (deadline !== null ? deadline.timeRemaining() <= 0 : count >= this.batchSize) {
+				break;
+			}
+			this.pending.delete(element);
+			element.render();
+			++count;
+		}
+		if (this.pending.size > 0) {
+			this.scheduleIdleRendering();
+		}
+	}
+}
+const renderScheduler = new RenderScheduler();
+window.addEventListener("beforeprint", () => renderScheduler.flush());
+
+// Metadata of the literate blocks of the page (see BlockInfoTable in nodes.py),
+// parsed on first use
+let blockInfoTable = null;
+
+/**
+ * Return the metadata of the block with the given uid, with link indices
+ * resolved to link objects.
+ */
+function getBlockInfo(uid) {
+	if (blockInfoTable === null) {
+		const script = document.getElementById("lit-block-data");
+		blockInfoTable = script !== null ? JSON.parse(script.textContent) : { links: [], blocks: {} };
+	}
+	const data = blockInfoTable.blocks[uid];
+	if (data === undefined) {
+		return null;
+	}
+	if (data.resolved === undefined) {
+		data.resolved = {};
+		for (const [key, value] of Object.entries(data)) {
+			if (Array.isArray(value)) {
+				data.resolved[key] = value.map(index => blockInfoTable.links[index]);
+			}
+		}
+	}
+	return data;
+}
+
 function buildComment(content, lexer) {
 	// TODO: get comment format from Sphinx lexer automatically?
 	lexer = lexer.toLowerCase();
@@ -217,39 +441,111 @@ function createLineWrapper(element, className) {
 	return lineWrapper;
 }
 
-class LitRef extends HTMLElement {
+/**
+ * Base class of the elements rendered by the renderScheduler. The shadow DOM
+ * is only created on first render.
+ */
+class LazyElement extends HTMLElement {
 	constructor() {
 		super();
+		this.rendered = false;
+		this.stale = false;
+		this.nearViewport = false;
+	}
+
+	connectedCallback() {
+		renderScheduler.observe(this);
+	}
 
-		const shadow = this.attachShadow({ mode: "open" });
+	disconnectedCallback() {
+		renderScheduler.unobserve(this);
+	}
 
-		this.styleElement = document.createElement("style");
-		this.styleElement.textContent = commonStyle + litRefStyle;
+	optionChanged(key) {
+		renderScheduler.invalidate(this);
+	}
 
+	render() {
+		if (!this.rendered) {
+			// Set first, as moving the element in the DOM while rendering
+			// connects it again
+			this.rendered = true;
+			const shadow = this.attachShadow({ mode: "open" });
+			this.styleNodes = adoptSharedStyle(shadow, this.sharedStyle());
+		}
+		this.stale = false;
 		this.rebuildShadow();
+	}
+}
 
-		// Callbacks
-		document.addEventListener(options.changedEvent.type, (function() {
-			this.rebuildShadow();
-		}).bind(this));
+class LitRef extends LazyElement {
+	constructor() {
+		super();
+
+		// Value of showReferenceLinks that the shadow DOM was built for, or
+		// null if it was not built yet
+		this.renderedLinks = null;
 	}
 
-	rebuildShadow() {
+	sharedStyle() {
+		return litRefSharedStyle;
+	}
+
+	connectedCallback() {
+		connectedLitRefs.add(this);
+		if (this.getAttribute("hidden-link") === "true") {
+			connectedHiddenLitRefs.add(this);
+			// Hiding the line is cheap, so it is not deferred: this avoids
+			// showing hidden content and shifting the layout when rendering.
+			this.updateLineVisibility();
+		}
+		super.connectedCallback();
+	}
+
+	disconnectedCallback() {
+		connectedLitRefs.delete(this);
+		connectedHiddenLitRefs.delete(this);
+		super.disconnectedCallback();
+	}
+
+	optionChanged(key) {
+		// A line that is hidden or shown is out of the viewport either before
+		// or after the change, so its visibility is updated right away.
+		if (key === 'showHiddenLinks') {
+			this.updateLineVisibility();
+		}
+		super.optionChanged(key);
+	}
+
+	/**
+	 * Hide the line that contains a hidden link, unless hidden links are shown.
+	 * @return true if the line is hidden
+	 */
+	updateLineVisibility() {
 		const hidden = this.getAttribute("hidden-link") === "true" && !options.get('showHiddenLinks');
-		if (hidden) {
-			let lineWrapper = this.closest(".lit-line-wrapper");
-			if (lineWrapper === null) {
-				lineWrapper = createLineWrapper(this, "lit-line-wrapper");
-			}
-			lineWrapper.setAttribute("style", "display: none;");
-		} else {
-			let lineWrapper = this.closest(".lit-line-wrapper");
-			if (lineWrapper !== null) {
-				lineWrapper.setAttribute("style", "");
-			}
+		let lineWrapper = this.closest(".lit-line-wrapper");
+		if (hidden && lineWrapper === null) {
+			lineWrapper = createLineWrapper(this, "lit-line-wrapper");
+		}
+		if (lineWrapper !== null) {
+			lineWrapper.setAttribute("style", hidden ? "display: none;" : "");
+		}
+		return hidden;
+	}
+
+	rebuildShadow() {
+		if (this.updateLineVisibility()) {
+			// Not visible, the content is built when the line gets shown
+			return;
+		}
+
+		const showLinks = options.get('showReferenceLinks');
+		if (this.renderedLinks === showLinks) {
+			return;
 		}
+		this.renderedLinks = showLinks;
 
-		if (options.get('showReferenceLinks')) {
+		if (showLinks) {
 			const open = document.createTextNode(config.begin_ref);
 
 			const close = document.createTextNode(config.end_ref);
@@ -258,7 +554,7 @@ class LitRef extends HTMLElement {
 			link.textContent = this.getAttribute("name");
 			link.href = this.getAttribute("href");
 
-			this.shadowRoot.replaceChildren(this.styleElement, open, link, close);
+			this.shadowRoot.replaceChildren(...this.styleNodes, open, link, close);
 		} else {
 			const comment = document.createElement("a");
 			comment.setAttribute("class", "comment");
@@ -269,32 +565,33 @@ class LitRef extends HTMLElement {
 			}
 			comment.textContent = buildComment("[...] " + this.getAttribute("name"), lexer);
 
-			this.shadowRoot.replaceChildren(this.styleElement, comment);
+			this.shadowRoot.replaceChildren(...this.styleNodes, comment);
 		}
 	}
 }
 
 customElements.define("lit-ref", LitRef);
 
-class LitBlockInfo extends HTMLElement {
-	constructor() {
-		super();
-
-		this.attachShadow({ mode: "open" });
-
-		this.styleElement = document.createElement("style");
-		this.styleElement.textContent = commonStyle + litBlockInfoStyle;
+class LitBlockInfo extends LazyElement {
+	sharedStyle() {
+		return litBlockInfoSharedStyle;
+	}
 
-		this.rebuildShadow();
+	connectedCallback() {
+		connectedLitBlockInfos.add(this);
+		super.connectedCallback();
+	}
 
-		// Callbacks
-		document.addEventListener(options.changedEvent.type, (function() {
-			this.rebuildShadow();
-		}).bind(this));
+	disconnectedCallback() {
+		connectedLitBlockInfos.delete(this);
+		super.disconnectedCallback();
 	}
 
 	rebuildShadow() {
-		const data = JSON.parse(this.getAttribute("data"));
+		const data = getBlockInfo(this.getAttribute("data-uid"));
+		if (data === null) {
+			return;
+		}
 
 		const wrapper = document.createElement("div");
 		wrapper.setAttribute("class", "wrapper");
@@ -320,9 +617,10 @@ class LitBlockInfo extends HTMLElement {
 				'inserted in'
 			];
 			details.map(section => {
-				if (data[section].length > 0) {
+				const links = data.resolved[section];
+				if (links !== undefined && links.length > 0) {
 					info.append(document.createTextNode(" " + section + " "));
-					data[section].map(lit => {
+					links.map(lit => {
 						info.append(...this.createLitLink(lit.name, lit.url));
 						if (lit.details) {
 							info.append(document.createTextNode(" " + lit.details));
@@ -332,7 +630,7 @@ class LitBlockInfo extends HTMLElement {
 			});
 		}
 
-		this.shadowRoot.replaceChildren(this.styleElement, wrapper);
+		this.shadowRoot.replaceChildren(...this.styleNodes, wrapper);
 	}
 
 	createLitLink(name, url, className) {
@@ -400,8 +698,5 @@ function onDOMContentLoaded() {
 	}
 
 	document.body.setAttribute("data-lit-block-show-hidden", options.get("showHiddenBlocks"));
-	document.addEventListener(options.changedEvent.type, function() {
-		document.body.setAttribute("data-lit-block-show-hidden", options.get("showHiddenBlocks"));
-	});
 }
 document.addEventListener('DOMContentLoaded', onDOMContentLoaded, {once: true});
\ No newline at end of file
@@ -0,0 +1,107 @@
+from __future__ import annotations
+from typing import Dict, List, Set
+import re
+
+#############################################################
+
+class MultiPatternMatcher:
+    """
+    Find which of a fixed list of substrings occur in a text, in a single
+    pass over the text rather than one pass per pattern.
+
+    The patterns are organized in a trie that is compiled into a regular
+    expression, so that the automaton runs in the regex engine. The regex
+    finds, at each position of the text, the longest pattern that starts
+    there: every other pattern that starts at this position is one of its
+    prefixes, so we precompute for each pattern the patterns that prefix it.
+    """
+
+    def __init__(self, patterns: List[str]) -> None:
+        # Patterns in their original order, without duplicates
+        self.patterns: List[str] = list(dict.fromkeys(patterns))
+        self._order: Dict[str,int] = {
+            p: i for i, p in enumerate(self.patterns)
+        }
+
+        # The empty pattern is found in any text
+        self._always: Set[str] = {""} if "" in self._order else set()
+
+        trie = {}
+        for p in self.patterns:
+            if p:
+                node = trie
+                for c in p:
+                    node = node.setdefault(c, {})
+                node[None] = p
+
+        # For each pattern, the list of patterns that are prefixes of it
+        # (including itself)
+        self._prefixes: Dict[str,List[str]] = {}
+        for p in self.patterns:
+            node = trie
+            prefixes = []
+            for c in p:
+                node = node[c]
+                if None in node:
+                    prefixes.append(node[None])
+            self._prefixes[p] = prefixes
+
+        # The lookahead finds overlapping occurrences, but prevents the regex
+        # engine from quickly skipping to the possible first characters, so
+        # texts are first checked with the plain regex.
+        self._any_regex = None
+        self._regex = None
+        if trie:
+            trie_regex = self._trie_to_regex(trie)
+            self._any_regex = re.compile(trie_regex)
+            self._regex = re.compile("(?=(" + trie_regex + "))")
+
+    @classmethod
+    def _trie_to_regex(cls, node: Dict) -> str:
+        """
+        Build a regex that matches any of the patterns of a trie, preferring
+        the longest one.
+        """
+        # Merge chains of nodes that have a single child and no pattern
+        # ending there into one literal, to limit nesting.
+        prefix = ""
+        while len(node) == 1 and None not in node:
+            (c, node), = node.items()
+            prefix += c
+
+        branches = [
+            re.escape(c) + cls._trie_to_regex(child)
+            for c, child in node.items()
+            if c is not None
+        ]
+        if not branches:
+            return re.escape(prefix)
+        alternatives = "|".join(branches)
+        if None in node:
+            # A pattern ends here, but a longer one is tried first (greedy)
+            return re.escape(prefix) + "(?:" + alternatives + ")?"
+        if len(branches) == 1:
+            return re.escape(prefix) + alternatives
+        return re.escape(prefix) + "(?:" + alternatives + ")"
+
+    def find(self, text: str) -> Set[str]:
+        """
+        Return the set of patterns that occur in the text.
+        """
+        found = set(self._always)
+        if self._regex is not None:
+            first = self._any_regex.search(text)
+            if first is None:
+                return found
+            for m in self._regex.finditer(text, first.start()):
+                found.update(self._prefixes[m.group(1)])
+        return found
+
+    def find_ordered(self, text: str) -> List[str]:
+        """
+        Return the patterns that occur in the text, in their original order.
+        """
+        found = self.find(text)
+        if len(found) <= 1:
+            return list(found)
+        return sorted(found, key=self._order.__getitem__)
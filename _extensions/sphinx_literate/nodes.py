@@ -1,9 +1,12 @@
+from __future__ import annotations
 from docutils import nodes
 
+from typing import Dict, List
 import html
 import json
+import re
 
-from .registry import Key, CodeBlock, SourceLocation
+from .registry import CodeBlock, SourceLocation
 
 #############################################################
 
@@ -43,12 +46,73 @@ class LiterateHighlighter:
 
         highlighted = self._original_highlighter.highlight_block(rawsource, lang, **kwargs)
 
-        # Post-process: Replace hashes with links
-        for uid, (lit, options) in self.node.uid_to_lit.items():
-            ref = self.ref_factory(self.node, lit, options)
-            highlighted = highlighted.replace(uid, ref)
+        # Post-process: Replace hashes with links, all in a single pass
+        if not self.node.uid_to_lit:
+            return highlighted
+        refs = {
+            uid: self.ref_factory(self.node, lit, options)
+            for uid, (lit, options) in self.node.uid_to_lit.items()
+        }
+        pattern = re.compile("|".join(re.escape(uid) for uid in refs))
+        return pattern.sub(lambda m: refs[m.group(0)], highlighted)
 
-        return highlighted
+#############################################################
+
+class BlockInfoTable:
+    """
+    Metadata of the literate blocks of an HTML page (names and links that
+    lit-block-info elements display). It is emitted once per page as a JSON
+    script, in which elements look up their block by uid, rather than as an
+    escaped JSON attribute of each element. Links are stored once and
+    referred to by index, as the same blocks get linked from many others.
+    """
+
+    # Id of the script element that holds the table
+    element_id = "lit-block-data"
+
+    def __init__(self) -> None:
+        self.links: List[Dict] = []
+        self.blocks: Dict[str,Dict] = {}
+        self._link_indices: Dict[tuple,int] = {}
+
+    @classmethod
+    def of_page(cls, builder, docname: str) -> BlockInfoTable:
+        """
+        Return the table of the page being written for a given document,
+        creating it if needed.
+        """
+        if not hasattr(builder, 'lit_block_info_tables'):
+            builder.lit_block_info_tables = {}
+        table = builder.lit_block_info_tables.get(docname)
+        if table is None:
+            table = cls()
+            builder.lit_block_info_tables[docname] = table
+        return table
+
+    @classmethod
+    def pop_page(cls, builder, docname: str) -> BlockInfoTable | None:
+        """
+        Return the table of a page once it has been written, if any.
+        """
+        return getattr(builder, 'lit_block_info_tables', {}).pop(docname, None)
+
+    def add_link(self, name: str, url: str, details: str | None = None) -> int:
+        """
+        @return the index of the link in the table
+        """
+        key = (name, url, details)
+        index = self._link_indices.get(key)
+        if index is None:
+            index = len(self.links)
+            self.links.append({ 'name': name, 'url': url, 'details': details })
+            self._link_indices[key] = index
+        return index
+
+    def to_html(self) -> str:
+        data = json.dumps({ 'links': self.links, 'blocks': self.blocks }, separators=(',', ':'))
+        # Make sure that the content cannot end the script element early
+        data = data.replace('<', '\\u003c').replace('>', '\\u003e').replace('&', '\\u0026')
+        return f'<script type="application/json" id="{self.element_id}">{data}</script>\n'
 
 #############################################################
 
@@ -97,6 +161,10 @@ class LiterateNode(nodes.General, nodes.Element):
 
         inherited_html_visit, inherited_html_depart = literal_block_handlers.get('html', (None, None))
 
+        # The same block is typically referenced many times from the same
+        # document, so we cache the HTML of references
+        ref_cache = {}
+
         def create_ref(node, lit, options):
             """
             # TODO: Could this be a way to make that protable to all builders?
@@ -104,20 +172,28 @@ class LiterateNode(nodes.General, nodes.Element):
             refnode['refdocname'] = lit.docname
             refnode['refuri'] = (
                 app.builder.get_relative_uri(node.document['source'], lit.docname)
-                + '#' + lit.target['refid']
+                + '#' + lit.refid
             )
             refnode.append(nodes.Text(lit.name))
             """
-            url = lit.link_url(node.lit.source_location.docname, app.builder)
+            fromdocname = node.lit.source_location.docname
+            cache_key = (lit.uid, 'HIDDEN' in options, fromdocname)
+            ref = ref_cache.get(cache_key)
+            if ref is not None:
+                return ref
+
+            url = lit.link_url(fromdocname, app.builder)
             lexer = f'"{lit.lexer}"' if lit.lexer is not None else "null"
             hidden = "true" if 'HIDDEN' in options else "false"
-            return (
+            ref = (
                 f'<lit-ref name="{lit.name}" href="{url}" lexer={lexer} hidden-link="{hidden}">' +
                     app.config.lit_begin_ref +
                         f'<a href="{url}">{lit.name}</a>' +
                     app.config.lit_end_ref +
                 '</lit-ref>'
             )
+            ref_cache[cache_key] = ref
+            return ref
 
         def visit_html(self, node):
             # Override highlighter
@@ -142,27 +218,17 @@ class LiterateNode(nodes.General, nodes.Element):
             self.highlighter = original_highlighter
 
             docname = node.lit.source_location.docname
+            table = BlockInfoTable.of_page(self.builder, self.builder.current_docname)
 
             def make_link_metadata(lit, details = None):
-                return {
-                    'name': lit.name,
-                    'url': lit.link_url(docname, self.builder),
-                    'details': details,
-                }
+                return table.add_link(lit.name, lit.link_url(docname, self.builder), details)
 
+            # Sections that list links to other blocks are only present when
+            # they are not empty
             metadata = {
                 'name': node.lit.name,
-                'permalink': "#" + node.lit.target['refid'],
+                'permalink': "#" + node.lit.refid,
                 'hidden': node.lit.hidden,
-                'replaced by': [],
-                'completed in': [],
-                'prepended in': [],
-                'patched by': [],
-                'replacing': [],
-                'completing': [],
-                'prepending': [],
-                'inserted in': [],
-                'referenced in': [],
             }
 
             if node.lit.prev is not None:
@@ -186,7 +252,7 @@ class LiterateNode(nodes.General, nodes.Element):
                     if prev is None:
                         print(f"ERROR: modifier.key = {modifier.key}, lit<{hex(id(node.lit))}>.key = {node.lit.key}")
                     assert(prev is not None)
-                metadata[section].append(
+                metadata.setdefault(section, []).append(
                     make_link_metadata(prev, details)
                 )
 
@@ -198,19 +264,19 @@ class LiterateNode(nodes.General, nodes.Element):
                     'INSERT': 'patched by',
                     'INSERTED': None, # not happening
                 }[node.lit.next.relation_to_prev]
-                metadata[section].append(
+                metadata.setdefault(section, []).append(
                     make_link_metadata(node.lit.next)
                 )
 
             for ref in node.references:
                 assert(ref is not None)
-                metadata['referenced in'].append(
+                metadata.setdefault('referenced in', []).append(
                     make_link_metadata(ref)
                 )
 
-            encoded_metadata = html.escape(json.dumps(metadata))
+            table.blocks[node.lit.uid] = metadata
             self.body.append(
-                f'<lit-block-info data="{encoded_metadata}"></lit-block-info>'
+                f'<lit-block-info data-uid="{html.escape(node.lit.uid)}"></lit-block-info>'
             )
 
             if skip:
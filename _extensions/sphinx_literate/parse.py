@@ -1,10 +1,10 @@
-from typing import List, Dict, Set, Tuple
+from typing import List, Dict, NamedTuple, Set, Tuple
 from dataclasses import dataclass, field
 from pathlib import Path
-import random
+import hashlib
 import re
 
-from .registry import CodeBlock, Key, BlockOptions
+from .registry import BlockKey, BlockOptions, SourceLocation
 
 from sphinx.errors import ExtensionError
 
@@ -79,68 +79,52 @@ def parse_option(raw_option: str) -> str|Tuple[str]:
     else:
         return raw_option.upper()
 
+# Pieces of an option list: a run of plain characters, a comma that separates
+# options, or a double-quoted string, in which a backslash escapes the next
+# character. A string that is not closed extends to the end of the list.
+_option_piece_regex = re.compile(r'[^",]+|,|"(?:[^"\\]|\\.)*(?:"|\\?\Z)', re.DOTALL)
+
+_string_escape_regex = re.compile(r'\\(.?)', re.DOTALL)
+
+def tokenize_block_title_options(raw_options: str) -> List[str]:
+    """
+    Split the content of the parenthesis of a title into options, at commas
+    that are not within a string.
+    """
+    if '"' not in raw_options:
+        return raw_options.split(',')
+
+    all_tokens = []
+    token = []
+    for m in _option_piece_regex.finditer(raw_options):
+        piece = m.group()
+        if piece == ',':
+            all_tokens.append("".join(token))
+            token = []
+        elif piece[0] == '"':
+            token.append(_string_escape_regex.sub(r'\1', piece))
+        else:
+            token.append(piece)
+    all_tokens.append("".join(token))
+    return all_tokens
+
 def parse_block_title_options(raw_options: str) -> List[str|Tuple[str]]:
     if raw_options is None:
         return set()
-    raw_options = raw_options[1:-1]
-
-    # Parsing automata, possible states:
-    (
-        DEFAULT,
-        IN_STRING,
-        IN_STRING_ESCAPE,
-    ) = range(3)
-    # Possible actions:
-    (
-        ACCUMULATE,
-        NEW_TOKEN,
-        IGNORE,
-    ) = range(3)
-    transitions = {
-        DEFAULT: {
-            '"': (IN_STRING, ACCUMULATE),
-            ',': (DEFAULT, NEW_TOKEN),
-            ...: (DEFAULT, ACCUMULATE),
-        },
-        IN_STRING: {
-            '\\': (IN_STRING_ESCAPE, IGNORE),
-            '"': (DEFAULT, ACCUMULATE),
-            ...: (IN_STRING, ACCUMULATE),
-        },
-        IN_STRING_ESCAPE: {
-            ...: (IN_STRING, ACCUMULATE),
-        },
-    }
-    cursor = 0
-    state = DEFAULT
-    token = ""
-    all_tokens = []
-    while cursor < len(raw_options):
-        char = raw_options[cursor]
-        cursor += 1
-        tr = transitions[state]
-        state, action = tr.get(char, tr[...])
-        if action == NEW_TOKEN:
-            all_tokens.append(token)
-            token = ""
-        elif action == ACCUMULATE:
-            token += char
-        elif action == IGNORE:
-            pass
-    all_tokens.append(token)
-
     return [
         parse_option(opt)
-        for opt in all_tokens
+        for opt in tokenize_block_title_options(raw_options[1:-1])
     ]
 
+_title_regex = re.compile(r"^((?P<lexer>[^(,]*),)?(?P<name>[^(,]*)(?P<options>\(.*\))?$")
+
 def parse_block_title(raw_title: str) -> ParsedBlockTitle:
     """
     This parse a literate code block title (@see ParsedBlockTitle)
     @param raw_title title as returned by Directive.arguments[0]
     @return a parsed title object
     """
-    m = re.match(r"^((?P<lexer>[^(,]*),)?(?P<name>[^(,]*)(?P<options>\(.*\))?$", raw_title.strip())
+    m = _title_regex.match(raw_title.strip())
 
     if m is None:
         message = (
@@ -174,12 +158,26 @@ class BlockLink:
     Link to a literate block
     """
 
-    # Name of the referenced block
-    key: Key = ""
+    # Key of the referenced block
+    key: BlockKey = BlockKey("", "")
 
     # Possible options are 'HIDDEN'
     options: Set[str] = field(default_factory=list)
 
+class ReferenceSlot(NamedTuple):
+    """
+    A line of a block that holds a reference. When tangling, the line is
+    replaced by the lines of the referenced block, each one prefixed by the
+    text that precedes the reference (anything after the reference is
+    ignored).
+    """
+
+    # Text that precedes the reference in the line
+    prefix: str
+
+    # The reference itself
+    link: BlockLink
+
 @dataclass
 class ParsedBlockContent:
     """
@@ -195,15 +193,42 @@ class ParsedBlockContent:
     # literate code blocks.
     uid_to_block_link: Dict[Uid,BlockLink]
 
+    # References of the original lines, as used when tangling
+    # (see parse_reference_slots())
+    reference_slots: Tuple[ReferenceSlot|None, ...] = ()
+
 #############################################################
 
-def generate_uid() -> Uid:
-    return "_" + "".join([random.choice("abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789") for _ in range(32)])
+def generate_uid_prefix(seed: str) -> str:
+    """
+    Derive the first part of the uids of a block from a string that
+    identifies the block, so that uids are the same from one build to
+    another.
+    """
+    return "_" + hashlib.blake2b(seed.encode(), digest_size=12).hexdigest()
+
+def generate_uid(prefix: str, index: int) -> Uid:
+    """
+    Uids look like identifiers so that syntax highlighters keep them in a
+    single token.
+    @param prefix obtained from generate_uid_prefix()
+    @param index index of the reference within the block
+    """
+    return f"{prefix}{index:08x}"
 
 #############################################################
 
+_link_regex = re.compile(r"(?P<name>[^(,]*)(?P<options>\(.*\))?")
+
 def parse_block_link(content: str, tangle_root: str | None) -> BlockLink:
-    m = re.match(r"(?P<name>[^(,]*)(?P<options>\(.*\))?", content)
+    if '(' not in content and ',' not in content:
+        # Most links have no option
+        return BlockLink(
+            key = BlockKey.make(content.strip(), tangle_root),
+            options = set(),
+        )
+
+    m = _link_regex.match(content)
 
     if m is None:
         message = f"Invalid block link: '{content}'"
@@ -221,11 +246,41 @@ def parse_block_link(content: str, tangle_root: str | None) -> BlockLink:
         }
 
     return BlockLink(
-        key = CodeBlock.build_key(name, tangle_root),
+        key = BlockKey.make(name, tangle_root),
         options = options,
     )
 
-def parse_block_content(content: List[str], tangle_root: str | None, config) -> ParsedBlockContent:
+def parse_reference_slots(content: List[str], tangle_root: str | None, begin_ref: str, end_ref: str, links: Dict[str,BlockLink] | None = None) -> Tuple[ReferenceSlot|None, ...]:
+    """
+    Parse the reference that each line of a block holds, if any. Only the
+    first reference of a line is taken into account.
+    @param links optional cache of already parsed links, indexed by their
+                 raw content, that gets updated with new links
+    @return a tuple that has one element per line, either None or the
+            reference slot of the line, or an empty tuple when no line holds
+            a reference.
+    """
+    if links is None:
+        links = {}
+    slots = None
+    for i, line in enumerate(content):
+        begin_offset = line.find(begin_ref)
+        if begin_offset == -1:
+            continue
+        end_offset = line.find(end_ref, begin_offset)
+        if end_offset == -1:
+            continue
+        raw_link = line[begin_offset+len(begin_ref):end_offset]
+        link = links.get(raw_link)
+        if link is None:
+            link = parse_block_link(raw_link, tangle_root)
+            links[raw_link] = link
+        if slots is None:
+            slots = [None] * len(content)
+        slots[i] = ReferenceSlot(line[:begin_offset], link)
+    return tuple(slots) if slots is not None else ()
+
+def parse_block_content(content: List[str], tangle_root: str | None, config, source_location: SourceLocation | None = None) -> ParsedBlockContent:
     """
     This reads the raw source code and extracts {{references}} to other blocks,
     not to disturb the syntax highlighter.
@@ -235,6 +290,8 @@ def parse_block_content(content: List[str], tangle_root: str | None, config) ->
     @param content original source code with literate references
     @param tangle_root context of the block
     @param config sphinx config
+    @param source_location where the block is defined, used to derive uids
+                           (the content is used instead if not provided)
     @return a parsed block object
     """
     parsed = ParsedBlockContent(
@@ -244,9 +301,16 @@ def parse_block_content(content: List[str], tangle_root: str | None, config) ->
 
     raw_source = '\n'.join(content)
 
+    if source_location is not None:
+        seed = f"{source_location.docname}\n{source_location.lineno}\n{tangle_root}"
+    else:
+        seed = f"{raw_source}\n{tangle_root}"
+    uid_prefix = None
+
     begin_ref = config.lit_begin_ref
     end_ref = config.lit_end_ref
 
+    links = {}
     offset = 0
     parsed_source = ""
     while True:
@@ -257,9 +321,15 @@ def parse_block_content(content: List[str], tangle_root: str | None, config) ->
         if end_offset == -1:
             print(f"Warning: Found a reference openning '{begin_ref}' but reached end of block before finding the reference closing '{end_ref}'")
             break
-        uid = generate_uid()
+        if uid_prefix is None:
+            uid_prefix = generate_uid_prefix(seed)
+        uid = generate_uid(uid_prefix, len(parsed.uid_to_block_link))
         block_name = raw_source[begin_offset+len(begin_ref):end_offset]
-        parsed.uid_to_block_link[uid] = parse_block_link(block_name, tangle_root)
+        link = links.get(block_name)
+        if link is None:
+            link = parse_block_link(block_name, tangle_root)
+            links[block_name] = link
+        parsed.uid_to_block_link[uid] = link
         parsed_source += raw_source[offset:begin_offset]
         parsed_source += uid
         offset = end_offset + len(end_ref)
@@ -268,6 +338,9 @@ def parse_block_content(content: List[str], tangle_root: str | None, config) ->
 
     parsed.content = parsed_source.split('\n')
 
+    # Links are shared with the uid map, so each one is parsed only once
+    parsed.reference_slots = parse_reference_slots(content, tangle_root, begin_ref, end_ref, links)
+
     return parsed
 
 #############################################################
@@ -1,21 +1,73 @@
 from __future__ import annotations
-from typing import Any, Dict, Set, Tuple
-from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, List, NamedTuple, Set, Tuple, TYPE_CHECKING
+from dataclasses import dataclass, field, fields
 from collections import defaultdict
 from pathlib import Path
-import random
+import itertools
+import sys
 
 from sphinx.errors import ExtensionError
 
+from .matcher import MultiPatternMatcher
+
+if TYPE_CHECKING:
+    # Not imported at runtime, as the parse module depends on this one
+    from .parse import ReferenceSlot
+
 #############################################################
 
 BlockOptions = Set[str|Tuple[str]]
 
-Key = str
+class BlockKey(NamedTuple):
+    """
+    Identifies the chain of blocks that share a name within a tangle root.
+    Build it with BlockKey.make() rather than directly, so that equal keys
+    are shared.
+    """
+
+    # Tangle root of the block, "" for the default root
+    tangle_root: str
+
+    # Name of the block
+    name: str
+
+    @classmethod
+    def make(cls, name: str, tangle_root: str | None = None) -> BlockKey:
+        # A plain tuple compares equal to the key, no need to build one to
+        # find out that it already exists.
+        root_and_name = (tangle_root or "", name)
+        key = _interned_keys.get(root_and_name)
+        if key is None:
+            key = cls(*root_and_name)
+            _interned_keys[key] = key
+        return key
+
+    def __reduce__(self):
+        # Keys loaded from a pickled environment are shared again
+        return (BlockKey.make, (self.name, self.tangle_root))
+
+    @staticmethod
+    def forget_interned_keys(keep: Iterable[BlockKey] = ()) -> None:
+        """
+        Clear the table of shared keys, except for the given keys (typically
+        the ones still used by the registry), so that a long running process
+        does not keep every key it ever created.
+        """
+        kept = { key: key for key in keep }
+        _interned_keys.clear()
+        _interned_keys.update(kept)
+
+    def format(self):
+        maybe_root = ''
+        if self.tangle_root:
+            maybe_root = f" (in root '{self.tangle_root}')"
+        return f"'{self.name}'{maybe_root}"
+
+_interned_keys: Dict[BlockKey,BlockKey] = {}
 
 #############################################################
 
-@dataclass
+@dataclass(slots=True)
 class SourceLocation:
     """
     Represents a location in the documentation's source
@@ -27,12 +79,20 @@ class SourceLocation:
     # Line number at which the block was defined in the source document
     lineno: int = -1
 
+    def __post_init__(self):
+        # Many blocks come from the same document, share the name
+        self.docname = sys.intern(self.docname)
+
+    def __reduce__(self):
+        # Go through __post_init__ when loading a pickled environment
+        return (SourceLocation, (self.docname, self.lineno))
+
     def format(self):
         return f"document '{self.docname}', line {self.lineno}"
 
 #############################################################
 
-@dataclass
+@dataclass(slots=True)
 class InsertLocation:
     # Either 'BEFORE' or 'AFTER'
     placement: str
@@ -40,10 +100,96 @@ class InsertLocation:
     # Substring used to detect the line before/after which inserting
     pattern: str
 
+#############################################################
+# Codeblock chain
+
+@dataclass(slots=True)
+class CodeBlockChain:
+    """
+    Shared by all the blocks of a chain (i.e., blocks linked through their
+    `next` member), so that appending to the chain and evaluating its content
+    do not require walking it.
+    """
+
+    # First and last blocks of the chain
+    head: CodeBlock
+
+    tail: CodeBlock
+
+    # Last block of the chain whose relation_to_prev is 'REPLACE', if any
+    last_replace: CodeBlock | None = None
+
+    # Last block of the chain whose relation_to_prev is 'PREPEND', if any
+    last_prepend: CodeBlock | None = None
+
+    # Blocks of the chain whose relation_to_prev is 'INSERT', in chain order
+    inserts: List[CodeBlock] = field(default_factory=list)
+
+    # Matchers for the patterns of INSERT blocks, indexed by the child index
+    # of the block from which the content is evaluated and by placement.
+    # See insert_matcher().
+    matchers: Dict[Tuple[int,str],MultiPatternMatcher] = field(default_factory=dict, repr=False, compare=False)
+
+    def __getstate__(self):
+        # Matchers are rebuilt on demand, no need to pickle them with the env
+        # (this is the (dict state, slots state) pair expected by pickle)
+        state = { f.name: getattr(self, f.name) for f in fields(self) }
+        state['matchers'] = {}
+        return None, state
+
+    @classmethod
+    def from_head(cls, head: CodeBlock) -> CodeBlockChain:
+        """
+        Create the chain object of a chain that does not have one yet.
+        """
+        chain = cls(head=head, tail=head)
+        lit = head
+        while lit is not None:
+            chain.track(lit)
+            lit = lit.next
+        return chain
+
+    def track(self, lit: CodeBlock) -> None:
+        """
+        Register a block that is now part of this chain (after all others).
+        """
+        lit.chain = self
+        self.tail = lit
+        if lit.relation_to_prev == 'REPLACE':
+            self.last_replace = lit
+        elif lit.relation_to_prev == 'PREPEND':
+            self.last_prepend = lit
+        elif lit.relation_to_prev == 'INSERT':
+            self.inserts.append(lit)
+            self.matchers.clear()
+
+    def insert_matcher(self, start: CodeBlock, placement: str, patterns: List[str]) -> MultiPatternMatcher:
+        """
+        Return the matcher for the patterns of the INSERT blocks that come
+        after `start` in the chain and have the given placement, building it
+        only the first time.
+        """
+        key = (start.child_index, placement)
+        matcher = self.matchers.get(key)
+        if matcher is None:
+            matcher = MultiPatternMatcher(patterns)
+            self.matchers[key] = matcher
+        return matcher
+
+def _is_read_after(a: CodeBlock, b: CodeBlock) -> bool:
+    """
+    Tell whether block `a` comes after block `b` in reading order. Blocks
+    whose document is unknown are not ordered.
+    """
+    loc_a, loc_b = a.source_location, b.source_location
+    if not loc_a.docname or not loc_b.docname:
+        return False
+    return (loc_a.docname, loc_a.lineno) > (loc_b.docname, loc_b.lineno)
+
 #############################################################
 # Codeblock
 
-@dataclass
+@dataclass(slots=True)
 class CodeBlock:
     """
     Data store about a code block parsed from a {lit} directive, to be
@@ -62,11 +208,16 @@ class CodeBlock:
     # Tangle root as defined by lit-setup at the time the block was created
     tangle_root: str | None = None
 
-    # A list of lines
-    content: List[str] = field(default_factory=list)
+    # A tuple of lines
+    content: Tuple[str, ...] = ()
+
+    # For each line of content, the reference to another block that it holds,
+    # if any, as returned by parse.parse_reference_slots(). This is empty when
+    # no line holds a reference, and None when not parsed yet.
+    reference_slots: Tuple[ReferenceSlot|None, ...] | None = field(default=None, repr=False, compare=False)
 
-    # Target anchor for referencing this code block in internal links
-    target: Any = None
+    # Id of the target anchor for referencing this code block in internal links
+    refid: str | None = None
 
     lexer: str | None = None
 
@@ -108,23 +259,39 @@ class CodeBlock:
     # Hide by default in HTML
     hidden: bool = False
 
-    @classmethod
-    def build_key(cls, name: str, tangle_root: str | None = None) -> Key:
-        if tangle_root is None:
-            tangle_root = ""
-        return tangle_root + "##" + name
+    # Chain this block belongs to, created on demand by get_chain()
+    chain: CodeBlockChain | None = field(default=None, repr=False, compare=False)
+
+    # Cached value of the 'key' property
+    _key: BlockKey | None = field(default=None, init=False, repr=False, compare=False)
+
+    def __post_init__(self):
+        # Directives provide a StringList, which carries per-line source info
+        # that we do not need to keep in the environment.
+        if type(self.content) is not tuple:
+            self.content = tuple(self.content)
 
     @property
-    def key(self) -> Key:
-        return self.build_key(self.name, self.tangle_root)
+    def key(self) -> BlockKey:
+        if self._key is None:
+            self._key = BlockKey.make(self.name, self.tangle_root)
+        return self._key
+
+    def get_chain(self) -> CodeBlockChain:
+        """
+        Return the chain this block belongs to. A block that was never added
+        to another one is the head of its own chain.
+        """
+        if self.chain is None:
+            self.chain = CodeBlockChain.from_head(self)
+        return self.chain
 
     def add_block(self, lit: CodeBlock) -> None:
         """
         Add a block at the end of the chained list
         """
-        last = self
-        while last.next is not None:
-            last = last.next
+        chain = self.get_chain()
+        last = chain.tail
         last.next = lit
         lit.prev = last
 
@@ -133,9 +300,10 @@ class CodeBlock:
         while lit is not None:
             lit.child_index = child_index
             child_index += 1
+            chain.track(lit)
             lit = lit.next
 
-    def all_content(self, registry: CodeBlockRegistry, tangle_root: str | None = None):
+    def all_content(self, registry: CodeBlockRegistry, tangle_root: str | None = None, visited: List[CodeBlock] | None = None):
         """
         Iterate on all lines of content, including children, and overridden
         parent.
@@ -145,19 +313,121 @@ class CodeBlock:
                            inheritance and the content of the block is
                            different if referencing inserted blocks that are
                            redefined in children.
+        @param visited optional list to which all the blocks that the content
+                       depends on are appended (may contain duplicates).
         """
-        debug = []  # collect all yielded values for error message
-        debug.append(f"%% Getting content of block {self.format()} from {self.source_location.format()}")
-        if tangle_root is None:
-            tangle_root = self.tangle_root
+        return (
+            lit.content[i]
+            for lit, i in self._all_content(registry, tangle_root, visited)
+        )
+
+    def all_content_origins(self, registry: CodeBlockRegistry, tangle_root: str | None = None, visited: List[CodeBlock] | None = None):
+        """
+        Same as all_content(), but instead of the lines, iterate on the pairs
+        (block, index) such that each line is block.content[index]. This
+        tells in particular which reference slot applies to each line.
+        """
+        return self._all_content(registry, tangle_root, visited)
 
-        # Find the last REPLACE of the chain
-        start = self
-        lit = start
+    def _content_start(self) -> CodeBlock:
+        """
+        Return the block of the chain from which content is evaluated, i.e.,
+        the last REPLACE of the chain if it comes after self.
+        """
+        # Child indices increase along the chain, so this tells whether the
+        # last REPLACE comes after self
+        chain = self.get_chain()
+        if chain.last_replace is not None and chain.last_replace.child_index > self.child_index:
+            return chain.last_replace
+        return self
+
+    def _chain_origins(self):
+        """
+        Iterate on the origins of the lines of the chain from this block on,
+        without considering INSERT nodes nor parent tangle roots.
+        """
+        ordered = []
+        lit = self
         while lit is not None:
-            if lit.relation_to_prev == 'REPLACE':
-                start = lit
+            if lit.relation_to_prev == 'PREPEND':
+                ordered.insert(0, lit)
+            else:
+                ordered.append(lit)
             lit = lit.next
+        for lit in ordered:
+            for i in range(len(lit.content)):
+                yield (lit, i)
+
+    def _all_content(self, registry: CodeBlockRegistry, tangle_root: str | None, visited: List[CodeBlock] | None, trace: List[str] | None = None):
+        """
+        Implementation of all_content(), yielding line origins.
+        @param trace if not None, all yielded lines are also appended to this
+                     list, together with debug information ("%% ..." lines)
+                     about where they come from. This is only used to build
+                     error messages, in which case unmatched INSERT patterns
+                     are not reported again.
+        """
+        if trace is not None:
+            return self._all_content_with_inserts(registry, tangle_root, visited, trace)
+        if tangle_root is None:
+            tangle_root = self.tangle_root
+
+        # Content inherited from parent tangle roots is evaluated first (or
+        # last for PREPEND). As long as the chains of these roots have no
+        # INSERT node, which would need to see the lines of their parent, we
+        # walk them in a loop rather than by recursion, so that long chains
+        # of inherited tangle roots do not hit the recursion limit.
+        before = []
+        after = []
+        lit = self
+        while True:
+            start = lit._content_start()
+            if any(n.child_index >= start.child_index for n in lit.get_chain().inserts):
+                middle = lit._all_content_with_inserts(registry, tangle_root, visited, None)
+                break
+
+            if visited is not None:
+                b = lit
+                while b is not None:
+                    visited.append(b)
+                    b = b.next
+
+            if start.prev is not None and start.relation_to_prev in {'APPEND', 'INSERT'}:
+                assert(start.prev.tangle_root != start.tangle_root)
+                after.append(start)
+                lit = start.prev
+            elif start.prev is not None and start.relation_to_prev == 'PREPEND':
+                assert(start.prev.tangle_root != start.tangle_root)
+                before.append(start)
+                lit = start.prev
+            else:
+                middle = start._chain_origins()
+                break
+
+        return itertools.chain(
+            itertools.chain.from_iterable(start._chain_origins() for start in before),
+            middle,
+            itertools.chain.from_iterable(start._chain_origins() for start in reversed(after)),
+        )
+
+    def _all_content_with_inserts(self, registry: CodeBlockRegistry, tangle_root: str | None, visited: List[CodeBlock] | None, trace: List[str] | None):
+        """
+        Implementation of _all_content() for blocks that have INSERT nodes in
+        their chain (or when tracing).
+        """
+        if trace is not None:
+            trace.append(f"%% Getting content of block {self.format()} from {self.source_location.format()}")
+        if tangle_root is None:
+            tangle_root = self.tangle_root
+
+        if visited is not None:
+            lit = self
+            while lit is not None:
+                visited.append(lit)
+                lit = lit.next
+
+        chain = self.get_chain()
+        start = self._content_start()
 
         # Consolidate all INSERT nodes downstream of the last REPLACE
         # Then create the maybeInsert function to handle them
@@ -165,105 +435,139 @@ class CodeBlock:
             'BEFORE': defaultdict(list), # pattern: nodes
             'AFTER': defaultdict(list), # pattern: nodes
         }
-        lit = start
-        while lit is not None:
-            if lit.relation_to_prev == 'INSERT':
+        for lit in chain.inserts:
+            if lit.child_index >= start.child_index:
                 assert(not lit.content)
                 loc = lit.inserted_location
                 insert_nodes[loc.placement][loc.pattern].append(lit)
-            lit = lit.next
+
+        # Look for all patterns at once in each line
+        matchers = {
+            placement: chain.insert_matcher(start, placement, list(node_dict.keys()))
+            for placement, node_dict in insert_nodes.items()
+            if node_dict
+        }
 
         def _maybeInsertAux(l, placement):
+            pending = insert_nodes[placement]
+            if not pending:
+                return
             matched = []
-            for pattern, nodes in insert_nodes[placement].items():
-                if pattern in l:
-                    for n in nodes:
-                        inserted_block = n.inserted_block
-                        if registry is not None:
-                            inserted_block = registry.get_rec_by_key(n.inserted_block.key, override_tangle_root=tangle_root)
-                        for ll in inserted_block.all_content(registry, tangle_root):
-                            yield ll
-                    matched.append(pattern)
+            for pattern in matchers[placement].find_ordered(l[0].content[l[1]]):
+                nodes = pending.get(pattern)
+                if nodes is None:
+                    continue  # already consumed
+                for n in nodes:
+                    inserted_block = n.inserted_block
+                    if registry is not None:
+                        inserted_block = registry.get_rec_by_key(n.inserted_block.key, override_tangle_root=tangle_root)
+                    yield from inserted_block._all_content(registry, tangle_root, visited)
+                matched.append(pattern)
             for pattern in matched:
-                del insert_nodes[placement][pattern]
+                del pending[pattern]
 
+        # Content lines are yielded as (origin, False), and debug information
+        # as (line, True), only if traced
         def maybeInsert(l):
             first = True
             for ll in _maybeInsertAux(l, 'BEFORE'):
-                if first:
-                    yield (f"%% Start inserting before", True)
-                    first = False
+                if first and trace is not None:
+                    yield ("%% Start inserting before", True)
+                first = False
                 yield (ll, False)
-            if not first:
-                yield (f"%% End inserting before", True)
+            if not first and trace is not None:
+                yield ("%% End inserting before", True)
 
             yield (l, False)
 
             first = True
             for ll in _maybeInsertAux(l, 'AFTER'):
-                if first:
-                    yield (f"%% Start inserting after", True)
-                    first = False
+                if first and trace is not None:
+                    yield ("%% Start inserting after", True)
+                first = False
                 yield (ll, False)
-            if not first:
-                yield (f"%% End inserting after", True)
+            if not first and trace is not None:
+                yield ("%% End inserting after", True)
 
-        # If no replace, maybe add source from the parent tangle
-        if start.prev is not None and start.relation_to_prev in {'APPEND', 'INSERT'}:
-            assert(start.prev.tangle_root != start.tangle_root)
-            debug.append("%% Start tangling parent content")
-            for l in start.prev.all_content(registry, tangle_root):
+        def parent_content(message):
+            if trace is not None:
+                trace.append(f"%% Start tangling parent content{message}")
+            for l in start.prev._all_content(registry, tangle_root, visited):
                 for ll, is_debug_info in maybeInsert(l):
-                    debug.append(ll)
+                    if trace is not None:
+                        trace.append(ll if is_debug_info else ll[0].content[ll[1]])
                     if not is_debug_info:
                         yield ll
-            debug.append("%% End tangling parent content")
+            if trace is not None:
+                trace.append(f"%% End tangling parent content{message}")
+
+        # If no replace, maybe add source from the parent tangle
+        if start.prev is not None and start.relation_to_prev in {'APPEND', 'INSERT'}:
+            assert(start.prev.tangle_root != start.tangle_root)
+            yield from parent_content("")
 
         # Content of the start and next blocks
-        lit = start
-        # (Because of PREPEND we can no longer "stream" the yields, we need to
-        # save everything in a list and yields lines afterwards.)
-        consolidated_content = []
-        test = False
-        while lit is not None:
-            chunk = []
-            chunk.append((f"%% Start tangling block {lit.format()} from {lit.source_location.format()}", True))
-            for l in lit.content:
-                for ll in maybeInsert(l):
-                    chunk.append(ll)
-            chunk.append((f"%% End tangling block {lit.format()} from {lit.source_location.format()}", True))
-            if lit.relation_to_prev == 'PREPEND':
-                consolidated_content.insert(0, chunk)
-            else:
-                consolidated_content.append(chunk)
-            assert(lit.next != lit)
-            lit = lit.next
+        def chunk_content(lit):
+            if trace is not None:
+                yield (f"%% Start tangling block {lit.format()} from {lit.source_location.format()}", True)
+            for i in range(len(lit.content)):
+                yield from maybeInsert((lit, i))
+            if trace is not None:
+                yield (f"%% End tangling block {lit.format()} from {lit.source_location.format()}", True)
+
+        def chain_from_start():
+            lit = start
+            while lit is not None:
+                yield lit
+                assert(lit.next != lit)
+                lit = lit.next
+
+        if chain.last_prepend is not None and chain.last_prepend.child_index >= start.child_index:
+            # Because of PREPEND we can no longer "stream" the yields, we need
+            # to save everything in a list and yields lines afterwards. (Lines
+            # must still be processed in chain order for INSERT patterns.)
+            consolidated_content = []
+            for lit in chain_from_start():
+                chunk = list(chunk_content(lit))
+                if lit.relation_to_prev == 'PREPEND':
+                    consolidated_content.insert(0, chunk)
+                else:
+                    consolidated_content.append(chunk)
+        else:
+            consolidated_content = (
+                chunk_content(lit)
+                for lit in chain_from_start()
+            )
 
         for chunk in consolidated_content:
             for ll, is_debug_info in chunk:
-                debug.append(ll)
+                if trace is not None:
+                    trace.append(ll if is_debug_info else ll[0].content[ll[1]])
                 if not is_debug_info:
                     yield ll
 
         # Add parent tangle afterwards if this block is prepended
-        debug.append(f"%% start.prev = {start.prev}, start.relation_to_prev = {start.relation_to_prev}")
+        if trace is not None:
+            trace.append(f"%% start.prev = {start.prev}, start.relation_to_prev = {start.relation_to_prev}")
         if start.prev is not None and start.relation_to_prev in {'PREPEND'}:
             assert(start.prev.tangle_root != start.tangle_root)
-            debug.append("%% Start tangling parent content after prepend")
-            for l in start.prev.all_content(registry, tangle_root):
-                for ll, is_debug_info in maybeInsert(l):
-                    debug.append(ll)
-                    if not is_debug_info:
-                        yield ll
-            debug.append("%% End tangling parent content after prepend")
+            yield from parent_content(" after prepend")
+
+        if trace is not None:
+            return
 
         for placement, node_dict in insert_nodes.items():
             for pattern, nodes in node_dict.items():
                 for n in nodes:
+                    # Evaluate the content again, this time keeping track of
+                    # where lines come from, to help fixing the pattern.
+                    debug = []
+                    for _ in self._all_content(registry, tangle_root, None, debug):
+                        pass
                     message = (
                         f"The block {n.inserted_block.format()} was supposed to be inserted {placement.lower()} "
                         + f"\"{pattern}\" in block {self.format()}, "
-                        + f"but no occurrence of this text was found."
+                        + "but no occurrence of this text was found."
                     )
                     message += "\nHint: Current bloc content:\n" + "\n".join(debug)
                     raise ExtensionError(message, modname="sphinx_literate")
@@ -282,12 +586,12 @@ class CodeBlock:
         """
         return (
             builder.get_relative_uri(fromdocname, self.source_location.docname)
-            + '#' + self.target['refid']
+            + '#' + self.refid
         )
 
 #############################################################
 
-@dataclass
+@dataclass(slots=True)
 class TangleHierarchyEntry:
     """
     Store options for each tangle root about the first lit-setup directive that
@@ -309,7 +613,7 @@ class TangleHierarchyEntry:
 
 #############################################################
 
-@dataclass
+@dataclass(slots=True)
 class MissingCodeBlock:
     """
     We allow missing blocks to enable parallel compilation. Missing
@@ -317,7 +621,7 @@ class MissingCodeBlock:
     parallel units.
     """
     # The key of the referee, that expected its 'prev' to exist
-    key: Key
+    key: BlockKey
     # The relation of the referee to the expected block
     relation_to_prev: str
 
@@ -340,24 +644,161 @@ class CodeBlockRegistry:
         # Literate code blocks that have been define, indexed by their key.
         # If blocks with the same key have been appended, they are accessed
         # using the `next` member of CodeBlock.
-        self._blocks: Dict[Key,CodeBlock] = {}
+        self._blocks: Dict[BlockKey,CodeBlock] = {}
 
         # Store an index of all the references to a block
-        # self._references[key] lists all blocks that reference key
-        self._references: Dict[Key,Set[Key]] = defaultdict(set)
+        # self._references[key] maps the keys of all blocks that reference key
+        # to the number of such references (a key may reference the same
+        # block from several documents, e.g., when it is appended to).
+        self._references: Dict[BlockKey,Dict[BlockKey,int]] = defaultdict(dict)
 
         # Holds the relationship between different tangle roots.
         # This maps a root to its parent
         self._hierarchy: Dict[str,TangleHierarchyEntry] = {}
 
+        # All the calls to set_tangle_parent() for each root (from different
+        # documents or lit-setup directives), from which _hierarchy is rebuilt
+        # when one of these documents gets removed.
+        self._hierarchy_declarations: Dict[str,List[TangleHierarchyEntry]] = defaultdict(list)
+
+        # Reverse of the hierarchy: maps a root to its direct children, in
+        # the order in which they were declared.
+        self._hierarchy_children: Dict[str,List[str]] = defaultdict(list)
+
+        # For each tangle root, its ancestors (starting with itself) mapped
+        # to their distance to the root. Filled lazily by _tangle_lineage()
+        # and invalidated by set_tangle_parent().
+        self._lineages: Dict[str,Dict[str,int]] = {}
+
+        # Tangle roots in which a block with a given name is defined, so that
+        # get_rec() only needs to look at these rather than walking up the
+        # whole hierarchy.
+        self._roots_by_name: Dict[str,Set[str|None]] = defaultdict(set)
+
+        # For each tangle root, the blocks that are visible from it (i.e.,
+        # what get_rec() returns) indexed by name, and the subset of these
+        # that are 'file:' blocks. Built for all roots at once on the first
+        # query (typically after finalize()) and cleared whenever the registry
+        # gets modified.
+        self._visible_by_root: Dict[str|None,Dict[str,CodeBlock]] = {}
+        self._visible_files_by_root: Dict[str|None,List[CodeBlock]] = {}
+
         # We allow missing blocks to enable parallel compilation. Missing
         # blocks are resolved when combining multiple registers comming from
         # parallel units.
         self._missing: List[MissingCodeBlock] = []
 
-    @classmethod
-    def create_uid(cls):
-        return ''.join([random.choice('123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ') for _ in range(16)])
+        # Index of all blocks (including non-head elements of the chains) by
+        # uid, so that get_by_uid() does not need to explore all chains.
+        self._blocks_by_uid: Dict[str,CodeBlock] = {}
+
+        # What each document added to the registry: blocks (including INSERT
+        # modifiers), references as (referencer, referencee) pairs and roots
+        # declared by lit-setup directives, so that removing a document does
+        # not need to explore the whole registry.
+        self._blocks_by_docname: Dict[str,List[CodeBlock]] = defaultdict(list)
+        self._references_by_docname: Dict[str,List[Tuple[BlockKey,BlockKey]]] = defaultdict(list)
+        self._roots_by_docname: Dict[str,Set[str]] = defaultdict(set)
+
+        # Keys whose chain lost its first block when removing a document, so
+        # that it now starts with a block appended to it from another document.
+        # The first block is expected to be registered again (when re-reading
+        # the document) before finalize().
+        self._orphaned_keys: Set[BlockKey] = set()
+
+        # Memoized tangled lines and their dependencies, indexed by (key,
+        # override tangle root). It is filled by the tangle module and cleared
+        # whenever the registry gets modified, see _invalidate_caches().
+        # A None value means that the block was tangled once but not memoized.
+        self.tangle_cache: Dict[Tuple[BlockKey,str|None],Tuple[List[str],Any]|None] = {}
+
+        # Registries coming from parallel reading workers, together with the
+        # documents they have read. They are merged all at once by finalize(),
+        # see schedule_merge().
+        self._pending_merges: List[Tuple[CodeBlockRegistry,Set[str]|None]] = []
+
+        # Set by finalize() once all documents have been read, after which the
+        # registry must no longer be modified until thaw() is called.
+        self._frozen = False
+
+    def __getstate__(self):
+        # Caches are rebuilt on demand, no need to pickle them with the env
+        state = self.__dict__.copy()
+        state['tangle_cache'] = {}
+        state['_visible_by_root'] = {}
+        state['_visible_files_by_root'] = {}
+        # Workers inherit the pending merges of the main process when they
+        # are forked, they must not send them back.
+        state['_pending_merges'] = []
+        return state
+
+    def _invalidate_caches(self) -> None:
+        """
+        Must be called by any method that modifies blocks or tangle roots.
+        """
+        self._check_not_frozen()
+        self.tangle_cache.clear()
+        self._visible_by_root.clear()
+        self._visible_files_by_root.clear()
+
+    def _check_not_frozen(self) -> None:
+        if self._frozen:
+            message = (
+                "The literate code block registry cannot be modified after it "
+                "has been finalized (i.e., once all documents have been read)."
+            )
+            raise ExtensionError(message, modname="sphinx_literate")
+
+    @property
+    def frozen(self) -> bool:
+        return self._frozen
+
+    def finalize(self) -> None:
+        """
+        Called once all documents have been read (and worker registries have
+        been merged): resolve missing blocks, check integrity and freeze the
+        registry, so that per-document handlers only have to read from it.
+        Does nothing if the registry is already frozen.
+        """
+        if self._frozen:
+            return
+        if self._pending_merges:
+            pending, self._pending_merges = self._pending_merges, []
+            # Workers finish in any order, but a block must be merged before
+            # the blocks that append to it from later documents. Sphinx reads
+            # documents in sorted order and gives each worker a contiguous
+            # range of them, so chunks are sorted by their first document.
+            pending.sort(key=lambda merge: min(merge[1]) if merge[1] else "")
+            self.merge_all(pending)
+        self.try_fixing_all_missing()
+        self.check_integrity()
+        self._orphaned_keys.clear()
+        self._frozen = True
+
+    def thaw(self) -> None:
+        """
+        Allow modifications again, typically before reading documents that
+        changed since the previous (incremental) build.
+        """
+        self._frozen = False
+        # Keys of blocks that were removed since the previous build are
+        # no longer needed.
+        BlockKey.forget_interned_keys(self._blocks.keys())
+
+    def create_uid(self, lit: CodeBlock) -> str:
+        """
+        Create an identifier for a new block from its location, so that it
+        remains the same from one build to another. Blocks defined at the same
+        location (e.g., for multiple tangle roots) get a counter suffix.
+        """
+        loc = lit.source_location
+        base = f"{loc.docname}:{loc.lineno}"
+        uid = base
+        counter = 0
+        while uid in self._blocks_by_uid:
+            counter += 1
+            uid = f"{base}:{counter}"
+        return uid
 
     def register_codeblock(self, lit: CodeBlock, options: BlockOptions = set()) -> None:
         """
@@ -379,8 +820,9 @@ class CodeBlockRegistry:
         @param lit block to register
         @param options the options
         """
+        self._check_not_frozen()
         assert(lit.uid is None)
-        lit.uid = self.create_uid()
+        lit.uid = self.create_uid(lit)
 
         opt_dict = {
             (x[0] if type(x) == tuple else x): x
@@ -404,7 +846,7 @@ class CodeBlockRegistry:
                 name = block_name,
                 tangle_root = lit.tangle_root,
                 source_location = lit.source_location,
-                target = lit.target,
+                refid = lit.refid,
                 lexer = lit.lexer,
             )
             modifier.inserted_location = InsertLocation(placement, pattern)
@@ -424,16 +866,20 @@ class CodeBlockRegistry:
         the same key, an error is raised.
         @param lit block to add
         """
-        if "##" in lit.name:
-            message = (
-                f"The sequence '##' is not allowed in a block name, " +
-                f"it is reserved to internal mechanisms.\n"
-            )
-            raise ExtensionError(message, modname="sphinx_literate")
-
         key = lit.key
         existing = self.get_by_key(key)
 
+        if existing is not None and key in self._orphaned_keys and self._is_orphan(existing):
+            # Blocks that were appended to a block of a document that has been
+            # removed since, and which is now read again
+            self._invalidate_caches()
+            self._orphaned_keys.discard(key)
+            self._missing = [m for m in self._missing if m.key != key]
+            self._set_chain_head(lit)
+            self._index_chain(lit)
+            lit.add_block(existing)
+            return
+
         if existing is not None:
             message = (
                 f"Multiple literate code blocks with the same name {lit.format()} were found:\n" +
@@ -443,7 +889,33 @@ class CodeBlockRegistry:
             raise ExtensionError(message, modname="sphinx_literate")
 
         assert(lit is not None)
-        self._blocks[key] = lit
+        self._invalidate_caches()
+        self._set_chain_head(lit)
+        self._index_chain(lit)
+
+    def _set_chain_head(self, lit: CodeBlock) -> None:
+        """
+        Register a block as the first element of the chain for its key.
+        """
+        self._blocks[lit.key] = lit
+        self._roots_by_name[lit.name].add(lit.tangle_root or None)
+
+    def _index_chain(self, lit: CodeBlock) -> None:
+        """
+        Add a block and the blocks chained after it to the uid and docname
+        indices.
+        """
+        while lit is not None:
+            if lit.uid is not None:
+                self._blocks_by_uid[lit.uid] = lit
+            self._blocks_by_docname[lit.source_location.docname].append(lit)
+            lit = lit.next
+
+    def _is_orphan(self, lit: CodeBlock) -> bool:
+        """
+        Tell whether a chain head modifies a block that is missing.
+        """
+        return lit.prev is None and lit.relation_to_prev not in {'NEW', 'INSERTED'}
 
     def _override_codeblock(self, lit: CodeBlock, relation_to_prev: str):
         """
@@ -451,6 +923,7 @@ class CodeBlockRegistry:
         @param args extra arguments precising the relation to previous block
         """
         lit.relation_to_prev = relation_to_prev
+        self._invalidate_caches()
 
         existing = self.get_rec(lit.name, lit.tangle_root)
 
@@ -462,51 +935,146 @@ class CodeBlockRegistry:
             # relation_to_prev is not NEW. This will be addressed when
             # resolving missings.
             assert(lit is not None)
-            self._blocks[lit.key] = lit
+            self._set_chain_head(lit)
             lit.prev = None
         elif existing.tangle_root != lit.tangle_root:
             assert(lit is not None)
-            self._blocks[lit.key] = lit
+            self._set_chain_head(lit)
             lit.prev = existing
         else:
-            existing.add_block(lit)
+            self._chain_block(existing, lit)
+
+        self._index_chain(lit)
 
-    def add_reference(self, referencer: Key, referencee: Key) -> None:
+    def _chain_block(self, head: CodeBlock, lit: CodeBlock) -> None:
+        """
+        Add a block to the chain that starts with `head`, after the blocks
+        of the documents that Sphinx reads before its own (i.e., in sorted
+        order) rather than simply at the end, so that a document that is read
+        again in an incremental build, or merged from a parallel worker, ends
+        up where a clean build would put it.
+        """
+        chain = head.get_chain()
+        after = chain.tail
+        while after is not head and _is_read_after(after, lit):
+            after = after.prev
+
+        if after is chain.tail:
+            head.add_block(lit)
+            return
+
+        blocks = []
+        node = head
+        while node is not None:
+            blocks.append(node)
+            if node is after:
+                blocks.append(lit)
+            node = node.next
+        self._relink_chain(lit.key, blocks)
+
+    def add_reference(self, referencer: BlockKey, referencee: BlockKey, docname: str = "") -> None:
         """
         Signal that `referencer` contains a reference to `referencee`
+        @param docname document that defines the referencing block
         """
-        self._references[referencee].add(referencer)
+        self._check_not_frozen()
+        refs = self._references[referencee]
+        refs[referencer] = refs.get(referencer, 0) + 1
+        self._references_by_docname[docname].append((referencer, referencee))
 
-    def merge(self, other: CodeBlockRegistry) -> None:
+    def merge(self, other: CodeBlockRegistry, docnames: Iterable[str] | None = None) -> None:
         """
         Merge another registry into this one. This one comes from a document
         defined before the other one (matters when resolving missing blocks).
         The other registry must no longer be used after this.
+        @param other registry to merge into this one
+        @param docnames if not None, only merge blocks defined in these docs
         """
-        # Merge tangle hierarchies
-        for h in other._hierarchy.values():
-            self.set_tangle_parent(h.root, h.parent, h.source_location, h.fetch_files)
+        self.merge_all([(other, docnames)])
 
-        # Merge blocks
-        for lit in other.blocks():
-            if lit.relation_to_prev in {'NEW', 'INSERTED'}:
-                self._add_codeblock(lit)
-            else:
-                self._override_codeblock(lit, lit.relation_to_prev)
-            self.check_integrity(allow_missing=True)
+    def schedule_merge(self, other: CodeBlockRegistry, docnames: Iterable[str] | None = None) -> None:
+        """
+        Same as merge(), but delay the actual merge until finalize() so that
+        registries coming from all parallel workers get merged in one batch,
+        in document order rather than in the order workers finish.
+        """
+        self._check_not_frozen()
+        self._pending_merges.append(
+            (other, set(docnames) if docnames is not None else None)
+        )
 
-        # Merge cross-references
-        for key, refs in other._references.items():
-            self._references[key].update(refs)
+    def merge_all(self, others: List[Tuple[CodeBlockRegistry,Iterable[str]|None]]) -> None:
+        """
+        Merge several registries into this one, in order. Each element of
+        `others` is a pair (registry, docnames) where docnames lists the
+        documents that the registry was filled from, or is None to merge all
+        of its blocks. Blocks from other documents are ignored: they were
+        already present in this registry when a parallel worker was forked.
+        Missing blocks are resolved and the integrity of the registry is
+        checked only once, after all blocks have been added.
+        The other registries must no longer be used after this.
+        """
+        self._check_not_frozen()
+
+        for other, docnames in others:
+            if docnames is not None and not isinstance(docnames, set):
+                docnames = set(docnames)
+
+            # Merge tangle hierarchies. Declarations that the other registry
+            # inherited from this one are already recorded, and are not
+            # declared again.
+            for declarations in other._hierarchy_declarations.values():
+                for h in declarations:
+                    self.set_tangle_parent(h.root, h.parent, h.source_location, h.fetch_files, h.debug)
+
+            # Merge blocks, one at a time because a chain may mix blocks
+            # from documents that we merge and from documents that we don't.
+            for lit in other._detach_blocks(docnames):
+                if lit.relation_to_prev in {'NEW', 'INSERTED'}:
+                    self._add_codeblock(lit)
+                else:
+                    self._override_codeblock(lit, lit.relation_to_prev)
+
+            # Merge cross-references
+            for docname, references in other._references_by_docname.items():
+                if docnames is None or docname in docnames:
+                    for referencer, referencee in references:
+                        self.add_reference(referencer, referencee, docname)
+
+        self.try_fixing_all_missing()
+        self.check_integrity(allow_missing=True)
+
+    def _detach_blocks(self, docnames: Set[str] | None) -> List[CodeBlock]:
+        """
+        Return all blocks (including non-head elements of the chains) that
+        are defined in one of the given documents (or all blocks if docnames
+        is None), unlinked from their chain so that they can be registered
+        again one by one.
+        """
+        detached = []
+        for lit in self._blocks.values():
+            while lit is not None:
+                if docnames is None or lit.source_location.docname in docnames:
+                    detached.append(lit)
+                lit = lit.next
+        for lit in detached:
+            lit.next = None
+            lit.chain = None
+            lit.child_index = 0
+            if lit.relation_to_prev != 'INSERTED':
+                lit.prev = None
+        return detached
 
     def try_fixing_all_missing(self):
+        self._check_not_frozen()
         new_missing_list = []
         for missing in self._missing[:]:
-            missing_tangle_root, missing_name = missing.key.split("##")
+            missing_tangle_root, missing_name = missing.key
 
             # Look for the missing lit name in the parent tangle
             entry = self._hierarchy.get(missing_tangle_root)
             if entry is None:
+                new_missing_list.append(missing)
                 continue
             parent_tangle_root = entry.parent
             existing = self.get_rec(missing_name, parent_tangle_root)
@@ -515,20 +1083,157 @@ class CodeBlockRegistry:
             if existing:
                 child_lit = self.get_by_key(missing.key)
                 if child_lit.prev is not None:
-                    print(f"ERROR! Block '{missing.key}' already has a prev block!")
+                    print(f"ERROR! Block {missing.key.format()} already has a prev block!")
                 assert(child_lit.prev is None)
                 child_lit.prev = existing
             else:
                 new_missing_list.append(missing)
+        if len(new_missing_list) != len(self._missing):
+            self._invalidate_caches()
         self._missing = new_missing_list
 
     def remove_codeblocks_by_docname(self, docname: str) -> None:
-        # TODO: when supporting cross-document REPLACE, be careful here
-        self._blocks = {
-            key: lit
-            for key, lit in self._blocks.items()
-            if lit.source_location.docname != docname
-        }
+        """
+        Remove everything that a document added to the registry: its blocks,
+        which are unlinked from the chains they belong to, the references
+        they contain and its lit-setup declarations. Blocks of other
+        documents that were chained after a removed block, in the same tangle
+        root or in a child one, are marked as missing their previous block
+        again, until the document is read again (or finalize() reports them).
+        This only looks at what the document defined.
+        """
+        self._invalidate_caches()
+
+        removed = self._blocks_by_docname.pop(docname, [])
+        removed_ids = { id(lit) for lit in removed }
+
+        # Keys whose first block changed, and the blocks that used to be first
+        changed_keys = set()
+        removed_heads = []
+        new_missing = []
+        for key in dict.fromkeys(lit.key for lit in removed):
+            head = self._blocks.get(key)
+            survivors = []
+            lit = head
+            while lit is not None:
+                if id(lit) in removed_ids:
+                    if lit.uid is not None and self._blocks_by_uid.get(lit.uid) is lit:
+                        del self._blocks_by_uid[lit.uid]
+                else:
+                    survivors.append(lit)
+                lit = lit.next
+            if head is not None and id(head) in removed_ids:
+                changed_keys.add(key)
+                removed_heads.append(head)
+            self._relink_chain(key, survivors)
+            if survivors and survivors[0] is not head:
+                # The chain now starts with a block that modifies a block
+                # that no longer exists
+                survivors[0].prev = None
+                new_missing.append(MissingCodeBlock(key, survivors[0].relation_to_prev))
+                self._orphaned_keys.add(key)
+
+        # Blocks of child tangle roots that were chained to a removed block
+        for old_head in removed_heads:
+            for tr in self._roots_by_name.get(old_head.name, ()):
+                lit = self.get(old_head.name, tr)
+                if lit is not None and lit.prev is old_head:
+                    lit.prev = None
+                    new_missing.append(MissingCodeBlock(lit.key, lit.relation_to_prev))
+
+        if changed_keys or new_missing:
+            self._missing = [
+                m for m in self._missing
+                if m.key not in changed_keys
+            ] + new_missing
+
+        # References
+        for referencer, referencee in self._references_by_docname.pop(docname, []):
+            refs = self._references.get(referencee)
+            if refs is None or referencer not in refs:
+                continue
+            refs[referencer] -= 1
+            if refs[referencer] == 0:
+                del refs[referencer]
+                if not refs:
+                    del self._references[referencee]
+
+        # Tangle hierarchy
+        for tangle_root in self._roots_by_docname.pop(docname, ()):
+            self._remove_tangle_declarations(tangle_root, docname)
+
+    def _relink_chain(self, key: BlockKey, survivors: List[CodeBlock]) -> None:
+        """
+        Make the chain of a key consist of the given blocks only, in this
+        order, or remove the key if the list is empty.
+        """
+        if not survivors:
+            if self._blocks.pop(key, None) is not None:
+                roots = self._roots_by_name.get(key.name)
+                roots.discard(key.tangle_root or None)
+                if not roots:
+                    del self._roots_by_name[key.name]
+            return
+
+        self._blocks[key] = survivors[0]
+        prev = None
+        for child_index, lit in enumerate(survivors):
+            if prev is not None:
+                prev.next = lit
+                lit.prev = prev
+            lit.child_index = child_index
+            lit.chain = None
+            prev = lit
+        prev.next = None
+        survivors[0].chain = CodeBlockChain.from_head(survivors[0])
+
+    def _remove_tangle_declarations(self, tangle_root: str, docname: str) -> None:
+        """
+        Remove the parent declarations of a tangle root that come from a given
+        document, and rebuild its hierarchy entry from the remaining ones.
+        """
+        declarations = [
+            h for h in self._hierarchy_declarations.get(tangle_root, [])
+            if h.source_location.docname != docname
+        ]
+        if declarations:
+            # All declarations have the same parent
+            self._hierarchy_declarations[tangle_root] = declarations
+            fetch_files = []
+            for h in declarations:
+                fetch_files += [f for f in h.fetch_files if f not in fetch_files]
+            self._hierarchy[tangle_root] = TangleHierarchyEntry(
+                root = tangle_root,
+                parent = declarations[0].parent,
+                source_location = declarations[0].source_location,
+                fetch_files = fetch_files,
+                debug = declarations[-1].debug,
+            )
+            return
+
+        self._hierarchy_declarations.pop(tangle_root, None)
+        entry = self._hierarchy.pop(tangle_root, None)
+        if entry is None:
+            return
+        self._hierarchy_children[entry.parent].remove(tangle_root)
+        affected_roots = [tangle_root] + self._all_children_tangle_roots(tangle_root)
+        for root in affected_roots:
+            self._lineages.pop(root, None)
+
+        # Blocks of the affected roots that were chained to a block of a root
+        # that is no longer one of their ancestors. This is the only case
+        # where we need to look at all blocks, but it only occurs when the
+        # removed document was the only one to declare a tangle parent.
+        affected_roots = set(affected_roots)
+        for lit in self._blocks.values():
+            if (
+                lit.tangle_root in affected_roots and
+                lit.prev is not None and
+                lit.relation_to_prev not in {'NEW', 'INSERTED'} and
+                (lit.prev.tangle_root or None) not in self._tangle_lineage(lit.tangle_root)
+            ):
+                lit.prev = None
+                self._missing.append(MissingCodeBlock(lit.key, lit.relation_to_prev))
 
     def set_tangle_parent(self, tangle_root: str, parent: str, source_location: SourceLocation = SourceLocation(), fetch_files: List[Path] = [], debug = False) -> None:
         """
@@ -539,6 +1244,7 @@ class CodeBlockRegistry:
         @param docname Name of the document that sets this parenting
         @param lineno Line where the lit-config that sets this is defined
         """
+        self._invalidate_caches()
         existing = self._hierarchy.get(tangle_root)
         if existing is not None:
             if existing.parent != parent:
@@ -548,28 +1254,38 @@ class CodeBlockRegistry:
                     f"  But trying to set to '{parent}' in {source_location.format()}.\n"
                 )
                 raise ExtensionError(message, modname="sphinx_literate")
-            existing.fetch_files += fetch_files
+            existing.fetch_files += [f for f in fetch_files if f not in existing.fetch_files]
             existing.debug = debug
+            self._declare_tangle_parent(tangle_root, parent, source_location, fetch_files, debug)
         elif tangle_root == parent:
             message = (
                 f"A tangle root cannot be its own parent! \n" +
                 f"  For tangle root '{tangle_root}' in {source_location.format()}.\n"
             )
             raise ExtensionError(message, modname="sphinx_literate")
+        elif tangle_root in self._tangle_lineage(parent):
+            message = (
+                f"Setting the tangle parent of root '{tangle_root}' to '{parent}' would create a cycle!\n" +
+                f"  In {source_location.format()}.\n"
+            )
+            raise ExtensionError(message, modname="sphinx_literate")
         else:
             self._hierarchy[tangle_root] = TangleHierarchyEntry(
                 root = tangle_root,
                 parent = parent,
                 source_location = source_location,
-                fetch_files = fetch_files,
+                fetch_files = list(fetch_files),
                 debug = debug,
             )
+            self._declare_tangle_parent(tangle_root, parent, source_location, fetch_files, debug)
+            self._hierarchy_children[parent].append(tangle_root)
+            for root in [tangle_root] + self._all_children_tangle_roots(tangle_root):
+                self._lineages.pop(root, None)
 
             # Now that 'tangle_root' has a parent, blocks that were missing for
             # this tangle may be resolved
             def isStillUnresolved(missing):
-                missing_tangle_root, missing_name = missing.key.split("##")
-                if missing_tangle_root == tangle_root:
+                if missing.key.tangle_root == tangle_root:
                     child_lit = self.get_by_key(missing.key)
                     if child_lit is not None:
                         assert(child_lit.prev is None)
@@ -581,6 +1297,24 @@ class CodeBlockRegistry:
                 return True
             self._missing = list(filter(isStillUnresolved, self._missing))
 
+    def _declare_tangle_parent(self, tangle_root: str, parent: str, source_location: SourceLocation, fetch_files: List[Path], debug: bool) -> None:
+        """
+        Record a call to set_tangle_parent(), see _hierarchy_declarations.
+        The same declaration may be merged several times (e.g., when merging
+        all blocks of a registry), it is only recorded once.
+        """
+        declaration = TangleHierarchyEntry(
+            root = tangle_root,
+            parent = parent,
+            source_location = source_location,
+            fetch_files = list(fetch_files),
+            debug = debug,
+        )
+        declarations = self._hierarchy_declarations[tangle_root]
+        if declaration not in declarations:
+            declarations.append(declaration)
+        self._roots_by_docname[source_location.docname].add(tangle_root)
+
     def blocks(self) -> List[CodeBlock]:
         return self._blocks.values()
 
@@ -589,17 +1323,63 @@ class CodeBlockRegistry:
         If a tangle root is given, return only blocks for this tangle root,
         including the inherited ones
         """
-        block_names = set()
-        for b in self._blocks.values():
-            if self.get_rec(b.name, tangle_root) is not None:
-                block_names.add(b.name)
-        return [
-            self.get_rec(name, tangle_root)
-            for name in block_names
-        ]
+        return list(self._visible_blocks(tangle_root).values())
+
+    def file_blocks_by_root(self, tangle_root: str | None) -> List[CodeBlock]:
+        """
+        Same as blocks_by_root(), but only return 'file:' blocks.
+        """
+        tangle_root = tangle_root or None
+        files = self._visible_files_by_root.get(tangle_root)
+        if files is None:
+            files = [
+                lit for name, lit in self._visible_blocks(tangle_root).items()
+                if name.startswith("file:")
+            ]
+            self._visible_files_by_root[tangle_root] = files
+        return list(files)
+
+    def _visible_blocks(self, tangle_root: str | None) -> Dict[str,CodeBlock]:
+        """
+        Return the blocks visible from a tangle root, indexed by name.
+        """
+        tangle_root = tangle_root or None
+        visible = self._visible_by_root.get(tangle_root)
+        if visible is None:
+            if not self._visible_by_root:
+                self._build_visible_index()
+            visible = self._visible_by_root.get(tangle_root, {})
+        return visible
+
+    def _build_visible_index(self) -> None:
+        """
+        Build the index of visible blocks of all tangle roots at once. The
+        index of a root is the one of its parent, updated with the blocks
+        that the root itself defines.
+        """
+        own_blocks = defaultdict(dict)
+        for key, lit in self._blocks.items():
+            own_blocks[key.tangle_root or None][key.name] = lit
+
+        visible_by_root = self._visible_by_root
+        visible_by_root[None] = own_blocks.get(None, {})
+        for root in itertools.chain(own_blocks.keys(), self._hierarchy.keys()):
+            if root in visible_by_root:
+                continue
+            # Ancestors whose index is not built yet, from the farthest one
+            missing = []
+            for tr in self._tangle_lineage(root):
+                if tr in visible_by_root:
+                    break
+                missing.append(tr)
+            for tr in reversed(missing):
+                parent = self._parent_tangle_root(tr)
+                visible = dict(visible_by_root[parent]) if parent is not None else {}
+                visible.update(own_blocks.get(tr, {}))
+                visible_by_root[tr] = visible
 
     def get(self, name: str, tangle_root: str | None = None) -> CodeBlock:
-        return self.get_by_key(CodeBlock.build_key(name, tangle_root))
+        return self.get_by_key(BlockKey.make(name, tangle_root))
 
     def get_rec(self, name: str, tangle_root: str | None, override_tangle_root: str | None = None) -> CodeBlock:
         """
@@ -612,16 +1392,31 @@ class CodeBlockRegistry:
         # From this chain of blocks, we keep the one that is just before the
         # first 'NEW' (beyond chich blocks with the same names are not
         # overrides, they are unrelated).
+        # Keys do not distinguish the default root None from ''
+        tangle_root = tangle_root or None
+        override_tangle_root = override_tangle_root or None
+
+        # Only roots that define a block with this name are candidates, so
+        # we never have to walk the whole hierarchy.
+        roots = self._roots_by_name.get(name)
+        if not roots:
+            return None
+
         found = None
-        tr = override_tangle_root
-        while tr is not None and tr != tangle_root:
-            lit = self.get(name, tr)
-            if lit is not None:
+        if override_tangle_root is not None and override_tangle_root != tangle_root:
+            lineage = self._tangle_lineage(override_tangle_root)
+            stop = lineage.get(tangle_root, len(lineage))
+            candidates = sorted(
+                (lineage[tr], tr)
+                for tr in roots
+                if tr in lineage and lineage[tr] < stop
+            )
+            for _, tr in candidates:
+                lit = self.get(name, tr)
                 if lit.relation_to_prev == 'NEW':
                     found = None # reset
                 elif found is None:
                     found = lit
-            tr = self._parent_tangle_root(tr)
 
         if found is not None:
             return found
@@ -630,28 +1425,22 @@ class CodeBlockRegistry:
             return self.get(name)
 
         # In upstream tangle tree, return the first match
-        tr = tangle_root
-        while tr is not None:
-            found = self.get(name, tr)
-            if found is not None:
-                return found
-            tr = self._parent_tangle_root(tr)
-        return None
-
-    def get_by_key(self, key: Key) -> CodeBlock:
+        lineage = self._tangle_lineage(tangle_root)
+        best = min(
+            ((lineage[tr], tr) for tr in roots if tr in lineage),
+            default = None,
+        )
+        return self.get(name, best[1]) if best is not None else None
+
+    def get_by_key(self, key: BlockKey) -> CodeBlock:
         return self._blocks.get(key)
 
-    def get_rec_by_key(self, key: Key, override_tangle_root: str | None = None) -> CodeBlock:
-        tangle_root, name = key.split("##")
+    def get_rec_by_key(self, key: BlockKey, override_tangle_root: str | None = None) -> CodeBlock:
+        tangle_root, name = key
         return self.get_rec(name, tangle_root, override_tangle_root)
 
     def get_by_uid(self, uid: str) -> CodeBlock | None:
-        for b in self._blocks.values():
-            bb = b
-            while bb is not None:
-                if bb.uid == uid:
-                    return bb
-                bb = bb.next
+        return self._blocks_by_uid.get(uid)
 
     def keys(self) -> dict_keys:
         return self._blocks.keys()
@@ -659,8 +1448,9 @@ class CodeBlockRegistry:
     def items(self) -> dict_items:
         return self._blocks.items()
 
-    def references_to_key(self, key: Key) -> List[Key]:
-        return list(self._references[key])
+    def references_to_key(self, key: BlockKey) -> List[BlockKey]:
+        # Sorted for deterministic outputs
+        return sorted(self._references.get(key, ()))
 
     def all_tangle_roots(self) -> List[str|None]:
         ret = set()
@@ -676,46 +1466,69 @@ class CodeBlockRegistry:
             h.parent
             for h in self._hierarchy.values()
         })
-        return list(ret)
+        # Sorted for deterministic outputs (None first)
+        return sorted(ret, key=lambda root: (root is not None, root or ""))
 
     def get_tangle_info(self, tangle_root: str) -> TangleHierarchyEntry:
         return self._hierarchy.get(tangle_root)
 
+    def tangle_lineage(self, tangle_root: str | None) -> List[str|None]:
+        """
+        Return the tangle roots in which blocks are looked up when tangling
+        from a given root: the root itself, then its parent, etc.
+        """
+        if tangle_root is None:
+            return [None]
+        return list(self._tangle_lineage(tangle_root))
+
     def all_tangle_fetch_files(self, tangle_root) -> List[(Path, SourceLocation)]:
         fetch_files = []
-        h = self._hierarchy.get(tangle_root)
-        while h is not None:
+        for tr in self._tangle_lineage(tangle_root):
+            h = self._hierarchy.get(tr)
+            if h is None:
+                continue
             fetch_files += [
                 (f, h.source_location)
                 for f in h.fetch_files
             ]
-            h = self._hierarchy.get(h.parent)
-        h = self._hierarchy.get(tangle_root)
         return fetch_files
 
     def _parent_tangle_root(self, tangle_root: str) -> str | None:
         h = self._hierarchy.get(tangle_root)
         return h.parent if h is not None else None
 
+    def _tangle_lineage(self, tangle_root: str) -> Dict[str,int]:
+        """
+        Return the ancestors of a tangle root, starting with the root itself,
+        mapped to their distance to the root (0 for the root, 1 for its
+        parent, etc.). Dict order follows the parent chain.
+        """
+        lineage = self._lineages.get(tangle_root)
+        if lineage is None:
+            lineage = {}
+            tr = tangle_root
+            while tr is not None and tr not in lineage:
+                lineage[tr] = len(lineage)
+                tr = self._parent_tangle_root(tr)
+            self._lineages[tangle_root] = lineage
+        return lineage
+
     def _children_tangle_roots(self, tangle_root: str) -> List[str] | None:
         """Return direct children"""
-        return [
-            h.root
-            for h in self._hierarchy.values()
-            if h.parent == tangle_root
-        ]
+        return list(self._hierarchy_children.get(tangle_root, []))
 
     def _all_children_tangle_roots(self, tangle_root: str) -> List[str] | None:
         """Recursively return all children"""
-        children = set(self._children_tangle_roots(tangle_root))
-        prev_len_children = -1
-        while len(children) != prev_len_children:
-            prev_len_children = len(children)
-            for child in list(children):  # iterate on a copy
-                children.update(
-                    self._children_tangle_roots(child)
-                )
-        return list(children)
+        children = []
+        seen = {tangle_root}
+        to_visit = [tangle_root]
+        while to_visit:
+            for child in self._hierarchy_children.get(to_visit.pop(), []):
+                if child not in seen:
+                    seen.add(child)
+                    children.append(child)
+                    to_visit.append(child)
+        return children
 
     def check_integrity(self, allow_missing=False):
         """
@@ -731,7 +1544,7 @@ class CodeBlockRegistry:
             while bb is not None:
                 if bb.prev is None and bb.relation_to_prev != 'NEW':
                     if bb.key not in missing_by_key:
-                        print(f"bb.key = {bb.key}")
+                        print(f"bb.key = {bb.key.format()}")
                     assert(bb.key in missing_by_key)
                     assert(missing_by_key[bb.key].relation_to_prev == bb.relation_to_prev)
                 bb = bb.next
@@ -744,7 +1557,7 @@ class CodeBlockRegistry:
 
             # Sanity checks
             assert(lit is not None)
-            missing_root, missing_name = missing.key.split("##", 1)
+            missing_root, missing_name = missing.key
             missing_root_parent = self._parent_tangle_root(missing_root)
             if missing_root_parent is not None:
                 #assert(self.get_rec(missing_name, missing_root_parent) is None)
@@ -804,5 +1617,5 @@ class CodeBlockRegistry:
         ret += [""]
         ret += ["Missing:"]
         for missing in self._missing:
-            ret += [f" - {missing.key} [{missing.relation_to_prev}]"]
+            ret += [f" - {missing.key.format()} [{missing.relation_to_prev}]"]
         return ret
@@ -1,75 +1,277 @@
-from typing import List
+from typing import Dict, FrozenSet, Iterator, List, Set, Tuple
+import hashlib
 
-from .registry import CodeBlock, CodeBlockRegistry
-from .parse import parse_block_link
+from .registry import BlockKey, CodeBlock, CodeBlockRegistry
+from .parse import ReferenceSlot, parse_reference_slots
 
 from sphinx.errors import ExtensionError
+from sphinx.util import logging
+
+logger = logging.getLogger(__name__)
+
+#############################################################
+
+# A block that some tangled content depends on, identified by its uid (None
+# for INSERT modifiers), the document that defines it and its name.
+BlockDependency = Tuple[str | None, str, str]
+
+def block_dependency(lit: CodeBlock) -> BlockDependency:
+    return (lit.uid, lit.source_location.docname, lit.name)
 
 #############################################################
 # Private
 
-def _get_tangle_info(registry, lit, override_tangle_root):
-    tangle_root = override_tangle_root
-    if tangle_root is None:
-        tangle_root = lit.tangle_root
-    return registry.get_tangle_info(tangle_root)
+# Comment prefix for lexers that are not listed in lit_comment_prefixes
+_default_comment_prefix = "//"
+
+# Change this whenever tangle_closure() or the tangled output of a given
+# closure changes, to invalidate on-disk caches
+_closure_version = 1
+
+class _TangleContext:
+    """
+    Settings of a call to tangle(), resolved once rather than for each block.
+    """
+
+    def __init__(self, config):
+        self.begin_ref = config.lit_begin_ref
+        self.end_ref = config.lit_end_ref
+        self.comment_prefixes: Dict[str,str] = {
+            lexer.lower(): prefix
+            for lexer, prefix in config.lit_comment_prefixes.items()
+        }
+        self._debug_by_root: Dict[str|None,bool] = {}
+
+    def comment_prefix(self, lexer: str | None) -> str:
+        if lexer is None:
+            return _default_comment_prefix
+        return self.comment_prefixes.get(lexer.lower(), _default_comment_prefix)
+
+    def is_debug(self, registry: CodeBlockRegistry, tangle_root: str | None) -> bool:
+        """
+        Tell whether the tangle root is in debug mode (see lit-setup)
+        """
+        debug = self._debug_by_root.get(tangle_root)
+        if debug is None:
+            tangle_info = registry.get_tangle_info(tangle_root)
+            debug = tangle_info is not None and tangle_info.debug
+            self._debug_by_root[tangle_root] = debug
+        return debug
+
+    def reference_slots(self, lit: CodeBlock) -> Tuple[ReferenceSlot|None, ...]:
+        """
+        Reference slots of a block, parsed here only if the block does not
+        come from a lit directive (which parses them already).
+        """
+        if lit.reference_slots is None:
+            lit.reference_slots = parse_reference_slots(lit.content, lit.tangle_root, self.begin_ref, self.end_ref)
+        return lit.reference_slots
+
+class _TangleFrame:
+    """
+    A block being tangled, in the explicit stack of _tangle_iter().
+    """
+    __slots__ = ("lit", "items", "prefix", "visited", "capture", "dependencies")
+
+    def __init__(self, lit: CodeBlock, items: Iterator, prefix: str, visited: List[CodeBlock], capture: bool):
+        self.lit = lit
+
+        # Iterator returned by _block_items()
+        self.items = items
+
+        # Prefix of all the lines of the block in the tangled output
+        self.prefix = prefix
+
+        # Blocks that the content of this block depends on
+        self.visited = visited
+
+        # When the lines of this block are memoized, they are gathered in this
+        # list (without self.prefix), together with the blocks they depend on
+        # (including referenced ones).
+        self.capture: List[str] | None = [] if capture else None
+        self.dependencies: Set[BlockDependency] | None = set() if capture else None
 
 def _tangle_rec(
     lit: CodeBlock,
     registry: CodeBlockRegistry,
     override_tangle_root: str,
-    begin_ref: str, # config
-    end_ref: str, # config
-    tangled_content, # return list
-    prefix = "" # for recursive use only
-) -> None:
+    context: _TangleContext,
+) -> Tuple[List[str], FrozenSet[BlockDependency]]:
+    """
+    Return the tangled lines of a block, without any prefix, together with the
+    set of blocks that they depend on. The result is memoized in the
+    registry's tangle cache, for each pair of (block key, override tangle
+    root), so that blocks referenced multiple times (possibly from different
+    files or tangle directives) are only tangled once.
+    The returned list is shared, it must not be modified.
+    """
     assert(lit is not None)
-    tangle_info = _get_tangle_info(registry, lit, override_tangle_root)
-    comment_prefix = {
-        "c++": "//",
-        "javascript": "//",
-        "rust": "//",
-        "python": "#",
-        "cmake": "#",
-        "bash": "#",
-    }.get(lit.lexer.lower() if lit.lexer is not None else None, "//")
+    cache_key = (lit.key, override_tangle_root)
+    cached = registry.tangle_cache.get(cache_key)
+    if cached is not None:
+        return cached
+
+    dependencies = set()
+    tangled_content = list(_tangle_iter(
+        lit,
+        registry,
+        override_tangle_root,
+        context,
+        dependencies,
+    ))
+
+    result = (tangled_content, frozenset(dependencies))
+    registry.tangle_cache[cache_key] = result
+    return result
+
+def _block_items(
+    lit: CodeBlock,
+    registry: CodeBlockRegistry,
+    override_tangle_root: str,
+    context: _TangleContext,
+    visited: List[CodeBlock],
+) -> Iterator[str | Tuple[CodeBlock, str]]:
+    """
+    Yield the lines of a block, without any prefix and without resolving
+    references: a line that holds a reference is replaced by the pair
+    (referenced block, prefix of the reference).
+    @param visited list to which the blocks that the content depends on get
+                   appended
+    """
     if lit.lexer is None:
-        print(f"######## {lit.format()} from {lit.source_location.format()}")
-    if tangle_info is not None and tangle_info.debug:
-        tangled_content.append(prefix + f"{comment_prefix} {{Begin block {lit.format()}}}")
-    for line in lit.all_content(registry, override_tangle_root):
-        # TODO: use parse.parse_block_content here?
-        subprefix = None
-        link = None
-        begin_offset = line.find(begin_ref)
-        if begin_offset != -1:
-            end_offset = line.find(end_ref, begin_offset)
-            if end_offset != -1:
-                subprefix = line[:begin_offset]
-                link = line[begin_offset+len(begin_ref):end_offset]
-        if link is not None:
-            parsed_link = parse_block_link(link, lit.tangle_root)
-            sublit = registry.get_rec_by_key(parsed_link.key, override_tangle_root=override_tangle_root)
-            if sublit is None:
+        logger.debug("[sphinx_literate] Block %s from %s has no lexer", lit.format(), lit.source_location.format())
+    debug = context.is_debug(
+        registry,
+        override_tangle_root if override_tangle_root is not None else lit.tangle_root,
+    )
+    if debug:
+        comment_prefix = context.comment_prefix(lit.lexer)
+        yield f"{comment_prefix} {{Begin block {lit.format()}}}"
+    tangle_root = lit.tangle_root or ""
+    source = None
+    slots = ()
+    for origin, i in lit.all_content_origins(registry, override_tangle_root, visited):
+        if origin is not source:
+            source = origin
+            slots = context.reference_slots(source)
+        slot = slots[i] if slots else None
+        if slot is None:
+            yield source.content[i]
+            continue
+
+        # References are looked up from the root of the tangled block, which
+        # differs from the one of the line when it comes from a parent root.
+        key = slot.link.key
+        if key.tangle_root != tangle_root:
+            key = BlockKey.make(key.name, tangle_root)
+        sublit = registry.get_rec_by_key(key, override_tangle_root=override_tangle_root)
+        if sublit is None:
+            message = (
+                f"Literate code block not found: {key.format()} " +
+                f"(in lit directive from {lit.source_location.format()}, " +
+                f"tangle root {lit.tangle_root})"
+            )
+            raise ExtensionError(message, modname="sphinx_literate")
+        yield (sublit, slot.prefix)
+    if debug:
+        yield f"{comment_prefix} {{End block {lit.format()}}}"
+
+def _tangle_iter(
+    lit: CodeBlock,
+    registry: CodeBlockRegistry,
+    override_tangle_root: str,
+    context: _TangleContext,
+    dependencies: Set[BlockDependency],
+) -> Iterator[str]:
+    """
+    Yield the tangled lines of a block, without any prefix. The blocks that
+    these lines depend on are added to `dependencies` as they are visited, so
+    this set is complete only once the iterator is exhausted.
+
+    References are resolved with an explicit stack of the blocks being
+    tangled rather than by recursion, so that the depth of references is not
+    limited by Python's recursion limit.
+
+    The first time a block is referenced, it is streamed. It gets memoized
+    only when referenced again, so that blocks that are used only once (like
+    large data tables) are never copied.
+    """
+    assert(lit is not None)
+
+    def push(lit, prefix, capture):
+        visited = []
+        items = _block_items(lit, registry, override_tangle_root, context, visited)
+        frame = _TangleFrame(lit, items, prefix, visited, capture)
+        active[lit.key] = len(stack)
+        stack.append(frame)
+        if capture:
+            capturing.append(frame)
+
+    def add_dependencies(block_dependencies):
+        dependencies.update(block_dependencies)
+        for frame in capturing:
+            frame.dependencies.update(block_dependencies)
+
+    stack: List[_TangleFrame] = []
+    # Frames of the stack that memoize their lines
+    capturing: List[_TangleFrame] = []
+    # Position in the stack of the blocks being tangled, to detect cycles
+    active: Dict[BlockKey,int] = {}
+
+    push(lit, "", False)
+    while stack:
+        frame = stack[-1]
+        item = next(frame.items, None)
+
+        if item is None:
+            # End of the block
+            stack.pop()
+            del active[frame.lit.key]
+            add_dependencies({ block_dependency(b) for b in frame.visited })
+            if frame.capture is not None:
+                capturing.pop()
+                cache_key = (frame.lit.key, override_tangle_root)
+                registry.tangle_cache[cache_key] = (frame.capture, frozenset(frame.dependencies))
+
+        elif type(item) is str:
+            line = frame.prefix + item if frame.prefix else item
+            for f in capturing:
+                f.capture.append(line[len(f.prefix):])
+            yield line
+
+        else:
+            sublit, subprefix = item
+            prefix = frame.prefix + subprefix
+
+            if sublit.key in active:
+                cycle = [f.lit for f in stack[active[sublit.key]:]] + [sublit]
                 message = (
-                    f"Literate code block not found: '{parsed_link.key}' " +
-                    f"(in lit directive from {lit.source_location.format()}, " +
-                    f"tangle root {lit.tangle_root})"
+                    "Cycle of references between literate code blocks: " +
+                    " -> ".join(b.format() for b in cycle) +
+                    f" (the last reference is in lit directive from {frame.lit.source_location.format()})"
                 )
                 raise ExtensionError(message, modname="sphinx_literate")
-            _tangle_rec(
-                sublit,
-                registry,
-                override_tangle_root,
-                begin_ref,
-                end_ref,
-                tangled_content,
-                prefix=prefix + subprefix
-            )
-        else:
-            tangled_content.append(prefix + line)
-    if tangle_info is not None and tangle_info.debug:
-        tangled_content.append(prefix + f"{comment_prefix} {{End block {lit.format()}}}")
+
+            cache_key = (sublit.key, override_tangle_root)
+            if cache_key not in registry.tangle_cache:
+                # Mark as seen once
+                registry.tangle_cache[cache_key] = None
+                push(sublit, prefix, False)
+                continue
+
+            cached = registry.tangle_cache[cache_key]
+            if cached is None:
+                # Seen once already, memoize while streaming
+                push(sublit, prefix, True)
+                continue
+
+            sublines, subdependencies = cached
+            add_dependencies(subdependencies)
+            for l in sublines:
+                line = prefix + l if prefix else l
+                for f in capturing:
+                    f.capture.append(line[len(f.prefix):])
+                yield line
 
 #############################################################
 # Public
@@ -79,8 +281,9 @@ def tangle(
     tangle_root: str | None,
     registry: CodeBlockRegistry,
     config, # sphinx app config
-    error_context: str = ""
-) -> List[str]:
+    error_context: str = "",
+    dependencies: Set[BlockDependency] | None = None,
+) -> Tuple[List[str], CodeBlock]:
     """
     Tangle a given code block, i.e. resolve all the references to generate a
     full code without any more pending reference in it.
@@ -91,7 +294,11 @@ def tangle(
                     from the source documentation.
     @param config sphinx app config
     @param error_context optional string added to error messages
-    @return the generated source code as a list of lines, and the root lit block
+    @param dependencies optional set that gets filled with the blocks that
+           the tangled content depends on
+    @return the generated source code as a list of lines, and the root lit block.
+            The list of lines is shared with the registry's tangle cache, so it
+            must not be modified.
     """
     lit = registry.get_rec(block_name, tangle_root)
     if lit is None:
@@ -101,13 +308,111 @@ def tangle(
         )
         raise ExtensionError(message, modname="sphinx_literate")
 
-    tangled_content = []
-    _tangle_rec(
+    tangled_content, block_dependencies = _tangle_rec(
         lit,
         registry,
         tangle_root,
-        config.lit_begin_ref,
-        config.lit_end_ref,
-        tangled_content,
+        _TangleContext(config),
     )
+    if dependencies is not None:
+        dependencies.update(block_dependencies)
     return tangled_content, lit
+
+def tangle_iter(
+    block_name: str,
+    tangle_root: str | None,
+    registry: CodeBlockRegistry,
+    config, # sphinx app config
+    error_context: str = "",
+    dependencies: Set[BlockDependency] | None = None,
+) -> Tuple[Iterator[str], CodeBlock]:
+    """
+    Same as tangle(), but the lines are generated while iterating, so that
+    the whole content does not need to be held in memory.
+    @return an iterator over the lines of the generated source code, and the
+            root lit block. The dependencies are complete only once the
+            iterator is exhausted.
+    """
+    lit = registry.get_rec(block_name, tangle_root)
+    if lit is None:
+        message = (
+            f"Literate code block not found: '{block_name}' " +
+            f"({error_context}in root '{tangle_root}')"
+        )
+        raise ExtensionError(message, modname="sphinx_literate")
+
+    if dependencies is None:
+        dependencies = set()
+    lines = _tangle_iter(
+        lit,
+        registry,
+        tangle_root,
+        _TangleContext(config),
+        dependencies,
+    )
+    return lines, lit
+
+def tangle_closure(
+    block_name: str,
+    tangle_root: str | None,
+    registry: CodeBlockRegistry,
+    config, # sphinx app config
+) -> Tuple[str, Set[BlockDependency]]:
+    """
+    Hash everything that the tangled content of a block may depend on,
+    without tangling it: all the blocks whose name can be reached from it
+    through references and insertions, in all the ancestors of the tangle
+    root, together with the hierarchy of these roots and the config. Two
+    registries that give the same hash give the same tangled content.
+    @return the hash, and the blocks it was computed from, which are a
+            superset of the dependencies filled by tangle()
+    """
+    context = _TangleContext(config)
+    lineage = registry.tangle_lineage(tangle_root)
+    debug = context.is_debug(registry, tangle_root)
+
+    h = hashlib.blake2b(digest_size=20)
+    h.update(repr((
+        _closure_version,
+        block_name,
+        lineage,
+        debug,
+        context.begin_ref,
+        context.end_ref,
+        sorted(context.comment_prefixes.items()) if debug else None,
+    )).encode())
+
+    dependencies = set()
+    names = [block_name]
+    seen_names = { block_name }
+    for name in names:
+        for tr in lineage:
+            lit = registry.get(name, tr)
+            while lit is not None:
+                dependencies.add(block_dependency(lit))
+                inserted = lit.inserted_block
+                location = lit.inserted_location
+                h.update(repr((
+                    lit.tangle_root,
+                    lit.name,
+                    lit.relation_to_prev,
+                    lit.lexer,
+                    lit.content,
+                    (location.placement, location.pattern) if location is not None else None,
+                    tuple(inserted.key) if inserted is not None else None,
+                )).encode())
+
+                referenced = [
+                    slot.link.key.name
+                    for slot in context.reference_slots(lit)
+                    if slot is not None
+                ]
+                if inserted is not None:
+                    referenced.append(inserted.name)
+                for n in referenced:
+                    if n not in seen_names:
+                        seen_names.add(n)
+                        names.append(n)
+                lit = lit.next
+
+    return h.hexdigest(), dependencies
@@ -7,7 +7,7 @@ def print_traceback(f):
     """
     def wrapped(*args, **kwargs):
         try:
-            f(*args, **kwargs)
+            return f(*args, **kwargs)
         except Exception as err:
             print(traceback.format_exc())
             raise err
@@ -0,0 +1,78 @@
+"""
+Benchmarks for the multi-pattern matcher used by INSERT BEFORE/AFTER.
+
+Run with `python bench/bench_matcher.py`. The script exits with a non-zero
+status when the time spent per line grows (roughly) linearly with the number
+of patterns, like it does with one substring search per pattern.
+"""
+
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.matcher import MultiPatternMatcher
+
+from timeit import timeit
+import random
+
+#############################################################
+
+def make_lines(line_count: int, rng: random.Random):
+    words = ["int", "float", "return", "auto", "const", "for", "if", "{", "}", "=", ";", "x", "y", "value"]
+    return [
+        " ".join(rng.choice(words) for _ in range(rng.randint(2, 10)))
+        for _ in range(line_count)
+    ]
+
+def make_patterns(pattern_count: int, rng: random.Random):
+    return [
+        f"// patch {i} " + "".join(rng.choice("abcdefgh") for _ in range(6))
+        for i in range(pattern_count)
+    ]
+
+def bench(pattern_count: int, line_count: int = 2000):
+    """
+    @return average time per line for the matcher and for a substring search
+            per pattern, in seconds
+    """
+    rng = random.Random(0)
+    lines = make_lines(line_count, rng)
+    patterns = make_patterns(pattern_count, rng)
+    matcher = MultiPatternMatcher(patterns)
+
+    def run_matcher():
+        for l in lines:
+            matcher.find_ordered(l)
+
+    def run_substring():
+        for l in lines:
+            [p for p in patterns if p in l]
+
+    return (
+        min(timeit(run_matcher, number=1) for _ in range(5)) / line_count,
+        min(timeit(run_substring, number=1) for _ in range(5)) / line_count,
+    )
+
+#############################################################
+
+def main():
+    pattern_counts = [1, 10, 100, 1000]
+    timings = {}
+    print("find patterns in a line:")
+    for pattern_count in pattern_counts:
+        timings[pattern_count], substring = bench(pattern_count)
+        print(
+            f"  {pattern_count:>5} patterns: " +
+            f"matcher {timings[pattern_count] * 1e9:8.1f} ns/line, " +
+            f"substring search {substring * 1e9:8.1f} ns/line"
+        )
+
+    ratio = timings[pattern_counts[-1]] / timings[pattern_counts[0]]
+    print(f"  ratio {pattern_counts[-1]}/{pattern_counts[0]}: {ratio:.2f}")
+    if ratio > 10:
+        print("FAILED: matching time grows with the number of patterns")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,112 @@
+"""
+Benchmark of the memory used while tangling a large file.
+
+Run with `python bench/bench_memory.py`. Each measure runs in a separate
+process, so that peak RSS (resident set size) values are not polluted by one
+another. The script exits with a non-zero status when streaming the tangled
+lines makes the peak RSS grow by more than a fraction of the size of the
+tangled content, i.e., when a copy of the whole content is kept somewhere.
+"""
+
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.registry import CodeBlockRegistry, CodeBlock, SourceLocation
+from sphinx_literate.tangle import tangle, tangle_iter
+
+from types import SimpleNamespace
+import resource
+import subprocess
+
+config = SimpleNamespace(
+    lit_begin_ref = "{{",
+    lit_end_ref = "}}",
+    lit_comment_prefixes = {},
+)
+
+#############################################################
+
+def build_registry(line_count: int) -> CodeBlockRegistry:
+    """
+    A file that contains a large data table, appended in multiple blocks,
+    with a few lines inserted in the middle.
+    """
+    reg = CodeBlockRegistry()
+    reg.register_codeblock(CodeBlock(
+        name = "file: data.h",
+        lexer = "C++",
+        source_location = SourceLocation("doc", 0),
+        content = ["const float data[] = {", "    {{Data}}", "};"],
+    ))
+    block_count = 10
+    for b in range(block_count):
+        reg.register_codeblock(CodeBlock(
+            name = "Data",
+            lexer = "C++",
+            source_location = SourceLocation("doc", b + 1),
+            content = [
+                f"{i * 0.001:.6f}f, {i * 0.002:.6f}f, {i * 0.003:.6f}f, // row {i}"
+                for i in range(b * line_count // block_count, (b + 1) * line_count // block_count)
+            ],
+        ), set() if b == 0 else {'APPEND'})
+    reg.register_codeblock(CodeBlock(
+        name = "Middle",
+        lexer = "C++",
+        source_location = SourceLocation("doc", block_count + 1),
+        content = ["// middle of the table"],
+    ), {('INSERT', "Data", 'AFTER', f"// row {line_count // 2}")})
+    reg.finalize()
+    return reg
+
+def peak_rss_kb() -> int:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(mode: str, line_count: int) -> None:
+    """
+    Run in a child process: print the increase of peak RSS (in kB) while
+    tangling, and the size of the tangled content (in kB).
+    """
+    reg = build_registry(line_count)
+    before = peak_rss_kb()
+    size = 0
+    if mode == "stream":
+        lines, _ = tangle_iter("file: data.h", None, reg, config)
+        for line in lines:
+            size += len(line) + 1
+    else:
+        lines, _ = tangle("file: data.h", None, reg, config)
+        data = '\n'.join(lines)
+        size = len(data)
+    print(peak_rss_kb() - before, size // 1024)
+
+def run(mode: str, line_count: int):
+    output = subprocess.run(
+        [sys.executable, __file__, mode, str(line_count)],
+        check=True, capture_output=True, text=True,
+    ).stdout
+    rss, size = output.splitlines()[-1].split()
+    return int(rss), int(size)
+
+#############################################################
+
+def main():
+    line_count = 500000
+    print(f"tangling a file of {line_count} lines:")
+    results = {}
+    for mode in ["list", "stream"]:
+        results[mode] = run(mode, line_count)
+        rss, size = results[mode]
+        print(f"  {mode:>6}: peak RSS +{rss / 1024:7.1f} MB (content: {size / 1024:.1f} MB)")
+
+    rss, size = results["stream"]
+    if rss > size / 4:
+        print("FAILED: the whole tangled content is kept in memory while streaming")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        measure(sys.argv[1], int(sys.argv[2]))
+        sys.exit(0)
+    sys.exit(main())
@@ -0,0 +1,102 @@
+"""
+Benchmarks for merging the registries of parallel reading workers.
+
+Run with `python bench/bench_merge.py`. The script exits with a non-zero
+status when the time spent per merged block does not stay (roughly) flat as
+the number of workers grows.
+"""
+
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.registry import CodeBlockRegistry, CodeBlock, SourceLocation
+
+from timeit import default_timer
+import gc
+
+#############################################################
+
+def build_worker_registry(worker: int, block_count: int) -> CodeBlockRegistry:
+    """
+    Create the registry that a worker would produce after reading its chunk
+    of documents: half of the blocks are new, the other half append to them,
+    and a few append to a block defined by the first worker (so they are
+    missing until merged).
+    """
+    reg = CodeBlockRegistry()
+    docname = f"doc{worker}"
+    for i in range(block_count):
+        if i % 50 == 49 and worker > 0:
+            name, options = "Shared", {'APPEND'}
+        elif i % 2 == 0:
+            name, options = f"Block {worker}-{i // 2}", set()
+        else:
+            name, options = f"Block {worker}-{i // 2}", {'APPEND'}
+        reg.register_codeblock(CodeBlock(
+            name = name,
+            source_location = SourceLocation(docname, i),
+            content = [f"line {i}"],
+        ), options)
+    if worker == 0:
+        reg.register_codeblock(CodeBlock(
+            name = "Shared",
+            source_location = SourceLocation(docname, block_count),
+            content = ["shared"],
+        ))
+    return reg
+
+def bench_merge(worker_count: int, block_count: int, batched: bool) -> float:
+    """
+    @return time spent merging worker_count registries of block_count blocks,
+    in seconds
+    """
+    timings = []
+    for _ in range(3):
+        workers = [
+            (build_worker_registry(w, block_count), [f"doc{w}"])
+            for w in range(worker_count)
+        ]
+        reg = CodeBlockRegistry()
+        # Like timeit, do not let the garbage collector add noise
+        gc.collect()
+        gc.disable()
+        start = default_timer()
+        if batched:
+            reg.merge_all(workers)
+        else:
+            for other, docnames in workers:
+                reg.merge(other, docnames)
+        reg.finalize()
+        timings.append(default_timer() - start)
+        gc.enable()
+    return min(timings)
+
+#############################################################
+
+def main():
+    block_count = 1000
+    worker_counts = [2, 4, 8, 16]
+    per_block = {}
+    print(f"merge ({block_count} blocks per worker):")
+    for worker_count in worker_counts:
+        batched = bench_merge(worker_count, block_count, batched=True)
+        one_by_one = bench_merge(worker_count, block_count, batched=False)
+        per_block[worker_count] = batched / (worker_count * block_count)
+        print(
+            f"  {worker_count:>3} workers: " +
+            f"merge_all {batched * 1e3:8.1f} ms, " +
+            f"merge one by one {one_by_one * 1e3:8.1f} ms"
+        )
+
+    # Checking integrity after each merged block made the cost per block
+    # grow linearly with the total number of blocks.
+    ratio = per_block[worker_counts[-1]] / per_block[worker_counts[0]]
+    print(f"  ratio per block {worker_counts[-1]}/{worker_counts[0]} workers: {ratio:.2f}")
+    if ratio > 3:
+        print("FAILED: merge time per block grows with the number of workers")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,540 @@
+/**
+ * Benchmark of the latency of toggling a literate option in the browser.
+ *
+ * Run with `node bench/bench_options.js [path/to/sphinx_literate.js]`. It
+ * builds a page with many lit-ref and lit-block-info elements, loads the
+ * script (the one of this repository by default) and measures how long
+ * options.set() takes for each option, as well as the time the script blocks
+ * the page when it loads. It uses jsdom when it is installed, and otherwise a
+ * minimal DOM implemented below, so that it runs offline with plain node.
+ *
+ * Elements are rendered lazily, when they get near the viewport and in
+ * idle-time batches, so this is measured with and without an
+ * IntersectionObserver: the minimal DOM emulates one for which the first lit
+ * elements of the page are in the viewport. The script exits with a non-zero status when toggling an
+ * option that only affects block infos gets slower with the number of
+ * references, when elements are rendered before the script returns, or
+ * when lines of hidden references are not hidden by then.
+ * Load times include the upgrade of the elements by the emulated DOM, which
+ * browsers do natively.
+ */
+
+const fs = require("fs");
+const path = require("path");
+const vm = require("vm");
+
+//////////////////////////////////////////////////////////////
+// Minimal DOM, with just what sphinx_literate.js needs
+
+class MiniNode {
+	constructor() {
+		this.parentNode = null;
+		this.childNodes = [];
+	}
+
+	get isConnected() {
+		let node = this;
+		while (node.parentNode !== null) {
+			node = node.parentNode;
+		}
+		if (node instanceof MiniShadowRoot) {
+			return node.host.isConnected;
+		}
+		return node instanceof MiniDocument;
+	}
+
+	get nextSibling() {
+		if (this.parentNode === null) return null;
+		const siblings = this.parentNode.childNodes;
+		return siblings[siblings.indexOf(this) + 1] || null;
+	}
+
+	append(...nodes) {
+		for (const node of nodes) {
+			this.insertBefore(node, null);
+		}
+	}
+
+	insertBefore(node, reference) {
+		if (node.parentNode !== null) {
+			node.parentNode.removeChild(node);
+		}
+		const index = reference === null ? this.childNodes.length : this.childNodes.indexOf(reference);
+		this.childNodes.splice(index, 0, node);
+		node.parentNode = this;
+		if (this.isConnected) {
+			node._connected();
+		}
+		return node;
+	}
+
+	removeChild(node) {
+		const wasConnected = node.isConnected;
+		this.childNodes.splice(this.childNodes.indexOf(node), 1);
+		node.parentNode = null;
+		if (wasConnected) {
+			node._disconnected();
+		}
+		return node;
+	}
+
+	replaceChildren(...nodes) {
+		while (this.childNodes.length > 0) {
+			this.removeChild(this.childNodes[this.childNodes.length - 1]);
+		}
+		this.append(...nodes);
+	}
+
+	_connected() {
+		if (this.connectedCallback) this.connectedCallback();
+		for (const child of this.childNodes) child._connected();
+	}
+
+	_disconnected() {
+		if (this.disconnectedCallback) this.disconnectedCallback();
+		for (const child of this.childNodes) child._disconnected();
+	}
+
+	_descendants() {
+		const nodes = [];
+		const stack = [...this.childNodes].reverse();
+		while (stack.length > 0) {
+			const node = stack.pop();
+			nodes.push(node);
+			for (let i = node.childNodes.length - 1 ; i >= 0 ; --i) {
+				stack.push(node.childNodes[i]);
+			}
+		}
+		return nodes;
+	}
+}
+
+class MiniText extends MiniNode {
+	constructor(value) {
+		super();
+		this.nodeType = 3;
+		this.nodeValue = value;
+	}
+}
+
+class MiniElement extends MiniNode {
+	constructor() {
+		super();
+		// Upgrade of an element that is already in the tree, see define()
+		const target = MiniElement.upgradeTarget;
+		if (target !== null) {
+			MiniElement.upgradeTarget = null;
+			Object.setPrototypeOf(target, new.target.prototype);
+			return target;
+		}
+		this.nodeType = 1;
+		this.nodeValue = null;
+		this.tagName = MiniElement.nextTagName;
+		this.attributes = new Map();
+		this.shadowRoot = null;
+	}
+
+	getAttribute(name) {
+		return this.attributes.has(name) ? this.attributes.get(name) : null;
+	}
+
+	setAttribute(name, value) {
+		this.attributes.set(name, String(value));
+	}
+
+	hasAttribute(name) {
+		return this.attributes.has(name);
+	}
+
+	set href(value) {
+		this.setAttribute("href", value);
+	}
+
+	get textContent() {
+		return this.childNodes.map(node => node.nodeType === 3 ? node.nodeValue : node.textContent).join("");
+	}
+
+	set textContent(value) {
+		this.replaceChildren(new MiniText(value));
+	}
+
+	matches(selector) {
+		if (selector.startsWith(".")) {
+			return (this.getAttribute("class") || "").split(" ").includes(selector.substring(1));
+		}
+		return this.tagName === selector;
+	}
+
+	closest(selector) {
+		let node = this;
+		while (node instanceof MiniElement) {
+			if (node.matches(selector)) return node;
+			node = node.parentNode;
+		}
+		return null;
+	}
+
+	attachShadow() {
+		this.shadowRoot = new MiniShadowRoot(this);
+		return this.shadowRoot;
+	}
+}
+MiniElement.upgradeTarget = null;
+MiniElement.nextTagName = "";
+
+class MiniShadowRoot extends MiniNode {
+	constructor(host) {
+		super();
+		this.host = host;
+		this._adoptedStyleSheets = [];
+	}
+
+	// Accessors, so that the script can detect support on the prototype
+	get adoptedStyleSheets() {
+		return this._adoptedStyleSheets;
+	}
+
+	set adoptedStyleSheets(sheets) {
+		this._adoptedStyleSheets = sheets;
+	}
+}
+
+class MiniStyleSheet {
+	replaceSync(css) {
+		this.css = css;
+	}
+}
+
+class MiniEvent {
+	constructor(type, init) {
+		this.type = type;
+		this.detail = init ? init.detail : undefined;
+	}
+}
+
+class MiniDocument extends MiniNode {
+	constructor() {
+		super();
+		this.listeners = {};
+		this.customElementClasses = {};
+		this.documentElement = this.createElement("html");
+		this.head = this.createElement("head");
+		this.body = this.createElement("body");
+		this.append(this.documentElement);
+		this.documentElement.append(this.head, this.body);
+	}
+
+	createElement(tagName) {
+		MiniElement.nextTagName = tagName;
+		const ElementClass = this.customElementClasses[tagName] || MiniElement;
+		return new ElementClass();
+	}
+
+	createTextNode(value) {
+		return new MiniText(value);
+	}
+
+	getElementById(id) {
+		for (const node of this._descendants()) {
+			if (node instanceof MiniElement && node.getAttribute("id") === id) {
+				return node;
+			}
+		}
+		return null;
+	}
+
+	addEventListener(type, listener) {
+		(this.listeners[type] = this.listeners[type] || []).push(listener);
+	}
+
+	dispatchEvent(event) {
+		for (const listener of this.listeners[event.type] || []) {
+			listener.call(this, event);
+		}
+	}
+
+	defineCustomElement(tagName, ElementClass) {
+		this.customElementClasses[tagName] = ElementClass;
+		// Upgrade elements that are already in the document, in tree order
+		const existing = this._descendants().filter(node => node.tagName === tagName);
+		for (const element of existing) {
+			MiniElement.upgradeTarget = element;
+			new ElementClass();
+			if (element.connectedCallback) element.connectedCallback();
+		}
+	}
+}
+
+/**
+ * Elements are near the viewport when they are among the first viewportSize
+ * elements ever observed, and not in a subtree hidden with "display: none;".
+ * Entries are delivered asynchronously, like in browsers.
+ */
+class MiniIntersectionObserver {
+	constructor(callback) {
+		this.callback = callback;
+		this.queue = [];
+		this.positions = MiniIntersectionObserver.positions;
+	}
+
+	observe(element) {
+		if (!this.positions.has(element)) {
+			this.positions.set(element, this.positions.size);
+		}
+		if (this.queue.length === 0) {
+			setTimeout(() => this.deliver(), 0);
+		}
+		this.queue.push(element);
+	}
+
+	unobserve(element) {
+		const index = this.queue.indexOf(element);
+		if (index !== -1) this.queue.splice(index, 1);
+	}
+
+	deliver() {
+		const entries = this.queue.map(target => ({
+			target,
+			isIntersecting: this.positions.get(target) < MiniIntersectionObserver.viewportSize && !isHidden(target),
+		}));
+		this.queue = [];
+		this.callback(entries);
+	}
+}
+MiniIntersectionObserver.positions = new Map();
+MiniIntersectionObserver.viewportSize = 100;
+
+function isHiddenLine(node) {
+	return node.getAttribute && node.getAttribute("class") === "lit-line-wrapper" && node.getAttribute("style") === "display: none;";
+}
+
+function isHidden(node) {
+	for (; node instanceof MiniElement ; node = node.parentNode) {
+		if (node.getAttribute("style") === "display: none;") return true;
+	}
+	return false;
+}
+
+class MiniStorage {
+	constructor() {
+		this.items = new Map();
+	}
+	getItem(key) {
+		return this.items.has(key) ? this.items.get(key) : null;
+	}
+	setItem(key, value) {
+		this.items.set(key, String(value));
+	}
+}
+
+function createMiniWindow(withIntersectionObserver) {
+	const document = new MiniDocument();
+	MiniIntersectionObserver.positions = new Map();
+	const window = {
+		document,
+		localStorage: new MiniStorage(),
+		customElements: { define: (name, cls) => document.defineCustomElement(name, cls) },
+		HTMLElement: MiniElement,
+		ShadowRoot: MiniShadowRoot,
+		CSSStyleSheet: MiniStyleSheet,
+		Node: { TEXT_NODE: 3, ELEMENT_NODE: 1 },
+		Event: MiniEvent,
+		CustomEvent: MiniEvent,
+		console: { log() {}, warn: console.warn, error: console.error },
+		setTimeout,
+		clearTimeout,
+		addEventListener() {},
+	};
+	if (withIntersectionObserver) {
+		window.IntersectionObserver = MiniIntersectionObserver;
+	}
+	window.window = window;
+	vm.createContext(window);
+	return {
+		document,
+		run: code => vm.runInContext(code, window),
+		loaded: () => document.dispatchEvent(new MiniEvent("DOMContentLoaded")),
+		renderedCount: () => document._descendants().filter(node => node.shadowRoot).length,
+		hiddenLineCount: () => document._descendants().filter(isHiddenLine).length,
+	};
+}
+
+//////////////////////////////////////////////////////////////
+// Test page
+
+/**
+ * Add a code block per blockCount to the body, with the references spread
+ * among them, one per line. One reference out of ten is hidden.
+ */
+function buildPage(page, refCount, blockCount) {
+	const document = page.document;
+	const blocks = {};
+	for (let b = 0 ; b < blockCount ; ++b) {
+		blocks[`doc:${b}`] = { name: `Block ${b}`, permalink: `#lit-${b}`, hidden: false, "referenced in": [0] };
+	}
+	const table = document.createElement("script");
+	table.setAttribute("type", "application/json");
+	table.setAttribute("id", "lit-block-data");
+	table.textContent = JSON.stringify({ links: [{ name: "Block 0", url: "#lit-0", details: null }], blocks });
+	document.body.append(table);
+
+	for (let b = 0 ; b < blockCount ; ++b) {
+		const pre = document.createElement("pre");
+		const lines = Math.floor(refCount / blockCount) + (b < refCount % blockCount ? 1 : 0);
+		for (let i = 0 ; i < lines ; ++i) {
+			const ref = document.createElement("lit-ref");
+			ref.setAttribute("name", `Block ${i}`);
+			ref.setAttribute("href", `#lit-${i}`);
+			ref.setAttribute("lexer", "C++");
+			ref.setAttribute("hidden-link", i % 10 === 0 ? "true" : "false");
+			pre.append(document.createTextNode("    "), ref, document.createTextNode("\n"));
+		}
+		const info = document.createElement("lit-block-info");
+		info.setAttribute("data-uid", `doc:${b}`);
+		document.body.append(pre, info);
+	}
+}
+
+function createJsdomPage(jsdom) {
+	const dom = new jsdom.JSDOM("<!DOCTYPE html><html><head></head><body></body></html>", {
+		runScripts: "outside-only",
+		url: "http://localhost/",
+	});
+	dom.window.console.log = () => {};
+	return {
+		document: dom.window.document,
+		run: code => dom.window.eval(code),
+		loaded: () => dom.window.document.dispatchEvent(new dom.window.Event("DOMContentLoaded")),
+		renderedCount: () => [...dom.window.document.querySelectorAll("lit-ref, lit-block-info")].filter(node => node.shadowRoot).length,
+		hiddenLineCount: () => [...dom.window.document.querySelectorAll(".lit-line-wrapper")].filter(isHiddenLine).length,
+	};
+}
+
+function loadPage(createPage, script, refCount, blockCount) {
+	const page = createPage();
+	buildPage(page, refCount, blockCount);
+	const start = process.hrtime.bigint();
+	page.run(script);
+	page.loaded();
+	page.loadTime = Number(process.hrtime.bigint() - start) / 1e6;
+	page.renderedWhileLoading = page.renderedCount();
+	page.hiddenLinesWhileLoading = page.hiddenLineCount();
+	return page;
+}
+
+/**
+ * @return the average time of options.set(key, ...), in milliseconds
+ */
+function toggleTime(page, key, repeat = 10) {
+	const toggle = `options.set(${JSON.stringify(key)}, !options.get(${JSON.stringify(key)}))`;
+	// Warm up, and leave the option as it was
+	page.run(toggle);
+	page.run(toggle);
+	const start = process.hrtime.bigint();
+	for (let i = 0 ; i < repeat ; ++i) {
+		page.run(toggle);
+	}
+	return Number(process.hrtime.bigint() - start) / 1e6 / repeat;
+}
+
+/**
+ * Let the timers run, which render the elements near the viewport or a few
+ * idle-time batches.
+ */
+async function settle() {
+	for (let i = 0 ; i < 3 ; ++i) {
+		await new Promise(resolve => setTimeout(resolve, 0));
+	}
+}
+
+/**
+ * Render all the elements that are still pending.
+ * @return the time it took, in milliseconds
+ */
+async function renderAll(page) {
+	const start = process.hrtime.bigint();
+	await settle();
+	page.run("if (typeof renderScheduler !== 'undefined') renderScheduler.flush()");
+	return Number(process.hrtime.bigint() - start) / 1e6;
+}
+
+//////////////////////////////////////////////////////////////
+
+async function main() {
+	const scriptPath = process.argv[2] || path.join(__dirname, "..", "_extensions", "sphinx_literate", "js", "sphinx_literate.js");
+	const script = fs.readFileSync(scriptPath, "utf8");
+
+	let modes = {
+		"idle batches": () => createMiniWindow(false),
+		"viewport": () => createMiniWindow(true),
+	};
+	let domName = "minimal DOM";
+	try {
+		const jsdom = require("jsdom");
+		// jsdom has no IntersectionObserver
+		modes = { "idle batches": () => createJsdomPage(jsdom) };
+		domName = "jsdom";
+	} catch (err) {
+		// jsdom is not installed
+	}
+
+	const keys = ["showBlockName", "showReferenceDetails", "showReferenceLinks", "showHiddenLinks", "showHiddenBlocks"];
+	const blockCount = 50;
+	let status = 0;
+	console.log(`toggle latency (${domName}, ${blockCount} blocks, ${path.basename(scriptPath)}):`);
+	for (const [mode, createPage] of Object.entries(modes)) {
+		// Warm up the JIT on a page that is not measured
+		const warmup = loadPage(createPage, script, 200, blockCount);
+		await renderAll(warmup);
+		keys.forEach(key => toggleTime(warmup, key));
+
+		console.log(`  rendering in ${mode}:`);
+		const timings = {};
+		for (const refCount of [0, 2000]) {
+			const t = timings[refCount] = {};
+			const page = loadPage(createPage, script, refCount, blockCount);
+			t.load = page.loadTime;
+			t.renderedWhileLoading = page.renderedWhileLoading;
+			t.hiddenLinesWhileLoading = page.hiddenLinesWhileLoading;
+			// Toggle once all elements are rendered in idle batches mode, and
+			// once the elements near the viewport are in viewport mode (the
+			// other ones are rendered afterwards)
+			if (mode === "viewport") {
+				await settle();
+			} else {
+				t.render = await renderAll(page);
+			}
+			const row = keys.map(key => {
+				t[key] = toggleTime(page, key);
+				return `${key} ${t[key].toFixed(2)} ms`;
+			});
+			if (mode === "viewport") {
+				t.render = await renderAll(page);
+			}
+			t.renderedAtEnd = page.renderedCount();
+			console.log(`    ${String(refCount).padStart(5)} refs: load ${t.load.toFixed(1)} ms (${t.renderedWhileLoading} rendered), render ${t.render.toFixed(1)} ms, ${row.join(", ")}`);
+		}
+
+		const ratio = timings[2000].showBlockName / timings[0].showBlockName;
+		console.log(`    showBlockName, ratio 2000/0 refs: ${ratio.toFixed(2)}`);
+		if (ratio > 3) {
+			console.log("FAILED: toggling an option rebuilds elements that do not depend on it");
+			status = 1;
+		}
+		if (timings[2000].renderedAtEnd !== 2000 + blockCount) {
+			console.log("FAILED: some elements are never rendered");
+			status = 1;
+		}
+		if (timings[2000].hiddenLinesWhileLoading !== 2000 / 10) {
+			console.log("FAILED: lines of hidden references are shown until they are rendered");
+			status = 1;
+		}
+		if (timings[2000].renderedWhileLoading > 0) {
+			console.log("FAILED: elements are rendered while the page loads");
+			status = 1;
+		}
+	}
+	return status;
+}
+
+main().then(status => { process.exitCode = status; });
@@ -0,0 +1,113 @@
+"""
+Benchmarks for the parsing of block titles and block links.
+
+Run with `python bench/bench_parse.py`. The corpus is made of the titles of
+the lit directives and of the references found in the documentation of this
+repository. The option tokenizer is compared with a character-level automaton
+(the original implementation), and the script exits with a non-zero status
+when they disagree or when the tokenizer is not faster.
+"""
+
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.parse import (
+    parse_block_title, parse_block_link, tokenize_block_title_options,
+)
+
+from pathlib import Path
+from timeit import timeit
+import re
+
+#############################################################
+
+def load_corpus():
+    """
+    @return the list of raw titles and the list of raw links of the doc
+    """
+    titles = []
+    links = []
+    doc_dir = Path(dirname(dirname(__file__))) / "doc"
+    for path in sorted(doc_dir.rglob("*.md")):
+        text = path.read_text(encoding="utf-8")
+        titles += re.findall(r"^(?:```|:::)\{lit\}(.*)$", text, re.MULTILINE)
+        links += re.findall(r"\{\{(.*?)\}\}", text)
+    return titles, links
+
+def reference_tokenize(raw_options: str):
+    """
+    Split options one character at a time, like the tokenizer did before
+    being based on regular expressions.
+    """
+    DEFAULT, IN_STRING, IN_STRING_ESCAPE = range(3)
+    state = DEFAULT
+    token = ""
+    all_tokens = []
+    for char in raw_options:
+        if state == DEFAULT:
+            if char == ',':
+                all_tokens.append(token)
+                token = ""
+                continue
+            if char == '"':
+                state = IN_STRING
+        elif state == IN_STRING:
+            if char == '\\':
+                state = IN_STRING_ESCAPE
+                continue
+            if char == '"':
+                state = DEFAULT
+        else:
+            state = IN_STRING
+        token += char
+    all_tokens.append(token)
+    return all_tokens
+
+def raw_options_of(title: str):
+    i = title.find('(')
+    return title[i+1:-1] if i != -1 else None
+
+#############################################################
+
+def main():
+    titles, links = load_corpus()
+    # Make the corpus less dominated by titles without options
+    options = [
+        o for o in map(raw_options_of, titles)
+        if o is not None
+    ]
+    options += [
+        'insert in {{file:CMakeLists.txt}} after "project(\\"a, b\\")"',
+        'for tangle root "step-2", append',
+    ]
+
+    for o in options:
+        if tokenize_block_title_options(o) != reference_tokenize(o):
+            print(f"FAILED: options are split differently: ({o})")
+            return 1
+
+    def run(f, corpus):
+        n = 2000 // len(corpus) + 1
+        t = min(
+            timeit(lambda: [f(x) for x in corpus], number=n)
+            for _ in range(5)
+        )
+        return t / n / len(corpus)
+
+    print(f"corpus: {len(titles)} titles, {len(options)} option lists, {len(links)} links")
+    title_time = run(parse_block_title, titles)
+    link_time = run(lambda l: parse_block_link(l, None), links)
+    tokenize_time = run(tokenize_block_title_options, options)
+    reference_time = run(reference_tokenize, options)
+    print(f"  parse_block_title: {title_time * 1e9:8.1f} ns/title")
+    print(f"   parse_block_link: {link_time * 1e9:8.1f} ns/link")
+    print(f"  options tokenizer: {tokenize_time * 1e9:8.1f} ns/option list (automaton: {reference_time * 1e9:.1f} ns)")
+
+    if tokenize_time > reference_time:
+        print("FAILED: the tokenizer is slower than a character-level automaton")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,182 @@
+"""
+Benchmarks for CodeBlockRegistry operations.
+
+Run with `python bench/bench_registry.py`. The script exits with a non-zero
+status when looking up a block by uid is not much faster than scanning all
+blocks, when the time to remove a document does not stay (roughly) flat as
+the registry grows, or when listing the 'file:' blocks of each tangle root of
+a project with many roots is not much faster than resolving every block name
+with get_rec().
+"""
+
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.registry import CodeBlockRegistry, CodeBlock, SourceLocation
+
+from time import perf_counter
+from timeit import timeit
+import random
+
+#############################################################
+
+def build_registry(block_count: int, chain_length: int = 4) -> CodeBlockRegistry:
+    """
+    Create a registry with block_count blocks, organized in chains of
+    chain_length appended blocks.
+    """
+    reg = CodeBlockRegistry()
+    for i in range(block_count):
+        options = set() if i % chain_length == 0 else {'APPEND'}
+        reg.register_codeblock(CodeBlock(
+            name = f"Block {i // chain_length}",
+            source_location = SourceLocation(f"doc{i // 100}", i),
+            content = [f"line {i}"],
+        ), options)
+    return reg
+
+def scan_by_uid(reg: CodeBlockRegistry, uid: str) -> CodeBlock | None:
+    """
+    Look for a block by walking all chains, as get_by_uid used to do.
+    """
+    for lit in reg._blocks.values():
+        while lit is not None:
+            if lit.uid == uid:
+                return lit
+            lit = lit.next
+
+def bench_get_by_uid(block_count: int, lookup_count: int = 10000, scan_count: int = 20):
+    """
+    @return average time of a call to get_by_uid, and of a lookup that scans
+            all blocks of the same registry, in seconds
+    """
+    reg = build_registry(block_count)
+    uids = list(reg._blocks_by_uid.keys())
+    rng = random.Random(0)
+    queries = [rng.choice(uids) for _ in range(lookup_count)]
+
+    def run():
+        for uid in queries:
+            reg.get_by_uid(uid)
+
+    def run_scan():
+        for uid in queries[:scan_count]:
+            scan_by_uid(reg, uid)
+
+    return (
+        min(timeit(run, number=1) for _ in range(5)) / lookup_count,
+        min(timeit(run_scan, number=1) for _ in range(3)) / scan_count,
+    )
+
+def bench_remove_document(doc_count: int, blocks_per_doc: int = 20) -> float:
+    """
+    @return average time to remove a document from a registry of doc_count
+            documents (and read it again), in seconds
+    """
+    reg = CodeBlockRegistry()
+    def read(d: int):
+        for i in range(blocks_per_doc):
+            reg.register_codeblock(CodeBlock(
+                name = f"Block {d}-{i // 2}",
+                source_location = SourceLocation(f"doc{d}", i),
+                content = [f"line {i}", f"{{{{Block {d}-{i // 2 + 1}}}}}"],
+            ), {'APPEND'} if i % 2 else set())
+    for d in range(doc_count):
+        read(d)
+
+    rng = random.Random(0)
+    docs = [rng.randrange(doc_count) for _ in range(50)]
+    def run():
+        for d in docs:
+            reg.remove_codeblocks_by_docname(f"doc{d}")
+            read(d)
+
+    return min(timeit(run, number=1) for _ in range(3)) / len(docs)
+
+def build_project(root_count: int, blocks_per_root: int) -> CodeBlockRegistry:
+    """
+    Create a registry with a chain of root_count tangle roots (like the
+    successive steps of a tutorial), each of which defines a few files and
+    appends to or redefines blocks of its parent.
+    """
+    reg = CodeBlockRegistry()
+    for r in range(root_count):
+        root = f"step{r:03d}"
+        if r > 0:
+            reg.set_tangle_parent(root, f"step{r - 1:03d}")
+        for i in range(blocks_per_root):
+            name = f"file: src/file{i}.cpp" if i % 10 == 0 else f"Block {r * blocks_per_root // 2 + i}"
+            reg.register_codeblock(CodeBlock(
+                name = name,
+                tangle_root = root,
+                source_location = SourceLocation(f"{root}/doc", i),
+                content = [f"line {i}"],
+            ), {'APPEND'} if r > 0 and i % 10 == 0 else set())
+    reg.finalize()
+    return reg
+
+def bench_file_blocks(root_count: int, blocks_per_root: int):
+    """
+    @return the time to list the 'file:' blocks of all roots with the index,
+            and with a get_rec() call per block name
+    """
+    def run_index():
+        reg = build_project(root_count, blocks_per_root)
+        start = perf_counter()
+        for tangle_root in reg.all_tangle_roots():
+            reg.file_blocks_by_root(tangle_root)
+        return perf_counter() - start
+
+    def run_get_rec():
+        reg = build_project(root_count, blocks_per_root)
+        start = perf_counter()
+        for tangle_root in reg.all_tangle_roots():
+            names = { lit.name for lit in reg.blocks() if reg.get_rec(lit.name, tangle_root) is not None }
+            [reg.get_rec(name, tangle_root) for name in names if name.startswith("file:")]
+        return perf_counter() - start
+
+    return min(run_index() for _ in range(3)), min(run_get_rec() for _ in range(3))
+
+#############################################################
+
+def main():
+    sizes = [1000, 10000, 100000]
+    timings = {}
+    print("get_by_uid:")
+    for size in sizes:
+        timings[size], scan_time = bench_get_by_uid(size)
+        print(f"  {size:>7} blocks: {timings[size] * 1e9:8.1f} ns/lookup (scan: {scan_time * 1e9:.0f} ns)")
+    ratio = timings[sizes[-1]] / timings[sizes[0]]
+    print(f"  ratio {sizes[-1]}/{sizes[0]}: {ratio:.2f}")
+
+    # Cache misses make the lookup time grow with the size of the registry,
+    # so it is compared to a scan of the same registry rather than to a
+    # smaller one: a hash lookup is orders of magnitude faster.
+    if timings[sizes[-1]] * 100 > scan_time:
+        print("FAILED: looking up a block by uid scans the registry")
+        return 1
+
+    doc_counts = [30, 300, 3000]
+    purge_timings = {}
+    print("remove a document and read it again:")
+    for doc_count in doc_counts:
+        purge_timings[doc_count] = bench_remove_document(doc_count)
+        print(f"  {doc_count:>7} documents: {purge_timings[doc_count] * 1e6:8.1f} us/document")
+    ratio = purge_timings[doc_counts[-1]] / purge_timings[doc_counts[0]]
+    print(f"  ratio {doc_counts[-1]}/{doc_counts[0]}: {ratio:.2f}")
+    if ratio > 10:
+        print("FAILED: removing a document depends on the size of the registry")
+        return 1
+
+    root_count, blocks_per_root = 60, 200
+    index_time, get_rec_time = bench_file_blocks(root_count, blocks_per_root)
+    print(f"file blocks of {root_count} roots ({blocks_per_root} blocks each):")
+    print(f"  index: {index_time * 1e3:8.1f} ms (get_rec: {get_rec_time * 1e3:.1f} ms)")
+    if index_time * 10 > get_rec_time:
+        print("FAILED: listing the blocks of a tangle root is not faster than resolving all names")
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,10 +2,12 @@ import sys
 from os.path import join, dirname
 sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
 
-from sphinx_literate.parse import parse_block_title
+from sphinx_literate.parse import parse_block_title, parse_block_content, tokenize_block_title_options
+from sphinx_literate.registry import SourceLocation
 
 from sphinx.errors import ExtensionError
 from unittest import TestCase, main
+from types import SimpleNamespace
 
 # Here are some tests, although the coverage is very low...
 
@@ -51,6 +53,35 @@ class TestBlockTitle(TestCase):
 		self.assertEqual(parsed_title.name, "Change stuff again")
 		self.assertEqual(parsed_title.options, {'HIDDEN', ('INSERT', "foo", 'BEFORE', 'there are "escaped" things')})
 
+	def test_option_tokenizer(self):
+		self.assertEqual(tokenize_block_title_options("append"), ["append"])
+		self.assertEqual(tokenize_block_title_options("append, hidden"), ["append", " hidden"])
+		self.assertEqual(tokenize_block_title_options(r'a "b, \"c\"", d'), ['a "b, "c""', ' d'])
+		# Backslashes only escape within strings, and a string may not be closed
+		self.assertEqual(tokenize_block_title_options(r'a\b, "c\\'), [r'a\b', ' "c\\'])
+		self.assertEqual(tokenize_block_title_options('"a, b\\'), ['"a, b'])
+
+class TestBlockContent(TestCase):
+	def test_deterministic_uids(self):
+		"""
+		Check that reference placeholders do not change from one build to
+		another, and are unique within a block.
+		"""
+		config = SimpleNamespace(lit_begin_ref="{{", lit_end_ref="}}")
+		content = ["{{Includes}}", "int main() { {{Main content}} {{Includes}} }"]
+		loc = SourceLocation("page1", 12)
+
+		parsed = parse_block_content(content, None, config, loc)
+		uids = list(parsed.uid_to_block_link.keys())
+		self.assertEqual(len(set(uids)), 3)
+		self.assertEqual(parsed.content[0], uids[0])
+		self.assertEqual(parsed.content[1], f"int main() {{ {uids[1]} {uids[2]} }}")
+		self.assertTrue(all(uid[0] == "_" and uid[1:].isalnum() for uid in uids))
+
+		self.assertEqual(list(parse_block_content(content, None, config, loc).uid_to_block_link.keys()), uids)
+		other_loc = SourceLocation("page1", 13)
+		self.assertNotEqual(list(parse_block_content(content, None, config, other_loc).uid_to_block_link.keys()), uids)
+
 class TestLitConfig(TestCase):
 	def test_parser(self):
 		"""
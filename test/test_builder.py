@@ -0,0 +1,142 @@
+import sys
+from os.path import join, dirname, getmtime
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.builder import TangleBuilder
+
+from sphinx.application import Sphinx
+
+from unittest import TestCase, main
+from tempfile import TemporaryDirectory
+import io
+import os
+
+class TestTangleBuilder(TestCase):
+    def test_join_lines(self):
+        lines = [f"line {i}" for i in range(100)]
+        chunks = list(TangleBuilder.join_lines(lines[0], iter(lines[1:]), chunk_size=32))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual("".join(chunks), "\n".join(lines))
+
+        self.assertEqual(list(TangleBuilder.join_lines("", iter([]))), [])
+
+    def test_write_file_if_changed(self):
+        # This does not depend on the builder's state
+        write_file_if_changed = lambda *args: TangleBuilder.write_file_if_changed(None, *args)
+
+        with TemporaryDirectory() as tmp:
+            filename = join(tmp, "sub", "file.txt")
+            def read():
+                with open(filename, encoding='utf-8') as f:
+                    return f.read()
+
+            self.assertTrue(write_file_if_changed(filename, iter(["abc\n", "déf"])))
+            self.assertEqual(read(), "abc\ndéf")
+
+            # Same content: the file is not touched
+            os.utime(filename, (0, 0))
+            self.assertTrue(write_file_if_changed(filename, iter(["ab", "c\ndéf"])))
+            self.assertEqual(getmtime(filename), 0)
+
+            # Shorter, longer and different content
+            self.assertTrue(write_file_if_changed(filename, iter(["abc\n"])))
+            self.assertEqual(read(), "abc\n")
+            self.assertTrue(write_file_if_changed(filename, iter(["abc\n", "déf", "ghi"])))
+            self.assertEqual(read(), "abc\ndéfghi")
+            self.assertTrue(write_file_if_changed(filename, "abX"))
+            self.assertEqual(read(), "abX")
+
+    def test_write_file_if_changed_error(self):
+        write_file_if_changed = lambda *args: TangleBuilder.write_file_if_changed(None, *args)
+
+        with TemporaryDirectory() as tmp:
+            filename = join(tmp, "file.txt")
+            with open(filename, "w", encoding='utf-8') as f:
+                f.write("abc\ndef\nghi")
+            os.utime(filename, (0, 0))
+
+            def failing_chunks():
+                yield "abc\n"
+                yield "XYZ\n"
+                raise ValueError("tangling failed")
+
+            # The existing file is left untouched
+            with self.assertRaises(ValueError):
+                write_file_if_changed(filename, failing_chunks())
+            with open(filename, encoding='utf-8') as f:
+                self.assertEqual(f.read(), "abc\ndef\nghi")
+            self.assertEqual(getmtime(filename), 0)
+            self.assertEqual(os.listdir(tmp), ["file.txt"])
+
+            # Nor created when it did not exist
+            newfilename = join(tmp, "new.txt")
+            with self.assertRaises(ValueError):
+                write_file_if_changed(newfilename, failing_chunks())
+            self.assertEqual(os.listdir(tmp), ["file.txt"])
+
+    def test_rebuild_missing_output(self):
+        with TemporaryDirectory() as tmp:
+            srcdir = join(tmp, "src")
+            outdir = join(tmp, "out")
+            os.makedirs(srcdir)
+            with open(join(srcdir, "conf.py"), "w", encoding='utf-8') as f:
+                f.write("extensions = ['sphinx_literate']\n")
+            with open(join(srcdir, "index.rst"), "w", encoding='utf-8') as f:
+                f.write(".. lit:: C++, file: main.cpp\n\n   int main() {}\n")
+
+            def build():
+                app = Sphinx(
+                    srcdir, srcdir, outdir, join(outdir, ".doctrees"), "tangle",
+                    status=io.StringIO(), warning=io.StringIO(),
+                )
+                app.build()
+
+            build()
+            outfilename = join(outdir, "main.cpp")
+            with open(outfilename, encoding='utf-8') as f:
+                self.assertEqual(f.read(), "int main() {}")
+
+            # No document changed, but the output file is missing
+            os.remove(outfilename)
+            build()
+            with open(outfilename, encoding='utf-8') as f:
+                self.assertEqual(f.read(), "int main() {}")
+
+            # Same when the manifest is missing, but unchanged files are not rewritten
+            os.remove(join(outdir, TangleBuilder.manifest_filename))
+            os.utime(outfilename, (0, 0))
+            build()
+            self.assertTrue(os.path.exists(join(outdir, TangleBuilder.manifest_filename)))
+            self.assertEqual(getmtime(outfilename), 0)
+
+    def test_rebuild_on_comment_prefix_change(self):
+        with TemporaryDirectory() as tmp:
+            srcdir = join(tmp, "src")
+            outdir = join(tmp, "out")
+            os.makedirs(srcdir)
+            with open(join(srcdir, "index.rst"), "w", encoding='utf-8') as f:
+                f.write(
+                    # Debug mode is set together with a parent root
+                    ".. lit-setup::\n   :tangle-root: r\n   :parent: p\n   :debug:\n\n" +
+                    ".. lit:: Python, file: main.py\n\n   print()\n"
+                )
+
+            def build(prefix):
+                with open(join(srcdir, "conf.py"), "w", encoding='utf-8') as f:
+                    f.write(f"extensions = ['sphinx_literate']\nlit_comment_prefixes = {{'python': '{prefix}'}}\n")
+                # Keep the same mtime, as only the config changes
+                os.utime(join(srcdir, "conf.py"), (0, 0))
+                app = Sphinx(
+                    srcdir, srcdir, outdir, join(outdir, ".doctrees"), "tangle",
+                    status=io.StringIO(), warning=io.StringIO(),
+                )
+                app.build()
+                with open(join(outdir, "r", "main.py"), encoding='utf-8') as f:
+                    return f.read()
+
+            self.assertIn("# ", build("#"))
+            # Documents are not read again, but the file is tangled again
+            self.assertIn("## ", build("##"))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,57 @@
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.cache import TangleCache
+
+from unittest import TestCase, main
+from tempfile import TemporaryDirectory
+
+class TestTangleCache(TestCase):
+    def test_get_put(self):
+        with TemporaryDirectory() as tmp:
+            filename = join(tmp, "sub", "cache.sqlite")
+            cache = TangleCache(filename, 1 << 20)
+            self.assertIsNone(cache.get("a"))
+            cache.put("a", "abc\\ndéf")
+            cache.put("b", "")
+            self.assertEqual(cache.get("a"), "abc\\ndéf")
+            self.assertEqual(cache.get("b"), "")
+            cache.close()
+
+            # Entries persist across instances
+            cache = TangleCache(filename, 1 << 20)
+            self.assertEqual(cache.get("a"), "abc\\ndéf")
+            cache.close()
+
+    def test_evict(self):
+        with TemporaryDirectory() as tmp:
+            cache = TangleCache(join(tmp, "cache.sqlite"), 25)
+            for key in ["a", "b", "c"]:
+                cache.put(key, key * 10)
+            # Make 'a' the most recently used entry
+            self.assertIsNotNone(cache.get("a"))
+            cache.evict()
+            self.assertIsNotNone(cache.get("a"))
+            self.assertIsNone(cache.get("b"))
+            self.assertIsNotNone(cache.get("c"))
+            cache.close()
+
+    def test_large_entry(self):
+        with TemporaryDirectory() as tmp:
+            cache = TangleCache(join(tmp, "cache.sqlite"), 1 << 30)
+            cache.max_entry_size = 10
+            cache.put("a", "x" * 11)
+            self.assertIsNone(cache.get("a"))
+            cache.close()
+
+    def test_error(self):
+        with TemporaryDirectory() as tmp:
+            # The cache file cannot be created in place of a directory
+            cache = TangleCache(tmp, 1 << 20)
+            self.assertIsNone(cache.get("a"))
+            cache.put("a", "abc")
+            self.assertFalse(cache.enabled)
+
+if __name__ == "__main__":
+    main()
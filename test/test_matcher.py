@@ -0,0 +1,36 @@
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.matcher import MultiPatternMatcher
+
+from unittest import TestCase, main
+import random
+
+class TestMultiPatternMatcher(TestCase):
+    def test_find(self):
+        matcher = MultiPatternMatcher(["return", "int main(", "main", "in", "x = 1;"])
+        self.assertEqual(matcher.find_ordered("int main() {"), ["int main(", "main", "in"])
+        self.assertEqual(matcher.find_ordered("    return 0;"), ["return"])
+        self.assertEqual(matcher.find_ordered("}"), [])
+
+    def test_special_characters(self):
+        matcher = MultiPatternMatcher(["a.b", "(c)", "[", "\\", ""])
+        self.assertEqual(matcher.find_ordered("axb"), [""])
+        self.assertEqual(matcher.find_ordered("f(c)[a.b]\\"), ["a.b", "(c)", "[", "\\", ""])
+
+    def test_same_as_substring_search(self):
+        rng = random.Random(0)
+        alphabet = "ab(."
+        def random_string(max_len):
+            return "".join(rng.choice(alphabet) for _ in range(rng.randint(0, max_len)))
+        for _ in range(500):
+            patterns = [random_string(4) for _ in range(rng.randint(1, 8))]
+            matcher = MultiPatternMatcher(patterns)
+            for _ in range(10):
+                text = random_string(12)
+                expected = [p for p in dict.fromkeys(patterns) if p in text]
+                self.assertEqual(matcher.find_ordered(text), expected)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+import sys
+from os.path import join, dirname
+sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
+
+from sphinx_literate.nodes import LiterateHighlighter, BlockInfoTable
+from sphinx_literate.registry import CodeBlock
+
+from unittest import TestCase, main
+from types import SimpleNamespace
+import json
+import re
+
+class IdentityHighlighter:
+    def highlight_block(self, rawsource, lang, **kwargs):
+        return f"<pre>{rawsource}</pre>"
+
+class TestLiterateHighlighter(TestCase):
+    def test_replace_uids(self):
+        block_a = CodeBlock(name = "Block A", uid = "a")
+        block_b = CodeBlock(name = "Block B", uid = "b")
+        node = SimpleNamespace(uid_to_lit = {
+            "_uid1": (block_a, set()),
+            "_uid2": (block_b, {'HIDDEN'}),
+            "_uid3": (block_a, set()),
+        })
+        calls = []
+        def ref_factory(node, lit, options):
+            calls.append(lit.name)
+            return f"[{lit.name}{' (hidden)' if 'HIDDEN' in options else ''}]"
+
+        highlighter = LiterateHighlighter(IdentityHighlighter(), node, ref_factory)
+        highlighted = highlighter.highlight_block("_uid1 + _uid2\n_uid3 _uid1", "c++")
+
+        self.assertEqual(highlighted, "<pre>[Block A] + [Block B (hidden)]\n[Block A] [Block A]</pre>")
+        self.assertEqual(len(calls), 3)
+
+    def test_no_reference(self):
+        node = SimpleNamespace(uid_to_lit = {})
+        highlighter = LiterateHighlighter(IdentityHighlighter(), node, None)
+        self.assertEqual(highlighter.highlight_block("x", "c++"), "<pre>x</pre>")
+
+class TestBlockInfoTable(TestCase):
+    def test_links(self):
+        builder = SimpleNamespace()
+        table = BlockInfoTable.of_page(builder, "doc")
+        self.assertIs(BlockInfoTable.of_page(builder, "doc"), table)
+        self.assertEqual(table.add_link("A", "#lit-0"), 0)
+        self.assertEqual(table.add_link("B", "other.html#lit-1"), 1)
+        self.assertEqual(table.add_link("A", "#lit-0"), 0)
+        self.assertEqual(table.add_link("A", "#lit-0", 'after "x"'), 2)
+
+        self.assertIs(BlockInfoTable.pop_page(builder, "doc"), table)
+        self.assertIsNone(BlockInfoTable.pop_page(builder, "doc"))
+
+    def test_to_html(self):
+        table = BlockInfoTable()
+        table.blocks["doc:1"] = {
+            'name': "</script><b>&amp;",
+            'permalink': "#lit-0",
+            'hidden': False,
+            'referenced in': [table.add_link("A", "#lit-1")],
+        }
+        output = table.to_html()
+        content = re.fullmatch(r'<script type="application/json" id="lit-block-data">(.*)</script>\n', output).group(1)
+        self.assertNotIn("<", content)
+        self.assertEqual(json.loads(content)['blocks']['doc:1']['name'], "</script><b>&amp;")
+        self.assertEqual(json.loads(content)['links'], [{ 'name': "A", 'url': "#lit-1", 'details': None }])
+
+if __name__ == "__main__":
+    main()
@@ -2,10 +2,11 @@ import sys
 from os.path import join, dirname
 sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
 
-from sphinx_literate.registry import CodeBlockRegistry, CodeBlock
+from sphinx_literate.registry import CodeBlockRegistry, CodeBlock, SourceLocation, BlockKey
 
 from sphinx.errors import ExtensionError
 from unittest import TestCase, main
+import pickle
 
 class TestRegistryBasics(TestCase):
     def test_multiple_tangle_parents(self):
@@ -19,6 +20,338 @@ class TestRegistryBasics(TestCase):
             reg.set_tangle_parent("B", "D")
         self.assertRaises(ExtensionError, dont)
 
+    def test_hierarchy_index(self):
+        reg = CodeBlockRegistry()
+        # Declare children before their parents to check that lineages are
+        # updated when a root gets a parent.
+        reg.set_tangle_parent("D", "C")
+        reg.set_tangle_parent("B", "A")
+        reg.set_tangle_parent("C", "B")
+        reg.set_tangle_parent("E", "B")
+
+        self.assertEqual(list(reg._tangle_lineage("D")), ["D", "C", "B", "A"])
+        self.assertEqual(reg._children_tangle_roots("B"), ["C", "E"])
+        self.assertEqual(sorted(reg._all_children_tangle_roots("A")), ["B", "C", "D", "E"])
+
+        # A root cannot become its own ancestor
+        def dont():
+            reg.set_tangle_parent("A", "D")
+        self.assertRaises(ExtensionError, dont)
+
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "A",
+            content = ["A1"],
+        ))
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "C",
+            content = ["C1"],
+        ), ['APPEND'])
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "E",
+            content = ["E1"],
+        ))
+
+        self.assertEqual(reg.get_rec("Block A1", "D").tangle_root, "C")
+        self.assertEqual(reg.get_rec("Block A1", "B").tangle_root, "A")
+        self.assertEqual(reg.get_rec("Block A1", "E").tangle_root, "E")
+        self.assertEqual(reg.get_rec("Block A1", "B", "D").tangle_root, "C")
+        self.assertEqual(reg.get_rec("Block A1", "A", "E").tangle_root, "A")
+        self.assertIsNone(reg.get_rec("Block A2", "D"))
+
+    def test_visible_blocks(self):
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A")
+        reg.set_tangle_parent("C", "B")
+        reg.register_codeblock(CodeBlock(name = "file:a.txt", tangle_root = "A", content = ["A"]))
+        reg.register_codeblock(CodeBlock(name = "Block", tangle_root = "A", content = ["A"]))
+        reg.register_codeblock(CodeBlock(name = "Block", tangle_root = "B", content = ["B"]), ['APPEND'])
+        reg.register_codeblock(CodeBlock(name = "file:c.txt", tangle_root = "C", content = ["C"]))
+        reg.register_codeblock(CodeBlock(name = "file:d.txt", content = ["D"]))
+
+        for tangle_root in ["A", "B", "C", None]:
+            blocks = reg.blocks_by_root(tangle_root)
+            self.assertEqual(len(blocks), len({ lit.name for lit in blocks }))
+            for lit in blocks:
+                self.assertIs(reg.get_rec(lit.name, tangle_root), lit)
+            self.assertEqual(
+                reg.file_blocks_by_root(tangle_root),
+                [lit for lit in blocks if lit.name.startswith("file:")],
+            )
+
+        self.assertEqual(sorted(lit.name for lit in reg.file_blocks_by_root("C")), ["file:a.txt", "file:c.txt"])
+        self.assertEqual([lit.name for lit in reg.file_blocks_by_root(None)], ["file:d.txt"])
+        self.assertEqual(reg.get_rec("Block", "C").tangle_root, "B")
+        self.assertIn(reg.get_rec("Block", "C"), reg.blocks_by_root("C"))
+
+        # The index is updated when the registry changes
+        reg.register_codeblock(CodeBlock(name = "file:b.txt", tangle_root = "B", content = ["B"]))
+        self.assertEqual(sorted(lit.name for lit in reg.file_blocks_by_root("C")), ["file:a.txt", "file:b.txt", "file:c.txt"])
+        self.assertEqual(len(reg.file_blocks_by_root("A")), 1)
+
+    def test_chain(self):
+        reg = CodeBlockRegistry()
+        reg.register_codeblock(CodeBlock(name = "Block A1", content = ["A1"]))
+        for i in range(10):
+            reg.register_codeblock(CodeBlock(
+                name = "Block A1",
+                content = [f"A{i + 2}"],
+            ), ['REPLACE' if i == 5 else 'APPEND'])
+
+        head = reg.get("Block A1")
+        chain = head.get_chain()
+        self.assertIs(chain.head, head)
+        self.assertEqual(chain.tail.content, ("A11",))
+        self.assertEqual(chain.tail.child_index, 10)
+        self.assertEqual(chain.last_replace.content, ("A7",))
+
+        self.assertEqual(list(head.all_content(reg)), ["A7", "A8", "A9", "A10", "A11"])
+
+    def test_get_by_uid(self):
+        reg = CodeBlockRegistry()
+        block_a = CodeBlock(
+            name = "Block A",
+            source_location = SourceLocation("doc_a", 1),
+            content = ["A"],
+        )
+        reg.register_codeblock(block_a)
+        block_b = CodeBlock(
+            name = "Block A",
+            source_location = SourceLocation("doc_a", 2),
+            content = ["B"],
+        )
+        reg.register_codeblock(block_b, ['APPEND'])
+
+        other = CodeBlockRegistry()
+        block_c = CodeBlock(
+            name = "Block C",
+            source_location = SourceLocation("doc_c", 1),
+            content = ["C"],
+        )
+        other.register_codeblock(block_c)
+        reg.merge(other)
+
+        self.assertIs(reg.get_by_uid(block_a.uid), block_a)
+        self.assertIs(reg.get_by_uid(block_b.uid), block_b)
+        self.assertIs(reg.get_by_uid(block_c.uid), block_c)
+
+        reg.remove_codeblocks_by_docname("doc_a")
+        self.assertIsNone(reg.get_by_uid(block_a.uid))
+        self.assertIsNone(reg.get_by_uid(block_b.uid))
+        self.assertIs(reg.get_by_uid(block_c.uid), block_c)
+
+    def test_deterministic_uid(self):
+        def build():
+            reg = CodeBlockRegistry()
+            for tangle_root in ["A", "B"]:
+                reg.register_codeblock(CodeBlock(
+                    name = "Block A1",
+                    tangle_root = tangle_root,
+                    source_location = SourceLocation("doc_a", 12),
+                ))
+            return reg
+
+        reg = build()
+        uids = [lit.uid for lit in reg.blocks()]
+        self.assertEqual(uids, ["doc_a:12", "doc_a:12:1"])
+        self.assertEqual([lit.uid for lit in build().blocks()], uids)
+
+    def test_block_key(self):
+        self.assertIs(BlockKey.make("Block A1", "A"), BlockKey.make("Block A1", "A"))
+        self.assertEqual(BlockKey.make("Block A1"), BlockKey.make("Block A1", ""))
+        self.assertNotEqual(BlockKey.make("B##C", "A"), BlockKey.make("C", "A##B"))
+
+        # Block names may contain the former '##' separator
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A")
+        reg.register_codeblock(CodeBlock(
+            name = "Block ## A1",
+            tangle_root = "A",
+            content = ["A1"],
+        ))
+        lit = reg.get_rec_by_key(BlockKey.make("Block ## A1", "B"))
+        self.assertEqual(lit.content, ("A1",))
+        self.assertIs(lit.key, BlockKey.make("Block ## A1", "A"))
+
+        # Thawing the registry forgets the keys that it does not use
+        unused = BlockKey.make("Unused", "A")
+        reg.finalize()
+        reg.thaw()
+        self.assertIs(lit.key, BlockKey.make("Block ## A1", "A"))
+        self.assertIsNot(unused, BlockKey.make("Unused", "A"))
+
+    def test_remove_document(self):
+        # Each document registers some blocks, references and roots
+        def read_a(reg):
+            reg.register_codeblock(CodeBlock(
+                name = "Block A1",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_a", 1),
+                content = ["A1", "{{Block A2}}"],
+            ))
+            reg.add_reference(BlockKey.make("Block A1", "A"), BlockKey.make("Block A2", "A"), "doc_a")
+            reg.register_codeblock(CodeBlock(
+                name = "Block A2",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_a", 2),
+                content = ["A2"],
+            ))
+        def read_b(reg):
+            reg.register_codeblock(CodeBlock(
+                name = "Block A1",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_b", 1),
+                content = ["B1", "{{Block A2}}"],
+            ), ['APPEND'])
+            reg.add_reference(BlockKey.make("Block A1", "A"), BlockKey.make("Block A2", "A"), "doc_b")
+            reg.register_codeblock(CodeBlock(
+                name = "Patch",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_b", 2),
+                content = ["patch"],
+            ), [('INSERT', "Block A2", 'AFTER', "A2")])
+        def read_c(reg):
+            reg.set_tangle_parent("C", "A", SourceLocation("doc_c", 1), ["c.zip"])
+            reg.register_codeblock(CodeBlock(
+                name = "Block A1",
+                tangle_root = "C",
+                source_location = SourceLocation("doc_c", 2),
+                content = ["C1"],
+            ), ['APPEND'])
+        def read_d(reg):
+            reg.register_codeblock(CodeBlock(
+                name = "Block A1",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_d", 1),
+                content = ["D1"],
+            ), ['APPEND'])
+        readers = { "doc_a": read_a, "doc_b": read_b, "doc_c": read_c, "doc_d": read_d }
+
+        def build():
+            reg = CodeBlockRegistry()
+            for read in readers.values():
+                read(reg)
+            reg.finalize()
+            return reg
+
+        def dump(reg):
+            return {
+                key: list(lit.all_content(reg))
+                for key, lit in reg.items()
+            }, {
+                key: reg.references_to_key(key)
+                for key in reg.keys()
+            }, {
+                root: (reg._parent_tangle_root(root), reg.all_tangle_fetch_files(root))
+                for root in reg.all_tangle_roots() if root is not None
+            }
+
+        expected = dump(build())
+        self.assertEqual(expected[0][BlockKey.make("Block A1", "C")], ["A1", "{{Block A2}}", "B1", "{{Block A2}}", "D1", "C1"])
+        self.assertEqual(expected[0][BlockKey.make("Block A2", "A")], ["A2", "patch"])
+        self.assertEqual(expected[1][BlockKey.make("Block A2", "A")], [BlockKey.make("Block A1", "A")])
+
+        # Removing a document then reading it again gives the same registry,
+        # even when blocks of later documents were appended to its blocks
+        for docname, read in readers.items():
+            reg = build()
+            reg.thaw()
+            reg.remove_codeblocks_by_docname(docname)
+            self.assertEqual(reg._blocks_by_docname.get(docname), None)
+            for lit in reg.blocks():
+                while lit is not None:
+                    self.assertNotEqual(lit.source_location.docname, docname)
+                    lit = lit.next
+            read(reg)
+            reg.finalize()
+            self.assertEqual(dump(reg), expected, docname)
+
+        # Blocks that were chained to a removed block are missing it again
+        reg = build()
+        reg.thaw()
+        reg.remove_codeblocks_by_docname("doc_a")
+        self.assertEqual(list(reg.get("Block A1", "A").all_content(reg)), ["B1", "{{Block A2}}", "D1"])
+        self.assertEqual(reg.references_to_key(BlockKey.make("Block A2", "A")), [BlockKey.make("Block A1", "A")])
+        self.assertRaises(ExtensionError, reg.finalize)
+
+        reg = build()
+        reg.thaw()
+        reg.remove_codeblocks_by_docname("doc_b")
+        reg.remove_codeblocks_by_docname("doc_c")
+        self.assertIsNone(reg.get_tangle_info("C"))
+        self.assertIsNone(reg.get("Patch", "A"))
+        self.assertEqual(reg.references_to_key(BlockKey.make("Block A2", "A")), [BlockKey.make("Block A1", "A")])
+        reg.finalize()
+        self.assertEqual(list(reg.get("Block A1", "A").all_content(reg)), ["A1", "{{Block A2}}", "D1"])
+
+    def test_pickle(self):
+        reg = CodeBlockRegistry()
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            source_location = SourceLocation("doc_a", 12),
+            content = iter(["A1", "{{Block A2}}"]),
+            refid = "lit-0",
+        ))
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            source_location = SourceLocation("doc_a", 20),
+            content = ["A2"],
+            refid = "lit-1",
+        ), ['APPEND'])
+        reg.finalize()
+        self.assertEqual(reg.get("Block A1").content, ("A1", "{{Block A2}}"))
+        self.assertEqual(list(reg.get("Block A1").all_content(reg)), ["A1", "{{Block A2}}", "A2"])
+
+        reg = pickle.loads(pickle.dumps(reg))
+        lit = reg.get("Block A1")
+        self.assertEqual(lit.refid, "lit-0")
+        self.assertEqual(lit.next.refid, "lit-1")
+        self.assertIs(lit.next.chain, lit.chain)
+        self.assertIs(lit.next.source_location.docname, lit.source_location.docname)
+        self.assertEqual(list(lit.all_content(reg)), ["A1", "{{Block A2}}", "A2"])
+
+        # Keys and document names are shared again when loading the registry
+        # in a new process
+        data = pickle.dumps(reg)
+        BlockKey.forget_interned_keys()
+        reg = pickle.loads(data)
+        lit = reg.get("Block A1")
+        self.assertIs(lit.key, BlockKey.make("Block A1"))
+        self.assertIs(next(iter(reg.keys())), lit.key)
+        self.assertIs(lit.source_location.docname, sys.intern("doc_a"))
+
+    def test_finalize(self):
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A")
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "B",
+            content = ["B1"],
+        ), ['APPEND'])
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "A",
+            content = ["A1"],
+        ))
+
+        reg.finalize()
+        self.assertTrue(reg.frozen)
+        self.assertEqual(reg._missing, [])
+        self.assertEqual(list(reg.get("Block A1", "B").all_content(reg)), ["A1", "B1"])
+
+        # Finalizing again is a no-op
+        reg.finalize()
+
+        def dont():
+            reg.register_codeblock(CodeBlock(name = "Block A2"))
+        self.assertRaises(ExtensionError, dont)
+
+        reg.thaw()
+        reg.register_codeblock(CodeBlock(name = "Block A2"))
+        self.assertFalse(reg.frozen)
+
 class TestRegistryMerge(TestCase):
     def test_merge_simple(self):
         reg_a = CodeBlockRegistry()
@@ -43,7 +376,7 @@ class TestRegistryMerge(TestCase):
 
         self.assertEqual(reg_a._missing, [])
         self.assertEqual(len(reg_b._missing), 1)
-        self.assertEqual(reg_b._missing[0].key, CodeBlock.build_key("Block A1"))
+        self.assertEqual(reg_b._missing[0].key, BlockKey.make("Block A1"))
 
         reg_a.merge(reg_b)
 
@@ -75,12 +408,12 @@ class TestRegistryMerge(TestCase):
 
         self.assertEqual(reg_a._missing, [])
         self.assertEqual(len(reg_b._missing), 1)
-        self.assertEqual(reg_b._missing[0].key, CodeBlock.build_key("Block C1"))
+        self.assertEqual(reg_b._missing[0].key, BlockKey.make("Block C1"))
 
         reg_a.merge(reg_b)
 
         self.assertEqual(len(reg_a._missing), 1)
-        self.assertEqual(reg_a._missing[0].key, CodeBlock.build_key("Block C1"))
+        self.assertEqual(reg_a._missing[0].key, BlockKey.make("Block C1"))
 
         self.assertRaises(ExtensionError, reg_a.check_integrity)
 
@@ -111,13 +444,13 @@ class TestRegistryMerge(TestCase):
 
         self.assertEqual(reg_a._missing, [])
         self.assertEqual(len(reg_b._missing), 1)
-        self.assertEqual(reg_b._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg_b._missing[0].key, BlockKey.make("Block A1", "B"))
 
         reg_a.merge(reg_b)
 
         # No relation between A and B -> key still missing
         self.assertEqual(len(reg_a._missing), 1)
-        self.assertEqual(reg_a._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg_a._missing[0].key, BlockKey.make("Block A1", "B"))
 
         self.assertRaises(ExtensionError, reg_a.check_integrity)
 
@@ -149,7 +482,7 @@ class TestRegistryMerge(TestCase):
 
         self.assertEqual(reg_a._missing, [])
         self.assertEqual(len(reg_b._missing), 1)
-        self.assertEqual(reg_b._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg_b._missing[0].key, BlockKey.make("Block A1", "B"))
 
         reg_a.merge(reg_b)
 
@@ -187,7 +520,7 @@ class TestRegistryMerge(TestCase):
 
         self.assertEqual(reg_a._missing, [])
         self.assertEqual(len(reg_b._missing), 1)
-        self.assertEqual(reg_b._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg_b._missing[0].key, BlockKey.make("Block A1", "B"))
 
         reg_a.merge(reg_b)
 
@@ -215,6 +548,92 @@ class TestRegistryMerge(TestCase):
         self.assertEqual(reg_a._parent_tangle_root("A"), "X")
         self.assertEqual(reg_a._parent_tangle_root("B"), "Y")
 
+    def test_merge_forked_worker(self):
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A", fetch_files = ["a.txt"])
+        reg.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "A",
+            source_location = SourceLocation("doc_a", 1),
+            content = ["A1"],
+        ))
+
+        # Workers are forked from the main process, so they already hold the
+        # blocks that were in the environment when they started.
+        def fork():
+            return pickle.loads(pickle.dumps(reg))
+
+        worker_b = fork()
+        worker_b.set_tangle_parent("B", "A", fetch_files = ["b.txt"])
+        worker_b.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "A",
+            source_location = SourceLocation("doc_b", 1),
+            content = ["B1"],
+        ), ['APPEND'])
+
+        worker_c = fork()
+        worker_c.register_codeblock(CodeBlock(
+            name = "Block A1",
+            tangle_root = "B",
+            source_location = SourceLocation("doc_c", 1),
+            content = ["C1"],
+        ), ['APPEND'])
+
+        reg.schedule_merge(worker_b, ["doc_b"])
+        reg.schedule_merge(worker_c, ["doc_c"])
+        self.assertEqual(list(reg.get("Block A1", "A").all_content(reg)), ["A1"])
+
+        reg.finalize()
+        self.assertEqual(list(reg.get("Block A1", "A").all_content(reg)), ["A1", "B1"])
+        self.assertEqual(list(reg.get("Block A1", "B").all_content(reg)), ["A1", "B1", "C1"])
+        self.assertEqual(reg.get_tangle_info("B").fetch_files, ["a.txt", "b.txt"])
+
+    def test_merge_in_document_order(self):
+        reg = CodeBlockRegistry()
+
+        # Each worker reads two documents, the first one defines the block and
+        # all others append to it.
+        workers = []
+        for chunk in [["doc_0", "doc_1"], ["doc_2", "doc_3"], ["doc_4", "doc_5"]]:
+            worker = pickle.loads(pickle.dumps(reg))
+            for docname in chunk:
+                worker.register_codeblock(CodeBlock(
+                    name = "Main",
+                    source_location = SourceLocation(docname, 1),
+                    content = [docname],
+                ), [] if docname == "doc_0" else ['APPEND'])
+            workers.append((worker, chunk))
+
+        # Workers that read the last documents finish first
+        for worker, chunk in reversed(workers):
+            reg.schedule_merge(worker, chunk)
+
+        reg.finalize()
+        self.assertEqual(reg._missing, [])
+        self.assertEqual(
+            list(reg.get("Main").all_content(reg)),
+            [f"doc_{i}" for i in range(6)]
+        )
+
+    def test_merge_does_not_duplicate_declarations(self):
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A", SourceLocation("doc_a", 1), ["a.txt"])
+
+        # Each worker inherits the declaration of doc_a
+        for i in range(3):
+            worker = pickle.loads(pickle.dumps(reg))
+            worker.register_codeblock(CodeBlock(
+                name = f"Block {i}",
+                tangle_root = "B",
+                source_location = SourceLocation(f"doc_{i}", 1),
+                content = [f"{i}"],
+            ))
+            reg.merge(worker, [f"doc_{i}"])
+
+        self.assertEqual(len(reg._hierarchy_declarations["B"]), 1)
+        self.assertEqual(reg.get_tangle_info("B").fetch_files, ["a.txt"])
+
     def test_cannot_define_contradictory_parents(self):
         reg_a = CodeBlockRegistry()
         reg_a.set_tangle_parent("A", "X")
@@ -344,7 +763,7 @@ class TestRegistryMerge(TestCase):
         ), ['APPEND'])
 
         self.assertEqual(len(reg._missing), 1)
-        self.assertEqual(reg._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg._missing[0].key, BlockKey.make("Block A1", "B"))
 
         # Then define in parent
         reg.register_codeblock(CodeBlock(
@@ -376,7 +795,7 @@ class TestRegistryMerge(TestCase):
         reg.register_codeblock(block_b1, [('INSERT', 'Block A1', 'AFTER', "Line 1")])
 
         self.assertEqual(len(reg._missing), 1)
-        self.assertEqual(reg._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg._missing[0].key, BlockKey.make("Block A1", "B"))
 
         modifier = reg.get("Block B1", "B").prev
         self.assertNotEqual(modifier, None)
@@ -427,7 +846,7 @@ class TestRegistryMerge(TestCase):
         reg_b.register_codeblock(block_b1, [('INSERT', 'Block A1', 'AFTER', "Line 1")])
 
         self.assertEqual(len(reg_b._missing), 1)
-        self.assertEqual(reg_b._missing[0].key, CodeBlock.build_key("Block A1", "B"))
+        self.assertEqual(reg_b._missing[0].key, BlockKey.make("Block A1", "B"))
 
         modifier = reg_b.get("Block B1", "B").prev
         self.assertNotEqual(modifier, None)
@@ -2,10 +2,19 @@ import sys
 from os.path import join, dirname
 sys.path.append(join(dirname(dirname(__file__)), "_extensions"))
 
-from sphinx_literate.registry import CodeBlockRegistry, CodeBlock
+from sphinx_literate.registry import CodeBlockRegistry, CodeBlock, SourceLocation, BlockKey
+from sphinx_literate.tangle import tangle, tangle_closure
+from sphinx_literate.parse import parse_block_content
 
 from sphinx.errors import ExtensionError
 from unittest import TestCase, main
+from types import SimpleNamespace
+
+config = SimpleNamespace(
+    lit_begin_ref = "{{",
+    lit_end_ref = "}}",
+    lit_comment_prefixes = {},
+)
 
 class TestTangle(TestCase):
     def test_inherited_files(self):
@@ -36,5 +45,238 @@ class TestTangle(TestCase):
         self.assertTrue("B" in reg.all_tangle_roots())
         self.assertTrue(None in reg.all_tangle_roots())
 
+    def test_memoized_references(self):
+        reg = CodeBlockRegistry()
+        reg.register_codeblock(CodeBlock(
+            name = "Includes",
+            lexer = "C++",
+            content = ["#include <a>"],
+        ))
+        reg.register_codeblock(CodeBlock(
+            name = "file:foo.cpp",
+            lexer = "C++",
+            content = ["{{Includes}}", "  {{Includes}}"],
+        ))
+
+        tangled, lit = tangle("file:foo.cpp", None, reg, config)
+        self.assertEqual(tangled, ["#include <a>", "  #include <a>"])
+        self.assertEqual(lit, reg.get("file:foo.cpp"))
+
+        includes_key = (BlockKey.make("Includes"), None)
+        self.assertEqual(reg.tangle_cache[includes_key][0], ["#include <a>"])
+
+        # Modifying the registry invalidates memoized results
+        reg.register_codeblock(CodeBlock(
+            name = "Includes",
+            lexer = "C++",
+            content = ["#include <b>"],
+        ), ['APPEND'])
+        self.assertNotIn(includes_key, reg.tangle_cache)
+
+        tangled, _ = tangle("file:foo.cpp", None, reg, config)
+        self.assertEqual(tangled, [
+            "#include <a>",
+            "#include <b>",
+            "  #include <a>",
+            "  #include <b>",
+        ])
+
+    def test_dependencies(self):
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A")
+        base = CodeBlock(
+            name = "file:foo.txt",
+            tangle_root = "A",
+            source_location = SourceLocation("doc_a", 1),
+            content = ["Hello", "{{Body}}"],
+        )
+        reg.register_codeblock(base)
+        body = CodeBlock(
+            name = "Body",
+            tangle_root = "A",
+            source_location = SourceLocation("doc_b", 1),
+            content = ["Body"],
+        )
+        reg.register_codeblock(body)
+        patch = CodeBlock(
+            name = "Patch",
+            tangle_root = "B",
+            source_location = SourceLocation("doc_c", 1),
+            content = ["Patched"],
+        )
+        reg.register_codeblock(patch, [('INSERT', 'Body', 'AFTER', "Body")])
+        unrelated = CodeBlock(
+            name = "Unrelated",
+            tangle_root = "B",
+            source_location = SourceLocation("doc_d", 1),
+            content = ["Unrelated"],
+        )
+        reg.register_codeblock(unrelated)
+
+        dependencies = set()
+        tangled, _ = tangle("file:foo.txt", "B", reg, config, dependencies=dependencies)
+        self.assertEqual(tangled, ["Hello", "Body", "Patched"])
+
+        self.assertEqual({ docname for _, docname, _ in dependencies }, {"doc_a", "doc_b", "doc_c"})
+        uids = { uid for uid, _, _ in dependencies }
+        self.assertIn(base.uid, uids)
+        self.assertIn(body.uid, uids)
+        self.assertIn(patch.uid, uids)
+        self.assertNotIn(unrelated.uid, uids)
+
+    def test_reference_slots(self):
+        reg = CodeBlockRegistry()
+        content = ["int main() {", "    {{Body}} // ignored", "}"]
+        parsed = parse_block_content(content, None, config)
+        self.assertIsNone(parsed.reference_slots[0])
+        self.assertEqual(parsed.reference_slots[1].prefix, "    ")
+        self.assertEqual(parsed.reference_slots[1].link, next(iter(parsed.uid_to_block_link.values())))
+
+        main_block = CodeBlock(
+            name = "file:main.cpp",
+            content = content,
+            reference_slots = parsed.reference_slots,
+        )
+        reg.register_codeblock(main_block)
+        # Parsed when tangling
+        body = CodeBlock(name = "Body", content = ["a();", "{{More}}"])
+        reg.register_codeblock(body)
+        reg.register_codeblock(CodeBlock(name = "More", content = ["b();"]))
+
+        tangled, _ = tangle("file:main.cpp", None, reg, config)
+        self.assertEqual(tangled, ["int main() {", "    a();", "    b();", "}"])
+        self.assertEqual(len(body.reference_slots), 2)
+        self.assertEqual(reg.get("More").reference_slots, ())
+
+    def test_references_from_parent_root(self):
+        # A line inherited from root A refers to a block defined in B when
+        # tangling B.
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A")
+        reg.register_codeblock(CodeBlock(
+            name = "file:foo.txt",
+            tangle_root = "A",
+            content = ["{{Body}}"],
+        ))
+        reg.register_codeblock(CodeBlock(
+            name = "file:foo.txt",
+            tangle_root = "B",
+            content = ["End"],
+        ), ['APPEND'])
+        reg.register_codeblock(CodeBlock(name = "Body", tangle_root = "A", content = ["Body A"]))
+        reg.register_codeblock(CodeBlock(name = "Body", tangle_root = "B", content = ["Body B"]))
+
+        self.assertEqual(tangle("file:foo.txt", "A", reg, config)[0], ["Body A"])
+        self.assertEqual(tangle("file:foo.txt", "B", reg, config)[0], ["Body B", "End"])
+
+    def test_debug_comments(self):
+        reg = CodeBlockRegistry()
+        reg.set_tangle_parent("B", "A", debug = True)
+        reg.register_codeblock(CodeBlock(
+            name = "file:foo.py",
+            tangle_root = "B",
+            lexer = "Python",
+            content = ["{{Body}}"],
+        ))
+        reg.register_codeblock(CodeBlock(
+            name = "Body",
+            tangle_root = "B",
+            lexer = "lua",
+            content = ["print()"],
+        ))
+        debug_config = SimpleNamespace(
+            lit_begin_ref = "{{",
+            lit_end_ref = "}}",
+            lit_comment_prefixes = {"python": "#", "Lua": "--"},
+        )
+        tangled, _ = tangle("file:foo.py", "B", reg, debug_config)
+        self.assertEqual(tangled, [
+            "# {Begin block 'file:foo.py' (in root 'B')}",
+            "-- {Begin block 'Body' (in root 'B')}",
+            "print()",
+            "-- {End block 'Body' (in root 'B')}",
+            "# {End block 'file:foo.py' (in root 'B')}",
+        ])
+
+    def test_deep_references(self):
+        # Deeper than Python's recursion limit
+        depth = sys.getrecursionlimit() + 100
+        reg = CodeBlockRegistry()
+        for i in range(depth):
+            reg.register_codeblock(CodeBlock(
+                name = f"Block {i}",
+                content = [f" {{{{Block {i + 1}}}}}" if i + 1 < depth else "end"],
+            ))
+        tangled, _ = tangle("Block 0", None, reg, config)
+        self.assertEqual(tangled, [" " * (depth - 1) + "end"])
+
+    def test_deep_parent_roots(self):
+        depth = sys.getrecursionlimit() + 100
+        reg = CodeBlockRegistry()
+        reg.register_codeblock(CodeBlock(name = "file:foo.txt", tangle_root = "0", content = ["0"]))
+        for i in range(1, depth):
+            reg.set_tangle_parent(str(i), str(i - 1))
+            reg.register_codeblock(CodeBlock(
+                name = "file:foo.txt",
+                tangle_root = str(i),
+                content = [str(i)],
+            ), ['PREPEND' if i % 2 else 'APPEND'])
+        tangled, _ = tangle("file:foo.txt", str(depth - 1), reg, config)
+        odd = [str(i) for i in range(depth) if i % 2]
+        even = [str(i) for i in range(depth) if i % 2 == 0]
+        self.assertEqual(tangled, odd[::-1] + even)
+
+    def test_reference_cycle(self):
+        reg = CodeBlockRegistry()
+        reg.register_codeblock(CodeBlock(name = "file:foo.txt", content = ["{{A}}"]))
+        reg.register_codeblock(CodeBlock(name = "A", content = ["a", "{{B}}"]))
+        reg.register_codeblock(CodeBlock(name = "B", content = ["  {{A}}"]))
+
+        with self.assertRaises(ExtensionError) as cm:
+            tangle("file:foo.txt", None, reg, config)
+        self.assertIn("'A' -> 'B' -> 'A'", str(cm.exception))
+
+    def test_closure(self):
+        def build(body="Body", patch="Patched", unrelated="Unrelated"):
+            reg = CodeBlockRegistry()
+            reg.set_tangle_parent("B", "A")
+            reg.register_codeblock(CodeBlock(
+                name = "file:foo.txt",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_a", 1),
+                content = ["Hello", "{{Body}}"],
+            ))
+            reg.register_codeblock(CodeBlock(
+                name = "Body",
+                tangle_root = "A",
+                source_location = SourceLocation("doc_b", 1),
+                content = [body],
+            ))
+            reg.register_codeblock(CodeBlock(
+                name = "Patch",
+                tangle_root = "B",
+                source_location = SourceLocation("doc_c", 1),
+                content = [patch],
+            ), [('INSERT', 'Body', 'AFTER', "Body")])
+            reg.register_codeblock(CodeBlock(
+                name = "Unrelated",
+                tangle_root = "B",
+                source_location = SourceLocation("doc_d", 1),
+                content = [unrelated],
+            ))
+            return reg
+
+        reg = build()
+        key, closure = tangle_closure("file:foo.txt", "B", reg, config)
+        dependencies = set()
+        tangle("file:foo.txt", "B", reg, config, dependencies=dependencies)
+        self.assertTrue(dependencies <= closure)
+
+        self.assertEqual(tangle_closure("file:foo.txt", "B", build(), config)[0], key)
+        self.assertEqual(tangle_closure("file:foo.txt", "B", build(unrelated="Changed"), config)[0], key)
+        self.assertNotEqual(tangle_closure("file:foo.txt", "B", build(body="Changed"), config)[0], key)
+        self.assertNotEqual(tangle_closure("file:foo.txt", "B", build(patch="Changed"), config)[0], key)
+        self.assertNotEqual(tangle_closure("file:foo.txt", "A", build(), config)[0], key)
+
 if __name__ == "__main__":
     main()